@@ -317,23 +317,25 @@ def get_product_detail(url):
         "sourceUrl": url
     }
 
-links = get_product_links(1)
-print(links)
-print(f"Find {len(links)} products")
 
-for link in links:
-    print("-> crawl:", link)
-    try:
-        data=get_product_detail(link)
-        print(json.dumps(data, ensure_ascii=False, indent=2))
+def main():
+    links = get_product_links(1)
+    print(links)
+    print(f"Find {len(links)} products")
 
+    for link in links:
+        print("-> crawl:", link)
+        try:
+            data=get_product_detail(link)
+            print(json.dumps(data, ensure_ascii=False, indent=2))
 
-        resp = requests.post(API_URL, json=data)
-        if resp.status_code != 201:
-            print(f"    ❌ Lỗi API: {resp.text}")
-    except Exception as e:
-        print(e)
-    
-    
+
+            resp = requests.post(API_URL, json=data)
+            if resp.status_code != 201:
+                print(f"    ❌ Lỗi API: {resp.text}")
+        except Exception as e:
+            print(e)
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# bench_decode.py
+# Benchmark decode ảnh cho SigLIP: cách cũ (decode full rồi resize) vs decode_image (JPEG draft mode)
+#
+# Chạy từ thư mục services/ai:
+#   python -m bench.bench_decode [--repeat 5]
+import argparse
+import io
+import time
+from PIL import Image
+from src.config import settings
+from src.images import load_vision_image
+
+# Kích thước ảnh upload thường gặp: ảnh web, ảnh chụp màn hình, điện thoại 8MP / 12MP / 48MP
+UPLOAD_SIZES = [
+    ("web 1024x768", (1024, 768), "JPEG"),
+    ("screenshot 1920x1080 PNG", (1920, 1080), "PNG"),
+    ("phone 8MP", (3264, 2448), "JPEG"),
+    ("phone 12MP", (4032, 3024), "JPEG"),
+    ("phone 48MP", (8000, 6000), "JPEG"),
+]
+
+
+def make_image(size, fmt) -> bytes:
+    """Ảnh tổng hợp có gradient + nhiễu (nén JPEG gần giống ảnh chụp thật hơn ảnh một màu)."""
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40)
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=90)
+    return buffer.getvalue()
+
+
+def baseline_decode(data: bytes, size: int):
+    """Đường cũ: decode toàn bộ độ phân giải rồi resize (processor làm bước này)."""
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    return image.resize((size, size), Image.Resampling.BICUBIC)
+
+
+def decoded_megabytes(data: bytes, size: int, draft: bool) -> float:
+    """Kích thước bitmap RGB mà decoder phải cấp phát."""
+    image = Image.open(io.BytesIO(data))
+    if draft and image.format == "JPEG":
+        image.draft("RGB", (size, size))
+    return image.size[0] * image.size[1] * 3 / 1e6
+
+
+def timed(fn, data, size, repeat) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data, size)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decode ảnh cho SigLIP")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    size = settings.VISION_IMAGE_SIZE
+
+    print(f"{'Ảnh':<28} {'File':>9} {'Cũ (ms)':>9} {'Mới (ms)':>9} {'x':>6} {'RAM cũ':>9} {'RAM mới':>9}")
+    for label, dims, fmt in UPLOAD_SIZES:
+        data = make_image(dims, fmt)
+        old_ms = timed(baseline_decode, data, size, args.repeat)
+        new_ms = timed(load_vision_image, data, size, args.repeat)
+        old_mem = decoded_megabytes(data, size, draft=False)
+        new_mem = decoded_megabytes(data, size, draft=True)
+        print(f"{label:<28} {len(data) / 1e6:>7.1f}MB {old_ms:>9.1f} {new_ms:>9.1f} {old_ms / new_ms:>5.1f}x "
+              f"{old_mem:>7.1f}MB {new_mem:>7.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# bench_load.py
+# Load test /analyze, /api/chat và /ws/chat với số request đồng thời cấu hình được.
+#
+# Mặc định chạy toàn bộ trong 1 process với thành phần giả lập tất định:
+#   - Fake Ollama stream token với tốc độ cố định (bench/fake_ollama.py)
+#   - Qdrant in-memory, được seed tranh + kiến thức giả lập
+#   - Model nhỏ trên HuggingFace (xem common.TINY_MODELS), chạy được trên CPU
+#
+# Chạy từ thư mục services/ai:
+#   python -m bench.bench_load --concurrency 8 --requests 64
+#   python -m bench.bench_load --json results.json                  # lưu kết quả
+#   python -m bench.bench_load --baseline results.json --tolerance 0.2   # exit 1 nếu chậm đi > 20%
+#   python -m bench.bench_load --url http://localhost:8000 --endpoints chat   # chạy vào service có sẵn
+#   python -m bench.bench_load --duplicate-inputs   # mọi request cùng nội dung: đo hiệu quả single-flight
+#
+# Mặc định mỗi request có nội dung riêng (ảnh / câu hỏi khác fingerprint) để single-flight (singleflight.py)
+# không gộp chúng: số đo là throughput thật, không phải tỉ lệ request được gộp.
+import argparse
+import asyncio
+import json
+import sys
+import threading
+import time
+import httpx
+from bench.common import SAMPLE_PROFILE, SAMPLE_QUESTIONS, configure_local_stack, seed_collections, summarize
+from bench.fake_ollama import FakeOllamaConfig, start_fake_ollama
+
+ENDPOINTS = ("analyze", "chat", "ws")
+
+
+def start_local_stack(args):
+    """Fake Ollama + Qdrant in-memory + uvicorn chạy trong thread nền. Trả về base_url."""
+    import socket
+    import uvicorn
+
+    fake_config = FakeOllamaConfig(args.tokens_per_second, args.ttft_ms, args.max_tokens)
+    _, ollama_url = start_fake_ollama(fake_config)
+    configure_local_stack(ollama_url, tiny_models=not args.real_models)
+
+    from src.main import app   # Import sau khi đã cấu hình env (load model ở đây)
+
+    print(f"🌱 Seed {args.paintings} tranh + {args.docs} đoạn kiến thức vào Qdrant in-memory...")
+    images = seed_collections(args.paintings, args.docs, ollama_url)
+    fake_config.images = {f"{i}.jpg": data for i, data in enumerate(images)}
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws="websockets"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def sample_image():
+    from bench.bench_decode import make_image
+    return make_image((1600, 1200), "JPEG")
+
+
+async def scrape_ttft(client: httpx.AsyncClient):
+    """(sum, count) của histogram TTFT phía server, để tính TTFT trung bình cho endpoint không stream."""
+    from prometheus_client.parser import text_string_to_metric_families
+    try:
+        response = await client.get("/metrics")
+    except httpx.HTTPError:
+        return None
+    total, count = 0.0, 0.0
+    for family in text_string_to_metric_families(response.text):
+        if family.name == "ai_llm_time_to_first_token_seconds":
+            for sample in family.samples:
+                if sample.name.endswith("_sum"):
+                    total += sample.value
+                elif sample.name.endswith("_count"):
+                    count += sample.value
+    return total, count
+
+
+# --- Từng loại request: trả về (latency_ms, ttft_ms hoặc None, ok) ---
+
+def unique_image(image: bytes, i: int) -> bytes:
+    """Thêm byte sau marker kết thúc JPEG: ảnh decode y hệt nhưng fingerprint khác."""
+    return image + f"bench-{i}".encode()
+
+
+def unique_question(i: int) -> str:
+    return f"{SAMPLE_QUESTIONS[i % len(SAMPLE_QUESTIONS)]} (khách {i})"
+
+
+async def run_analyze(client, i, image, duplicate_inputs=False):
+    start = time.perf_counter()
+    response = await client.post(
+        "/analyze",
+        files={"file": ("room.jpg", image if duplicate_inputs else unique_image(image, i), "image/jpeg")},
+        data={"feng_shui_profile": json.dumps(SAMPLE_PROFILE)},
+    )
+    return (time.perf_counter() - start) * 1000, None, response.status_code == 200
+
+
+async def run_chat(client, i, duplicate_inputs=False):
+    start = time.perf_counter()
+    response = await client.post("/api/chat", json={
+        "text": SAMPLE_QUESTIONS[i % len(SAMPLE_QUESTIONS)] if duplicate_inputs else unique_question(i),
+        "feng_shui_profile": SAMPLE_PROFILE,
+    })
+    return (time.perf_counter() - start) * 1000, None, response.status_code == 200
+
+
+async def run_ws(ws, i, protocol, idle_ms, duplicate_inputs=False):
+    """1 tin nhắn trên kết nối websocket của worker."""
+    text = SAMPLE_QUESTIONS[i % len(SAMPLE_QUESTIONS)] if duplicate_inputs else unique_question(i)
+    start = time.perf_counter()
+    first = None
+
+    if protocol == "v2":
+        await ws.send(json.dumps({"type": "message", "text": text, "feng_shui_profile": SAMPLE_PROFILE}))
+        while True:
+            event = json.loads(await ws.recv())
+            if event["type"] == "delta" and first is None:
+                first = time.perf_counter()
+            elif event["type"] == "done":
+                end = time.perf_counter()
+                return (end - start) * 1000, (first - start) * 1000 if first else None, True
+            elif event["type"] == "error":
+                return (time.perf_counter() - start) * 1000, None, False
+
+    # v1 không có sự kiện kết thúc: coi câu trả lời xong khi không có frame mới trong idle_ms
+    await ws.send(json.dumps({"text": text, "feng_shui_profile": SAMPLE_PROFILE}))
+    end = None
+    while True:
+        try:
+            frame = await asyncio.wait_for(ws.recv(), timeout=idle_ms / 1000 if first else 60)
+        except asyncio.TimeoutError:
+            break
+        if frame.startswith('{"type"'):
+            continue
+        end = time.perf_counter()
+        if first is None:
+            first = end
+    if end is None:
+        return (time.perf_counter() - start) * 1000, None, False
+    return (end - start) * 1000, (first - start) * 1000, True
+
+
+async def run_endpoint(name, base_url, args, image):
+    """Closed-loop: `concurrency` worker, mỗi worker gửi request kế tiếp ngay khi xong request trước."""
+    import websockets
+
+    latencies, ttfts, errors = [], [], 0
+    counter = iter(range(args.warmup + args.requests))
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        before = await scrape_ttft(client)
+
+        async def worker():
+            nonlocal errors
+            ws = None
+            if name == "ws":
+                path = "/ws/chat/v2" if args.ws_protocol == "v2" else "/ws/chat"
+                ws = await websockets.connect(base_url.replace("http", "ws", 1) + path, max_size=None)
+            try:
+                for i in counter:
+                    try:
+                        if name == "analyze":
+                            result = await run_analyze(client, i, image, args.duplicate_inputs)
+                        elif name == "chat":
+                            result = await run_chat(client, i, args.duplicate_inputs)
+                        else:
+                            result = await run_ws(ws, i, args.ws_protocol, args.ws_idle_ms, args.duplicate_inputs)
+                    except Exception as e:
+                        print(f"   ⚠️ {name} #{i}: {type(e).__name__}: {e}")
+                        result = (None, None, False)
+                    if i < args.warmup:
+                        continue
+                    latency, ttft, ok = result
+                    if not ok:
+                        errors += 1
+                        continue
+                    latencies.append(latency)
+                    if ttft is not None:
+                        ttfts.append(ttft)
+            finally:
+                if ws is not None:
+                    await ws.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        after = await scrape_ttft(client)
+
+    server_ttft = None
+    if before and after and after[1] > before[1]:
+        server_ttft = round((after[0] - before[0]) / (after[1] - before[1]) * 1000, 2)
+
+    return {
+        "endpoint": name,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "errors": errors,
+        # Thời gian chạy gồm cả request warmup nên throughput hơi thấp hơn thực tế một chút
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": summarize(latencies),
+        "ttft_ms": summarize(ttfts),
+        "server_ttft_mean_ms": server_ttft,
+    }
+
+
+def print_report(results):
+    print(f"\n{'Endpoint':<10} {'RPS':>7} {'Lỗi':>5} {'p50':>9} {'p95':>9} {'p99':>9} {'TTFT p50':>9} {'TTFT p95':>9} {'TTFT srv':>9}")
+    for r in results:
+        lat, ttft = r["latency_ms"], r["ttft_ms"]
+        fmt = lambda d, k: f"{d[k]:>9.1f}" if k in d else f"{'-':>9}"
+        srv = f"{r['server_ttft_mean_ms']:>9.1f}" if r["server_ttft_mean_ms"] is not None else f"{'-':>9}"
+        print(f"{r['endpoint']:<10} {r['throughput_rps']:>7.2f} {r['errors']:>5} "
+              f"{fmt(lat, 'p50')} {fmt(lat, 'p95')} {fmt(lat, 'p99')} {fmt(ttft, 'p50')} {fmt(ttft, 'p95')} {srv}")
+    print("(đơn vị ms; TTFT srv = TTFT trung bình phía server lấy từ /metrics)")
+
+
+def compare_baseline(results, baseline_path, tolerance, args_duplicates=False) -> bool:
+    """So với lần chạy trước: p95 tăng hoặc throughput giảm quá tolerance -> regression."""
+    with open(baseline_path, encoding="utf-8") as f:
+        data = json.load(f)
+    baseline = {r["endpoint"]: r for r in data["results"]}
+    # Baseline ghi trước khi có --duplicate-inputs: request trùng nội dung, đo cả single-flight -> không so được
+    base_duplicates = data.get("config", {}).get("duplicate_inputs")
+    if base_duplicates is None:
+        print(f"⚠️ {baseline_path} ghi từ bản bench cũ (request trùng nội dung bị single-flight gộp), cần đo lại baseline")
+        return False
+    if base_duplicates != args_duplicates:
+        print(f"⚠️ {baseline_path} đo với duplicate_inputs={base_duplicates}, lần này {args_duplicates}: không so được")
+        return False
+
+    ok = True
+    for r in results:
+        base = baseline.get(r["endpoint"])
+        if not base or "p95" not in r["latency_ms"] or "p95" not in base["latency_ms"]:
+            continue
+        p95, base_p95 = r["latency_ms"]["p95"], base["latency_ms"]["p95"]
+        if p95 > base_p95 * (1 + tolerance):
+            print(f"❌ {r['endpoint']}: p95 {p95:.1f}ms > baseline {base_p95:.1f}ms (+{tolerance:.0%})")
+            ok = False
+        if r["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            print(f"❌ {r['endpoint']}: throughput {r['throughput_rps']} < baseline {base['throughput_rps']} (-{tolerance:.0%})")
+            ok = False
+    if ok:
+        print(f"✅ Không có regression so với {baseline_path}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test AI service với thành phần giả lập local")
+    parser.add_argument("--url", help="Chạy vào service có sẵn thay vì dựng stack local")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="analyze,chat,ws")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=32, help="Số request đo cho mỗi endpoint")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--ws-protocol", choices=("v1", "v2"), default="v2")
+    parser.add_argument("--ws-idle-ms", type=float, default=500.0, help="(v1) khoảng lặng coi như hết câu trả lời")
+    parser.add_argument("--duplicate-inputs", action="store_true",
+                        help="Gửi cùng ảnh / câu hỏi cho mọi request (đo single-flight thay vì throughput)")
+    # Fake Ollama
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument("--max-tokens", type=int, default=120)
+    # Dữ liệu + model
+    parser.add_argument("--paintings", type=int, default=50)
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--real-models", action="store_true", help="Dùng model thật trong config thay vì model nhỏ")
+    # Kết quả
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    parser.add_argument("--baseline", help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"Endpoint không hỗ trợ: {', '.join(sorted(unknown))}")
+
+    base_url = args.url.rstrip("/") if args.url else start_local_stack(args)
+    image = sample_image()
+
+    results = []
+    for name in endpoints:
+        print(f"🚀 {name}: {args.requests} request, concurrency={args.concurrency}")
+        results.append(asyncio.run(run_endpoint(name, base_url, args, image)))
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"💾 Đã lưu kết quả vào {args.json}")
+
+    if args.baseline and not compare_baseline(results, args.baseline, args.tolerance, args.duplicate_inputs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# bench_micro.py
+# Micro-benchmark các hàm nóng: chunk_text, generate_tags (crawler), embedding ảnh / text, rerank.
+#
+# Chạy từ thư mục services/ai (mặc định dùng model nhỏ, xem common.TINY_MODELS):
+#   python -m bench.bench_micro [--repeat 50] [--only chunk_text,rerank] [--real-models]
+#   python -m bench.bench_micro --json micro.json
+#   python -m bench.bench_micro --baseline micro.json --tolerance 0.2
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from bench.common import KNOWLEDGE_SENTENCES, SAMPLE_QUESTIONS, configure_local_stack, summarize, synthetic_document
+
+CRAWLER_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "..", "crawlers", "crawler.py")
+
+
+def load_generate_tags():
+    """crawlers/ không phải package Python -> import trực tiếp từ file."""
+    spec = importlib.util.spec_from_file_location("crawler", os.path.abspath(CRAWLER_PATH))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.generate_tags
+
+
+def measure(fn, repeat: int, warmup: int = 2):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return summarize(times)
+
+
+def build_cases(only):
+    """Danh sách (tên, hàm không tham số). Import lười để chỉ load model khi cần."""
+    cases = []
+    wanted = lambda group: not only or group in only
+
+    if wanted("chunk_text"):
+        from src.ingest_pdf import chunk_text
+        for paragraphs in (50, 500):
+            text = synthetic_document(paragraphs)
+            cases.append((f"chunk_text ({len(text) // 1000}k ký tự)", lambda t=text: chunk_text(t, 500, 50)))
+
+    if wanted("generate_tags"):
+        generate_tags = load_generate_tags()
+        description = " ".join(KNOWLEDGE_SENTENCES)
+        cases.append(("generate_tags (1 mô tả)", lambda: generate_tags(description)))
+
+    if wanted("embedding") or wanted("rerank"):
+        from src.core import ai_models
+
+    if wanted("embedding"):
+        from bench.bench_decode import make_image
+        from src.images import load_vision_image
+        from src.config import settings
+        jpeg = make_image((1600, 1200), "JPEG")
+        decoded = load_vision_image(jpeg, settings.VISION_IMAGE_SIZE)
+        batch = SAMPLE_QUESTIONS * 2
+        cases += [
+            ("image_embedding (JPEG 1600x1200)", lambda: ai_models.get_image_embedding(jpeg)),
+            ("image_embedding (ảnh đã decode)", lambda: ai_models.get_image_embedding(decoded)),
+            ("text_embedding (1 câu)", lambda: ai_models.get_text_embedding(SAMPLE_QUESTIONS[0])),
+            (f"text_embedding (batch {len(batch)})", lambda: ai_models.get_text_embedding(batch)),
+            ("vision_text_embedding (1 câu)", lambda: ai_models.get_vision_text_embedding(SAMPLE_QUESTIONS[0])),
+        ]
+
+    if wanted("rerank"):
+        for n in (10, 30):
+            docs = [synthetic_document(1, seed=i) for i in range(n)]
+            cases.append((f"rerank ({n} đoạn)", lambda d=docs: ai_models.rerank_docs(SAMPLE_QUESTIONS[0], d, top_k=3)))
+
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark các hàm nóng của AI service")
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--only", default="", help="chunk_text,generate_tags,embedding,rerank")
+    parser.add_argument("--real-models", action="store_true")
+    parser.add_argument("--json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Không cần Ollama cho micro-benchmark, chỉ cần settings trỏ tới Qdrant in-memory + model nhỏ
+    configure_local_stack("http://127.0.0.1:9", tiny_models=not args.real_models)
+    only = {name.strip() for name in args.only.split(",") if name.strip()}
+
+    results = {}
+    print(f"{'Benchmark':<40} {'mean':>9} {'p50':>9} {'p95':>9} {'ops/s':>9}")
+    for name, fn in build_cases(only):
+        stats = measure(fn, args.repeat)
+        results[name] = stats
+        print(f"{name:<40} {stats['mean']:>9.3f} {stats['p50']:>9.3f} {stats['p95']:>9.3f} {1000 / stats['mean']:>9.1f}")
+    print("(đơn vị ms)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = [
+            f"❌ {name}: p50 {stats['p50']:.3f}ms > baseline {baseline[name]['p50']:.3f}ms"
+            for name, stats in results.items()
+            if name in baseline and stats["p50"] > baseline[name]["p50"] * (1 + args.tolerance)
+        ]
+        print("\n".join(regressions) or f"✅ Không có regression so với {args.baseline}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
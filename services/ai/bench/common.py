@@ -0,0 +1,146 @@
+# common.py
+# Dùng chung cho các benchmark: dựng môi trường local (fake Ollama, Qdrant in-memory, model nhỏ),
+# sinh dữ liệu giả lập và tính thống kê latency.
+#
+# Lưu ý: configure_local_stack() phải được gọi TRƯỚC khi import bất kỳ module nào trong src
+# (settings, client Qdrant, client Ollama và model đều được tạo lúc import).
+import os
+import random
+import statistics
+import tempfile
+import uuid
+
+# Checkpoint nhỏ trên HuggingFace (trọng số ngẫu nhiên / rất nhỏ) để benchmark chạy trên CPU
+TINY_MODELS = {
+    "VISION_MODEL_ID": "hf-internal-testing/tiny-random-SiglipModel",
+    "TEXT_MODEL_ID": "sentence-transformers-testing/stsb-bert-tiny-safetensors",
+    "RERANKER_MODEL_ID": "cross-encoder/ms-marco-TinyBERT-L-2-v2",
+}
+
+SAMPLE_QUESTIONS = [
+    "Người mệnh Kim nên treo tranh màu gì?",
+    "Tranh cá chép hợp với phòng khách hướng nào?",
+    "Mệnh Thủy có nên treo tranh phong cảnh núi non không?",
+    "Tranh mã đáo thành công treo ở đâu là tốt nhất?",
+    "Phòng ngủ nên treo tranh gì để ngủ ngon?",
+    "Mệnh Hỏa kỵ màu gì khi chọn tranh?",
+    "Tranh hoa sen có ý nghĩa phong thủy gì?",
+    "Văn phòng làm việc nên treo tranh thuận buồm xuôi gió không?",
+]
+
+KNOWLEDGE_SENTENCES = [
+    "Mệnh Kim hợp với màu trắng, xám, ghi và màu vàng của hành Thổ tương sinh.",
+    "Mệnh Mộc hợp màu xanh lá, tranh cây cối, rừng trúc giúp tăng sinh khí.",
+    "Mệnh Thủy hợp màu đen, xanh dương; tranh thác nước, cá chép mang lại tài lộc.",
+    "Mệnh Hỏa hợp màu đỏ, cam, hồng; tranh mặt trời mọc, mã đáo thành công rất phù hợp.",
+    "Mệnh Thổ hợp màu vàng, nâu đất; tranh núi non thể hiện sự vững chãi.",
+    "Phòng khách nên treo tranh có kích thước cân đối với bức tường chính.",
+    "Không nên treo tranh thác nước đổ thẳng về phía cửa chính vì tài lộc trôi ra ngoài.",
+    "Tranh hoa sen tượng trưng cho sự thanh cao, thuần khiết và bình an.",
+    "Phòng ngủ nên tránh tranh có màu quá rực rỡ hoặc hình ảnh dữ dội.",
+    "Tranh thuận buồm xuôi gió nên đặt sao cho thuyền hướng vào trong nhà.",
+]
+
+SAMPLE_PROFILE = {
+    "dung_than": ["Thủy", "Mộc"],
+    "hy_than": ["Kim"],
+    "ky_than": ["Hỏa"],
+    "hung_than": ["Thổ"],
+    "day_master_element": "Mộc",
+    "day_master_status": "Nhược",
+}
+
+
+def configure_local_stack(ollama_url: str, tiny_models: bool = True, device: str = None):
+    """Trỏ service tới các thành phần local qua biến môi trường (settings đọc env lúc import)."""
+    os.environ["OLLAMA_HOST"] = ollama_url
+    os.environ["QDRANT_URL"] = ":memory:"
+    # Đo throughput thật: tắt semantic cache và phần giữ kết quả single-flight cho request trùng đến muộn
+    # (request trùng ĐANG chạy vẫn được gộp -> bench_load gửi nội dung khác nhau cho từng request)
+    os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+    os.environ.setdefault("SINGLEFLIGHT_WINDOW", "0")
+    os.environ.setdefault("DATA_VERSION_FILE", os.path.join(tempfile.gettempdir(), "ai_bench_data_version"))
+    if tiny_models:
+        for key, model_id in TINY_MODELS.items():
+            os.environ.setdefault(key, model_id)
+    if device is None:
+        import torch
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    os.environ["DEVICE"] = device
+
+
+def synthetic_document(paragraphs: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    return "\n\n".join(
+        " ".join(rng.choice(KNOWLEDGE_SENTENCES) for _ in range(rng.randint(2, 6)))
+        for _ in range(paragraphs)
+    )
+
+
+def seed_collections(num_paintings: int, num_docs: int, image_base_url: str):
+    """Tạo collection tranh + kiến thức trong Qdrant in-memory (kích thước vector lấy từ model đang dùng)."""
+    from qdrant_client.http import models
+    from src.config import settings
+    from src.core import ai_models
+    from src.qdrant import client
+    from bench.bench_decode import make_image
+
+    rng = random.Random(0)
+    images = [make_image((rng.randint(400, 1200), rng.randint(400, 1200)), "JPEG") for _ in range(8)]
+
+    points = []
+    for i in range(num_paintings):
+        vector = ai_models.get_image_embedding(images[i % len(images)])
+        points.append(models.PointStruct(
+            id=str(uuid.uuid5(uuid.NAMESPACE_DNS, f"bench-painting-{i}")),
+            vector=vector,
+            payload={
+                "original_id": f"bench-{i}",
+                "name": f"Tranh thử nghiệm {i}",
+                "price": 500000 + 10000 * i,
+                "imageUrl": f"{image_base_url}/images/{i % len(images)}.jpg",
+                "category": "Tranh phong thủy",
+                "tags": rng.sample(["menh_thuy", "menh_moc", "menh_kim", "chu_de_ca_chep", "mau_xanh", "phong_cach_hien_dai"], 3),
+            },
+        ))
+    client.recreate_collection(
+        collection_name=settings.PAINTINGS_COLLECTION,
+        vectors_config=models.VectorParams(size=len(points[0].vector), distance=models.Distance.COSINE),
+    )
+    client.upsert(collection_name=settings.PAINTINGS_COLLECTION, points=points)
+
+    chunks = [synthetic_document(1, seed=i) for i in range(num_docs)]
+    vectors = [ai_models.get_text_embedding(chunk) for chunk in chunks]
+    client.recreate_collection(
+        collection_name=settings.DOCS_COLLECTION,
+        vectors_config=models.VectorParams(size=len(vectors[0]), distance=models.Distance.COSINE),
+    )
+    client.upsert(collection_name=settings.DOCS_COLLECTION, points=[
+        models.PointStruct(id=i, vector=vector, payload={"content": chunk, "source": "bench"})
+        for i, (chunk, vector) in enumerate(zip(chunks, vectors))
+    ])
+    return images
+
+
+def percentile(values, q: float) -> float:
+    """Percentile theo nội suy tuyến tính (q trong [0, 100])."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize(values_ms) -> dict:
+    if not values_ms:
+        return {"count": 0}
+    return {
+        "count": len(values_ms),
+        "mean": round(statistics.fmean(values_ms), 2),
+        "p50": round(percentile(values_ms, 50), 2),
+        "p95": round(percentile(values_ms, 95), 2),
+        "p99": round(percentile(values_ms, 99), 2),
+        "max": round(max(values_ms), 2),
+    }
@@ -0,0 +1,152 @@
+# fake_ollama.py
+# Fake Ollama server (tất định) cho benchmark: stream NDJSON giống /api/chat với tốc độ cấu hình được,
+# và phục vụ ảnh tranh giả lập tại /images/<n>.jpg (cho luồng tải ảnh sản phẩm).
+#
+# Chạy riêng:
+#   python -m bench.fake_ollama --port 11500 --tokens-per-second 40 --ttft-ms 300
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER_WORDS = (
+    "Dựa trên hồ sơ phong thủy của bạn, những bức tranh có tông màu xanh dương và hình ảnh "
+    "dòng nước sẽ giúp tăng cường hành Thủy. Bạn nên treo tranh ở bức tường chính phòng khách, "
+    "tránh đối diện cửa ra vào để giữ tài lộc. "
+).split(" ")
+
+
+class FakeOllamaConfig:
+    def __init__(self, tokens_per_second: float = 40.0, ttft_ms: float = 300.0, max_tokens: int = 200):
+        self.tokens_per_second = tokens_per_second
+        self.ttft_ms = ttft_ms
+        self.max_tokens = max_tokens
+        self.images = {}   # tên file -> bytes JPEG
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+def _handler(config: FakeOllamaConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            name = self.path.rsplit("/", 1)[-1]
+            if self.path.startswith("/images/") and name in config.images:
+                data = config.images[name]
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            if self.path != "/api/chat":
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            config.count_request()
+
+            options = body.get("options") or {}
+            num_tokens = min(config.max_tokens, options.get("num_predict") or config.max_tokens)
+            prompt_tokens = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 4
+            model = body.get("model", "fake")
+
+            if body.get("stream", True) is False:
+                time.sleep((config.ttft_ms + 1000 * num_tokens / config.tokens_per_second) / 1000)
+                content = " ".join(ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(num_tokens))
+                payload = json.dumps(self._chunk(model, content, done=True, prompt_tokens=prompt_tokens,
+                                                 eval_count=num_tokens)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            started = time.perf_counter()
+            time.sleep(config.ttft_ms / 1000)
+            interval = 1 / config.tokens_per_second
+            try:
+                for i in range(num_tokens):
+                    token = ANSWER_WORDS[i % len(ANSWER_WORDS)] + " "
+                    self._write_chunk(self._chunk(model, token))
+                    # Giữ đúng nhịp sinh token kể cả khi ghi socket bị chậm
+                    target = started + config.ttft_ms / 1000 + (i + 1) * interval
+                    time.sleep(max(0.0, target - time.perf_counter()))
+                eval_duration = int((time.perf_counter() - started - config.ttft_ms / 1000) * 1e9)
+                self._write_chunk(self._chunk(model, "", done=True, prompt_tokens=prompt_tokens,
+                                              eval_count=num_tokens, eval_duration=eval_duration))
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # Service đã hủy stream (client ngắt kết nối / tin nhắn mới)
+                pass
+
+        def _write_chunk(self, obj):
+            data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        @staticmethod
+        def _chunk(model, content, done=False, prompt_tokens=0, eval_count=0, eval_duration=0):
+            chunk = {
+                "model": model,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "message": {"role": "assistant", "content": content},
+                "done": done,
+            }
+            if done:
+                chunk.update({
+                    "done_reason": "stop",
+                    "prompt_eval_count": prompt_tokens,
+                    "eval_count": eval_count,
+                    "eval_duration": eval_duration or int(eval_count / config.tokens_per_second * 1e9),
+                })
+            return chunk
+
+    return Handler
+
+
+def start_fake_ollama(config: FakeOllamaConfig, host: str = "127.0.0.1", port: int = 0):
+    """Chạy server trong thread nền. Trả về (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), _handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Ollama server cho benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument("--max-tokens", type=int, default=200)
+    args = parser.parse_args()
+
+    config = FakeOllamaConfig(args.tokens_per_second, args.ttft_ms, args.max_tokens)
+    server, url = start_fake_ollama(config, args.host, args.port)
+    print(f"🤖 Fake Ollama đang chạy tại {url} ({args.tokens_per_second} tokens/s, TTFT {args.ttft_ms}ms)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# answer_cache.py
+# (Semantic cache: câu hỏi diễn đạt khác nhưng cùng ý -> dùng lại câu trả lời)
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+import numpy as np
+from .config import settings
+from .data_version import current_data_version
+from .logger import get_logger
+from .metrics import ANSWER_CACHE_TOTAL
+
+logger = get_logger("answer_cache")
+
+# Câu trả lời đã cache + thông tin của lần trả lời gốc
+CachedAnswer = namedtuple("CachedAnswer", ["answer", "meta"])
+
+
+def context_fingerprint(feng_shui_profile=None, current_product=None) -> str:
+    """Fingerprint của hồ sơ phong thủy + sản phẩm đang xem (câu trả lời phụ thuộc vào chúng)."""
+    product_key = None
+    if current_product:
+        product_key = {
+            "id": current_product.get("id"),
+            "imageUrl": current_product.get("imageUrl"),
+            "price": current_product.get("price"),
+        }
+    raw = json.dumps({"profile": feng_shui_profile, "product": product_key}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def replay_stream(answer: str, chunk_words: int = 4):
+    """Phát lại câu trả lời đã cache theo từng cụm từ, giống định dạng stream của chat_stream."""
+    words = answer.split(" ")
+    for i in range(0, len(words), chunk_words):
+        chunk = " ".join(words[i:i + chunk_words])
+        yield chunk if i + chunk_words >= len(words) else chunk + " "
+
+
+class SemanticAnswerCache:
+    """
+    LRU + TTL cache, key = (embedding câu hỏi, fingerprint ngữ cảnh).
+    Tự xóa toàn bộ khi phiên bản dữ liệu (kho tranh / kiến thức) thay đổi.
+    """
+
+    def __init__(self, threshold: float, ttl: int, max_entries: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # id -> (fingerprint, vector, CachedAnswer, created_at)
+        self._next_id = 0
+        self._data_version = current_data_version()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(vector):
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm > 0 else v
+
+    def _check_version(self):
+        version = current_data_version()
+        if version != self._data_version:
+            logger.info(f"🧹 Dữ liệu đã thay đổi, xóa {len(self._entries)} câu trả lời trong cache")
+            self._entries.clear()
+            self._data_version = version
+
+    def lookup(self, vector, fingerprint: str):
+        """Trả về CachedAnswer (câu trả lời + thông tin đi kèm) nếu có câu hỏi đủ giống, ngược lại None."""
+        if vector is None:
+            return None
+        query = self._normalize(vector)
+        now = time.time()
+
+        with self._lock:
+            self._check_version()
+
+            expired = [k for k, (_, _, _, created) in self._entries.items() if now - created > self.ttl]
+            for k in expired:
+                del self._entries[k]
+
+            candidates = [(k, v) for k, (fp, v, _, _) in self._entries.items() if fp == fingerprint]
+            if candidates:
+                keys = [k for k, _ in candidates]
+                sims = np.stack([v for _, v in candidates]) @ query
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    key = keys[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    ANSWER_CACHE_TOTAL.labels(result="hit").inc()
+                    logger.info(f"⚡ Cache hit (similarity={sims[best]:.3f})")
+                    return self._entries[key][2]
+
+            self.misses += 1
+            ANSWER_CACHE_TOTAL.labels(result="miss").inc()
+            return None
+
+    def store(self, vector, fingerprint: str, answer: str, meta: dict = None):
+        """meta: thông tin của lần trả lời gốc cần trả lại khi hit (vd. context_found)."""
+        if vector is None or not answer:
+            return
+        with self._lock:
+            self._check_version()
+            entry = CachedAnswer(answer, dict(meta or {}))
+            self._entries[self._next_id] = (fingerprint, self._normalize(vector), entry, time.time())
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+answer_cache = SemanticAnswerCache(
+    threshold=settings.ANSWER_CACHE_THRESHOLD,
+    ttl=settings.ANSWER_CACHE_TTL,
+    max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+)
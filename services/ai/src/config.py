@@ -1,29 +1,163 @@
 import os
 from pydantic_settings import BaseSettings
 
+# Thư mục services/ai: đường dẫn dữ liệu mặc định không phụ thuộc thư mục đang đứng khi chạy lệnh
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 class Settings(BaseSettings):
     # API Backend (để lấy danh sách sản phẩm)
     PRODUCT_SERVICE_URL: str = os.getenv("PRODUCT_SERVICE_URL", "http://localhost:3000/products")
     
     QDRANT_URL: str = os.getenv("QDRANT_URL", "http://localhost:6333")
+    # Backend tìm kiếm vector: "qdrant" (server) hoặc "numpy" (memmap trong process, cho kho nhỏ)
+    VECTOR_BACKEND: str = os.getenv("VECTOR_BACKEND", "qdrant")
+    VECTOR_STORE_DIR: str = os.path.join(SERVICE_DIR, "vector_store")
+    # float32: ~0.4ms/truy vấn với 1.4k x 1152 chiều; float16: nhẹ RAM/đĩa 1 nửa nhưng phải đổi kiểu mỗi lần (~4ms)
+    VECTOR_STORE_DTYPE: str = "float32"
+    # Đồ thị "tranh tương tự" (tính sau khi index, phục vụ từ bộ nhớ)
+    NEIGHBORS_FILE: str = os.path.join(SERVICE_DIR, "vector_store", "neighbors.npz")
+    NEIGHBORS_TOP_N: int = 12
     OLLAMA_HOST: str = os.getenv("OLLAMA_HOST", "http://localhost:11434")
     
     # --- 1. MODEL TÌM TRANH (Vision) ---
     VISION_MODEL_ID: str = "google/siglip-so400m-patch14-384"
     VISION_VECTOR_SIZE: int = 1152
+    VISION_IMAGE_SIZE: int = 384          # Kích thước đầu vào của SigLIP
+    MAX_IMAGE_PIXELS: int = 50_000_000    # Chặn ảnh "decompression bomb"
     PAINTINGS_COLLECTION: str = "paintings_siglip"
+    # Tìm tranh bằng chữ (SigLIP text tower): số câu truy vấn giữ vector trong LRU cache
+    TEXT_SEARCH_CACHE_SIZE: int = 2048
+    # SigLIP chỉ hiểu tiếng Anh: câu tiếng Việt đổi qua từ điển (query_translation.py).
+    # Bật thì câu ngoài từ điển nhờ LLM dịch: chiếm slot LLM_MODEL_ID (PRIORITY_BATCH), nên mặc định tắt
+    TEXT_SEARCH_LLM_TRANSLATE: bool = False
+    TEXT_SEARCH_TRANSLATE_TIMEOUT: float = 2.0   # Giây chờ slot LLM tối đa, quá thì dùng câu dự phòng
+    # Tìm tranh bằng nhiều ảnh (/analyze/batch)
+    BATCH_SEARCH_MAX_IMAGES: int = 8
+    BATCH_SEARCH_FUSION: str = "rrf"      # "rrf" (gộp thứ hạng) hoặc "centroid" (trung bình vector)
+    BATCH_SEARCH_RRF_K: int = 60          # Hằng số k của Reciprocal Rank Fusion
+    BATCH_LLM_IMAGES: int = 2             # Số ảnh phòng tối đa gửi kèm cho LLM (mỗi ảnh ~LLM_IMAGE_TOKENS)
     
     # --- 2. MODEL TÌM TÀI LIỆU (Text Retrieval) ---
     TEXT_MODEL_ID: str = "bkai-foundation-models/vietnamese-bi-encoder"
     TEXT_VECTOR_SIZE: int = 768
     DOCS_COLLECTION: str = "feng_shui_docs"
+    # Tham số RAG kiến thức (chọn bằng src/eval_retrieval.py)
+    KNOWLEDGE_CHUNK_SIZE: int = 500       # Ký tự mỗi chunk khi nạp PDF
+    KNOWLEDGE_CHUNK_OVERLAP: int = 50
+    KNOWLEDGE_CANDIDATES: int = 10        # Số đoạn lấy từ Qdrant cho Reranker chọn
+    KNOWLEDGE_TOP_K: int = 3              # Số đoạn đưa vào prompt
     
     # --- 3. MODEL CHẤM ĐIỂM (Reranker) ---
     RERANKER_MODEL_ID: str = "itdainb/PhoRanker"
+    RERANK_MAX_TOKENS: int = 256          # Cắt cặp (câu hỏi, đoạn) về số token này
+    RERANK_BATCH_SIZE: int = 32           # >= KNOWLEDGE_CANDIDATES -> chạy 1 batch duy nhất
+    # Rerank thích ứng: bỏ qua khi điểm dense đã phân định rõ, chỉ rerank các candidate sát top 1
+    RERANK_SKIP_MARGIN: float = 0.1       # top1 - top2 (cosine) >= margin ...
+    RERANK_SKIP_MIN_SCORE: float = 0.5    # ... và top1 >= ngưỡng này -> không cần rerank
+    RERANK_SCORE_WINDOW: float = 0.15     # Candidate kém top1 quá mức này khó được reranker kéo lên
+    
+    # --- XẾP HẠNG HỢP MỆNH (fengshui.py) ---
+    FENGSHUI_WEIGHT_DUNG: float = 1.0     # Trọng số ngũ hành Dụng Thần
+    FENGSHUI_WEIGHT_HY: float = 0.5       # Hỷ Thần
+    FENGSHUI_WEIGHT_KY: float = -0.7      # Kỵ Thần
+    FENGSHUI_WEIGHT_HUNG: float = -1.0    # Hung Thần
+    FENGSHUI_VISUAL_WEIGHT: float = 0.5   # Tỉ trọng điểm SigLIP so với tags khi dựng vector ngũ hành
+    FENGSHUI_MATCH_MIN: float = 0.25      # Điểm >= ngưỡng -> PHÙ HỢP
+    FENGSHUI_AVOID_MAX: float = -0.15     # Điểm <= ngưỡng -> NÊN TRÁNH
+    FENGSHUI_BLEND: float = 0.3           # Trọng số điểm hợp mệnh khi sắp lại kết quả tìm bằng ảnh
     
     # --- 4. MODEL TƯ VẤN (LLM) ---
     LLM_MODEL_ID: str = "qwen2.5:7b"
+    # Tokenizer của LLM (HuggingFace) để đếm token khi lắp ráp context
+    LLM_TOKENIZER_ID: str = "Qwen/Qwen2.5-7B-Instruct"
+    LLM_NUM_CTX: int = 8192
+    LLM_NUM_PREDICT: int = 2048
+    # Số token ước tính cho mỗi ảnh gửi kèm (vision encoder)
+    LLM_IMAGE_TOKENS: int = 768
+    # Tỉ lệ ngân sách token còn lại dành cho kiến thức (phần còn lại cho danh sách tranh)
+    CONTEXT_KNOWLEDGE_SHARE: float = 0.6
+    # Ảnh gửi cho LLM: thu nhỏ về độ phân giải của vision encoder và nén lại JPEG
+    LLM_IMAGE_MAX_SIDE: int = 768
+    LLM_IMAGE_JPEG_QUALITY: int = 85
+    # Giữ model (và KV cache của prompt) trong Ollama giữa các lượt chat
+    LLM_KEEP_ALIVE: str = "30m"
+    # Mô tả hình ảnh sản phẩm (sinh 1 lần / ảnh, chat gửi mô tả thay cho ảnh, xem descriptions.py)
+    DESCRIPTIONS_FILE: str = os.path.join(SERVICE_DIR, "vector_store", "descriptions.json")
+    DESCRIPTIONS_LAZY: bool = True        # Chưa có mô tả: request đầu vẫn gửi ảnh + sinh mô tả nền
+    DESCRIPTION_MAX_TOKENS: int = 300
+    
+    # --- LLM GATEWAY (Giới hạn tải cho Ollama) ---
+    # Giới hạn cho CẢ service: mỗi worker uvicorn có gateway riêng nên được chia đều theo WEB_CONCURRENCY
+    # (uvicorn cũng lấy WEB_CONCURRENCY làm số --workers mặc định -> chỉ cần đặt 1 biến môi trường).
+    # Answer cache, single-flight, EWMA độ trễ vẫn riêng từng worker: request trùng vào 2 worker khác nhau không được gộp.
+    WEB_CONCURRENCY: int = 1
+    LLM_MAX_CONCURRENCY: int = 2      # Tổng số stream Ollama chạy đồng thời (mỗi worker tối thiểu 1)
+    LLM_MAX_QUEUE: int = 16           # Tổng số request được phép chờ, vượt quá sẽ bị từ chối ngay
+    LLM_QUEUE_TIMEOUT: float = 15.0   # Giây tối đa chờ trong hàng đợi
+    LLM_REQUEST_DEADLINE: float = 30.0  # Giây tính từ lúc nhận request tới lúc phải bắt đầu sinh
+    
+    # --- ĐIỀU PHỐI MODEL THEO TẢI ---
+    # Model nhỏ cho câu hỏi đơn giản / lúc quá tải, vd. "qwen2.5:1.5b" (phải pull trên Ollama trước).
+    # Rỗng = tắt: luôn dùng LLM_MODEL_ID, lúc quá tải chỉ rút ngắn câu trả lời
+    LLM_LIGHT_MODEL_ID: str = ""
+    LLM_LIGHT_NUM_PREDICT: int = 768
+    LLM_PRESSURE_NUM_PREDICT: int = 1024      # num_predict của model chính khi quá tải
+    LLM_ROUTE_QUEUE_DEPTH: int = 4            # Hàng đợi (tổng các worker) dài hơn mức này -> coi là quá tải
+    LLM_ROUTE_LATENCY: float = 5.0            # TTFT trung bình (giây, sau khi có slot) vượt mức này -> quá tải
+    LLM_ROUTE_SIMPLE_TOKENS: int = 300        # Câu hỏi + kiến thức + tranh dưới mức này -> câu hỏi đơn giản
+    
+    # Giây giữ kết quả của /analyze, /api/chat cho request trùng đến muộn (0 = chỉ gộp khi đang chạy)
+    SINGLEFLIGHT_WINDOW: float = 2.0
+    
+    # --- WEBSOCKET ---
+    WS_MAX_IMAGE_BYTES: int = 10 * 1024 * 1024   # Giới hạn ảnh upload qua websocket
+    WS_COALESCE_MS: int = 40                     # Gom token trong cửa sổ thời gian (protocol v2)
+    WS_COALESCE_CHARS: int = 256                 # ... hoặc tới khi đủ số ký tự
+    
+    # --- 5. CACHE CÂU TRẢ LỜI (Semantic cache) ---
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_THRESHOLD: float = 0.92   # Cosine similarity tối thiểu để coi là cùng câu hỏi
+    ANSWER_CACHE_TTL: int = 6 * 3600       # Giây
+    ANSWER_CACHE_MAX_ENTRIES: int = 1024
+    # File đánh dấu phiên bản dữ liệu (index/ingest ghi lại khi kho tranh hoặc kiến thức thay đổi).
+    # Indexer và API phải thấy cùng 1 file: rỗng = <VECTOR_STORE_DIR>/data_version
+    DATA_VERSION_FILE: str = ""
+    
+    # --- 6. PHIÊN CHAT NHIỀU LƯỢT (/ws/chat) ---
+    SESSION_HISTORY_TOKENS: int = 1536        # Trần token cho lịch sử, vượt quá sẽ tóm tắt
+    SESSION_SUMMARY_TOKENS: int = 256         # Độ dài tối đa của bản tóm tắt
+    SESSION_RETRIEVAL_SIMILARITY: float = 0.6 # Câu hỏi đủ giống lần tìm kiếm trước -> dùng lại kết quả
+    
+    # --- GIÁM SÁT ---
+    LOG_LEVEL: str = "INFO"
+    
+    # --- PROFILING THEO REQUEST ---
+    # Bật cho 1 request bằng header "X-Profile: 1" (hoặc ?profile=1) kèm "X-Admin-Token"
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")   # Rỗng = tắt profiling thủ công và /admin/profiles
+    PROFILE_SAMPLE_RATE: float = 0.0          # Tỉ lệ request được profile ngẫu nhiên (0 = tắt)
+    PROFILE_TORCH: bool = True                # Ghi thêm torch profiler trace cho các lần gọi model
+    PROFILE_DIR: str = "./profiles"
+    PROFILE_MAX_ARTIFACTS: int = 50           # Giữ lại N profile gần nhất
+    
+    # --- MODEL NẰM TRÊN THIẾT BỊ (core.ModelResidency) ---
+    # Model nạp lúc khởi động; model còn lại nạp lười ở lần dùng đầu (vd. replica chỉ chat: "text,reranker")
+    MODEL_PRELOAD: str = "vision,text,reranker"
+    MODEL_MEMORY_BUDGET_MB: int = 0       # Tổng dung lượng model trên DEVICE (0 = không giới hạn)
+    MODEL_IDLE_SECONDS: float = 0.0       # Model không dùng quá số giây này thì offload (0 = giữ mãi)
+    MODEL_OFFLOAD: str = "cpu"            # "cpu": chuyển GPU -> RAM (nạp lại nhanh) | "unload": giải phóng hẳn
+    
+    # --- MODEL SERVER (nhiều worker HTTP dùng chung 1 bản model, xem model_server.py) ---
+    MODEL_SERVER_SOCKET: str = os.getenv("MODEL_SERVER_SOCKET", "")   # Rỗng = nạp model ngay trong process
+    MODEL_SERVER_CONNECT_TIMEOUT: float = 300.0   # Giây chờ model server nạp xong model lúc khởi động (lần kết nối đầu)
+    MODEL_SERVER_RECONNECT_TIMEOUT: float = 2.0   # Giây chờ kết nối lại sau khi đã từng kết nối được
+    MODEL_SERVER_TIMEOUT: float = 60.0            # Giây tối đa cho 1 lời gọi
     
-    DEVICE: str = "cuda"
+    DEVICE: str = "auto"                  # "auto" (cuda nếu có GPU, không thì cpu) | "cuda" | "cuda:1" | "cpu"
+    # Độ chính xác khi suy luận: "auto" (bf16/fp16 trên cuda, fp32 trên cpu) | "fp32" | "fp16" | "bf16" (autocast)
+    MODEL_PRECISION: str = "auto"
+    # Lần nạp đầu: so vector bộ mẫu cố định với fp32, lệch quá ngưỡng -> model đó quay về fp32
+    MODEL_PRECISION_CHECK: bool = True
+    MODEL_PRECISION_MIN_COSINE: float = 0.995   # Cosine tối thiểu với vector fp32 (vector đã index vẫn tương thích)
+    MODEL_COMPILE: bool = False           # torch.compile SigLIP vision tower / bi-encoder / reranker (khởi động chậm hơn)
 
 settings = Settings()
\ No newline at end of file
@@ -0,0 +1,147 @@
+# context.py
+# (Lắp ráp context cho LLM theo ngân sách token)
+from functools import lru_cache
+from .config import settings
+from .logger import get_logger
+
+logger = get_logger("context")
+
+# Số token tối thiểu để một đoạn kiến thức bị cắt ngắn vẫn còn giá trị
+MIN_COMPRESSED_TOKENS = 64
+# Dự phòng sai số giữa các phần được đếm riêng lẻ
+SAFETY_MARGIN = 64
+# Ước lượng khi không có tokenizer: tiếng Việt có dấu trung bình ~3 ký tự / token với tokenizer BPE
+CHARS_PER_TOKEN = 3
+
+
+@lru_cache(maxsize=1)
+def _get_tokenizer():
+    """Tải tokenizer của LLM (chỉ 1 lần). Trả về None nếu không tải được."""
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(settings.LLM_TOKENIZER_ID)
+        logger.info(f"✅ Tokenizer LLM: {settings.LLM_TOKENIZER_ID}")
+        return tokenizer
+    except Exception as e:
+        logger.warning(f"⚠️ Không tải được tokenizer {settings.LLM_TOKENIZER_ID}, dùng ước lượng theo ký tự: {e}")
+        return None
+
+
+@lru_cache(maxsize=1024)
+def count_tokens(text: str) -> int:
+    """Đếm số token của đoạn text theo tokenizer của LLM."""
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cắt text còn tối đa max_tokens token."""
+    if max_tokens <= 0:
+        return ""
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        # Khớp với count_tokens: len // CHARS_PER_TOKEN + 1 <= max_tokens
+        return text[:(max_tokens - 1) * CHARS_PER_TOKEN]
+    ids = tokenizer.encode(text, add_special_tokens=False)
+    if len(ids) <= max_tokens:
+        return text
+    return tokenizer.decode(ids[:max_tokens]).rstrip() + "…"
+
+
+def _fill_by_score(items, budget, render, compress=None):
+    """
+    Lấy lần lượt các item theo điểm liên quan (cao -> thấp) cho tới khi hết ngân sách.
+    Item không vừa sẽ được nén (nếu có hàm compress) hoặc bị loại.
+
+    Returns:
+        (kept_texts, used_tokens, dropped_count, compressed_count)
+    """
+    # "rank_score": điểm đã gộp hợp mệnh (fengshui.rerank), ưu tiên hơn điểm tìm kiếm gốc
+    def sort_key(item):
+        score = item.get("rank_score", item.get("score"))
+        return score if score is not None else float("-inf")
+
+    ranked = sorted(items, key=sort_key, reverse=True)
+    kept, used, dropped, compressed = [], 0, 0, 0
+
+    for item in ranked:
+        text = render(item, len(kept) + 1)
+        tokens = count_tokens(text)
+        remaining = budget - used
+
+        if tokens <= remaining:
+            kept.append(text)
+            used += tokens
+            continue
+
+        if compress and remaining >= MIN_COMPRESSED_TOKENS:
+            short_text = compress(text, remaining)
+            short_tokens = count_tokens(short_text)
+            if short_text and short_tokens <= remaining:
+                kept.append(short_text)
+                used += short_tokens
+                compressed += 1
+                continue
+
+        dropped += 1
+
+    return kept, used, dropped, compressed
+
+
+def assemble_context(knowledge_docs, products, render_product, fixed_parts, num_images=0, reserve_tokens=0):
+    """
+    Phân bổ ngân sách token cho từng phần của prompt.
+
+    Args:
+        knowledge_docs: List[{"content": str, "score": float}] từ search_knowledge_docs
+        products: List[dict] payload tranh (có "score" nếu tìm bằng vector, "rank_score" nếu đã xếp theo mệnh)
+        render_product: Hàm (product, index) -> str
+        fixed_parts: Dict[name, str] các phần luôn giữ nguyên (template, hồ sơ, câu hỏi...)
+        num_images: Số ảnh gửi kèm (mỗi ảnh chiếm LLM_IMAGE_TOKENS)
+        reserve_tokens: Số token chừa lại (vd. lịch sử hội thoại các lượt sau)
+
+    Returns:
+        (knowledge_str, products_str, usage)
+    """
+    prompt_budget = settings.LLM_NUM_CTX - settings.LLM_NUM_PREDICT - SAFETY_MARGIN - reserve_tokens
+    usage = {"num_ctx": settings.LLM_NUM_CTX, "prompt_budget": prompt_budget, "sections": {}}
+
+    fixed_tokens = 0
+    for name, text in fixed_parts.items():
+        tokens = count_tokens(text)
+        usage["sections"][name] = tokens
+        fixed_tokens += tokens
+
+    image_tokens = num_images * settings.LLM_IMAGE_TOKENS
+    usage["sections"]["images"] = image_tokens
+
+    available = max(prompt_budget - fixed_tokens - image_tokens, 0)
+    knowledge_budget = int(available * settings.CONTEXT_KNOWLEDGE_SHARE)
+
+    # 1. Kiến thức: ưu tiên đoạn có điểm rerank cao, đoạn cuối có thể bị cắt ngắn
+    knowledge_texts, knowledge_used, knowledge_dropped, knowledge_compressed = _fill_by_score(
+        knowledge_docs,
+        knowledge_budget,
+        render=lambda doc, i: doc["content"],
+        compress=truncate_to_tokens,
+    )
+
+    # 2. Sản phẩm: nhận phần ngân sách còn lại (kể cả phần kiến thức chưa dùng hết)
+    products_budget = available - knowledge_used
+    product_texts, products_used, products_dropped, _ = _fill_by_score(
+        products,
+        products_budget,
+        render=render_product,
+    )
+
+    usage["sections"]["knowledge"] = knowledge_used
+    usage["sections"]["products"] = products_used
+    usage["dropped"] = {"knowledge": knowledge_dropped, "products": products_dropped}
+    usage["compressed"] = {"knowledge": knowledge_compressed}
+    usage["prompt_tokens_estimate"] = fixed_tokens + image_tokens + knowledge_used + products_used
+
+    return "\n\n".join(knowledge_texts), "".join(product_texts), usage
@@ -2,11 +2,340 @@
 # (AI Engine - Load Model SigLIP)
 from transformers import AutoProcessor, AutoModel
 from sentence_transformers import SentenceTransformer, CrossEncoder
+from contextlib import contextmanager
 from PIL import Image
+import gc
+import threading
+import time
+import numpy as np
 import torch
-import requests
-import io
 from .config import settings
+from .images import load_vision_image
+from .logger import get_logger
+from .metrics import MODEL_EVICTIONS_TOTAL, MODEL_LOAD_SECONDS, MODEL_RESIDENT_BYTES, stage
+from .profiling import model_trace
+
+logger = get_logger("core")
+
+
+# --- Thiết bị / độ chính xác ---
+
+_AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def resolve_device(device: str) -> str:
+    """ "auto" -> cuda nếu có GPU, không thì cpu; khai báo cuda mà không có GPU -> cpu."""
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    if device.startswith("cuda") and not torch.cuda.is_available():
+        logger.warning(f"⚠️ DEVICE={device} nhưng không có GPU -> chạy trên cpu")
+        return "cpu"
+    return device
+
+
+def resolve_precision(precision: str, device: str) -> str:
+    """ "auto" -> bf16 (hoặc fp16 nếu GPU không hỗ trợ bf16) trên cuda, fp32 trên cpu."""
+    on_cuda = device.startswith("cuda")
+    if precision == "auto":
+        if not on_cuda:
+            return "fp32"
+        return "bf16" if torch.cuda.is_bf16_supported() else "fp16"
+    if precision == "fp16" and not on_cuda:
+        logger.warning("⚠️ Autocast fp16 chỉ dùng trên cuda -> dùng fp32")
+        return "fp32"
+    if precision not in _AUTOCAST_DTYPES and precision != "fp32":
+        logger.warning(f"⚠️ MODEL_PRECISION={precision} không hợp lệ -> dùng fp32")
+        return "fp32"
+    return precision
+
+
+settings.DEVICE = resolve_device(settings.DEVICE)
+
+
+@contextmanager
+def inference_context(precision: str):
+    """torch.inference_mode (không ghi autograd) + autocast fp16 / bf16 nếu precision yêu cầu."""
+    with torch.inference_mode():
+        if precision in _AUTOCAST_DTYPES:
+            with torch.autocast(device_type=settings.DEVICE.split(":")[0], dtype=_AUTOCAST_DTYPES[precision]):
+                yield
+        else:
+            yield
+
+
+def _maybe_compile(parent, attr: str):
+    """torch.compile 1 module con (MODEL_COMPILE); lỗi (thiếu compiler, model không hỗ trợ) thì giữ nguyên."""
+    if not settings.MODEL_COMPILE:
+        return
+    try:
+        setattr(parent, attr, torch.compile(getattr(parent, attr), dynamic=True))
+    except Exception as e:
+        logger.warning(f"⚠️ Không torch.compile được {type(parent).__name__}.{attr}: {e}")
+
+
+# Bộ mẫu cố định: warmup sau khi nạp + so độ lệch với fp32
+DRIFT_CAPTIONS = [
+    "a painting of koi fish swimming",
+    "a landscape painting of mountains and rivers",
+    "a painting in red, orange and pink tones",
+]
+DRIFT_TEXTS = [
+    "Mệnh Kim hợp với màu trắng, xám, ghi và màu vàng của hành Thổ tương sinh.",
+    "Tranh cá chép hợp với phòng khách hướng nào?",
+    "Không nên treo tranh thác nước đổ thẳng về phía cửa chính.",
+]
+DRIFT_PAIRS = [[DRIFT_TEXTS[1], text] for text in DRIFT_TEXTS]
+# Điểm reranker (sau sigmoid, 0..1) được phép lệch so với fp32
+RERANK_DRIFT_MAX = 0.02
+
+
+def _drift_images():
+    """Ảnh tổng hợp tất định: dải màu, bàn cờ, nhiễu (seed cố định)."""
+    size = settings.VISION_IMAGE_SIZE
+    ramp = np.linspace(0, 255, size, dtype=np.float32)
+    gradient = np.stack([np.tile(ramp, (size, 1)), np.tile(ramp[:, None], (1, size)), np.full((size, size), 128.0)], axis=-1)
+    checker = ((np.indices((size, size)).sum(axis=0) // 32) % 2 * 255).astype(np.float32)
+    noise = np.random.default_rng(0).integers(0, 256, (size, size, 3)).astype(np.float32)
+    arrays = [gradient, np.stack([checker] * 3, axis=-1), noise]
+    return [Image.fromarray(a.astype(np.uint8)) for a in arrays]
+
+
+def _load_vision():
+    logger.info(f"   🔹 Loading Vision: {settings.VISION_MODEL_ID}...")
+    processor = AutoProcessor.from_pretrained(settings.VISION_MODEL_ID)
+    model = AutoModel.from_pretrained(settings.VISION_MODEL_ID).to(settings.DEVICE)
+    if hasattr(model, "vision_model"):
+        _maybe_compile(model, "vision_model")
+    return processor, model
+
+
+def _probe_vision(loaded):
+    processor, model = loaded
+    images = processor(images=_drift_images(), do_resize=False, return_tensors="pt").to(settings.DEVICE)
+    texts = processor(text=DRIFT_CAPTIONS, padding="max_length", truncation=True, return_tensors="pt").to(settings.DEVICE)
+    outputs = torch.cat([model.get_image_features(**images), model.get_text_features(**texts)])
+    return outputs.float().cpu().numpy()
+
+
+def _load_text():
+    logger.info(f"   🔹 Loading Text Embed: {settings.TEXT_MODEL_ID}...")
+    model = SentenceTransformer(settings.TEXT_MODEL_ID, device=settings.DEVICE)
+    if hasattr(model[0], "auto_model"):
+        _maybe_compile(model[0], "auto_model")
+    return model
+
+
+def _load_reranker():
+    logger.info(f"   🔹 Loading Reranker: {settings.RERANKER_MODEL_ID}...")
+    # max_length: tokenizer tự cắt cặp (câu hỏi, đoạn) -> chi phí attention có trần
+    model = CrossEncoder(settings.RERANKER_MODEL_ID, device=settings.DEVICE, max_length=settings.RERANK_MAX_TOKENS)
+    _maybe_compile(model, "model")
+    return model
+
+
+def _check_drift(reference, reduced):
+    """
+    So kết quả bộ mẫu ở độ chính xác thấp với fp32.
+    Vector (2 chiều): cosine nhỏ nhất >= MODEL_PRECISION_MIN_COSINE (vector index cũ vẫn dùng được);
+    điểm (1 chiều, reranker): lệch tuyệt đối <= RERANK_DRIFT_MAX.
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    reduced = np.asarray(reduced, dtype=np.float32)
+    if reference.ndim == 2:
+        cosine = (reference * reduced).sum(axis=1) / (
+            np.linalg.norm(reference, axis=1) * np.linalg.norm(reduced, axis=1) + 1e-12)
+        min_cosine = float(cosine.min())
+        return min_cosine >= settings.MODEL_PRECISION_MIN_COSINE, {"min_cosine": round(min_cosine, 6)}
+    max_diff = float(np.abs(reference - reduced).max())
+    return max_diff <= RERANK_DRIFT_MAX, {"max_score_diff": round(max_diff, 6)}
+
+
+def _module_bytes(modules):
+    return sum(t.numel() * t.element_size() for m in modules for t in list(m.parameters()) + list(m.buffers()))
+
+
+class _ResidentModel:
+    def __init__(self, name, load, modules, probe, precision):
+        self.name = name
+        self.load = load              # () -> model đã nằm trên DEVICE
+        self.modules = modules        # model -> các torch module (để chuyển thiết bị / đo dung lượng)
+        self.probe = probe            # model -> kết quả trên bộ mẫu cố định (warmup + kiểm tra độ lệch)
+        self.precision = precision    # "fp32" | "fp16" | "bf16"
+        self.drift = None             # Kết quả kiểm tra với fp32 ở lần nạp đầu
+        self.obj = None
+        self.location = "unloaded"    # "unloaded" | "cpu" (đã offload) | DEVICE
+        self.bytes = 0
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        self.loads = 0
+        self.last_load = None         # {"source", "seconds"}
+        self.lock = threading.Lock()
+
+
+class ModelResidency:
+    """
+    Quản lý model nằm trên DEVICE trong ngân sách bộ nhớ:
+    - Nạp lười / nạp lại khi cần (từ đĩa hoặc từ bản offload trên CPU) + warmup
+    - Chạy trong inference_mode + autocast theo precision; lần nạp đầu so với fp32 trên bộ mẫu,
+      lệch quá ngưỡng thì model đó quay về fp32
+    - Model rảnh quá idle_seconds: offload GPU -> CPU ("cpu") hoặc giải phóng hẳn ("unload")
+    - Nạp model mới vượt ngân sách: đẩy model rảnh lâu nhất (LRU) ra trước
+    Model đang được dùng (trong use()) không bao giờ bị đẩy ra.
+    """
+
+    def __init__(self, budget_bytes: int, idle_seconds: float, offload: str):
+        self.budget_bytes = budget_bytes
+        self.idle_seconds = idle_seconds
+        # Chạy trên CPU thì "offload sang CPU" không giải phóng gì -> luôn unload
+        self.offload = offload if settings.DEVICE != "cpu" else "unload"
+        self.models = {}
+        self._lock = threading.Lock()
+        if idle_seconds > 0:
+            threading.Thread(target=self._idle_loop, name="model-residency", daemon=True).start()
+
+    def register(self, name, load, modules, probe, precision="fp32"):
+        self.models[name] = _ResidentModel(name, load, modules, probe, precision)
+
+    @contextmanager
+    def use(self, name):
+        """
+        with residency.use("text") as model: ...
+        -> model chắc chắn nằm trên DEVICE trong suốt khối lệnh, chạy trong inference_context của model.
+        """
+        model = self.models[name]
+        with self._lock:
+            model.in_use += 1
+        try:
+            with model.lock:
+                if model.location != settings.DEVICE:
+                    self._bring_up(model)
+            with inference_context(model.precision):
+                yield model.obj
+        finally:
+            with self._lock:
+                model.in_use -= 1
+                model.last_used = time.monotonic()
+
+    def preload(self, name):
+        """Nạp sẵn lên DEVICE (không giữ: model vẫn có thể bị offload sau đó, cần dùng thì qua use())."""
+        with self.use(name):
+            pass
+
+    def _bring_up(self, model):
+        """Gọi khi đang giữ model.lock."""
+        with stage("model_load"):
+            start = time.perf_counter()
+            self._make_room(model)
+            if model.obj is None:
+                source = "disk"
+                model.obj = model.load()
+            else:
+                source = "cpu"
+                for module in model.modules(model.obj):
+                    module.to(settings.DEVICE)
+            model.location = settings.DEVICE
+            model.bytes = _module_bytes(model.modules(model.obj))
+            if source == "disk" and model.precision != "fp32" and settings.MODEL_PRECISION_CHECK:
+                self._check_precision(model)
+            else:
+                with inference_context(model.precision):
+                    model.probe(model.obj)   # Warmup
+            # Lần nạp đầu mới biết dung lượng thật -> kiểm tra lại ngân sách
+            self._make_room(model)
+            seconds = time.perf_counter() - start
+
+        model.loads += 1
+        model.last_load = {"source": source, "seconds": round(seconds, 3)}
+        MODEL_LOAD_SECONDS.labels(model=model.name, source=source).observe(seconds)
+        MODEL_RESIDENT_BYTES.labels(model=model.name).set(model.bytes)
+        logger.info(f"📥 Nạp model {model.name} từ {source}: {model.bytes / 2**20:.0f}MB, {seconds:.2f}s")
+
+    @staticmethod
+    def _check_precision(model):
+        """Chạy bộ mẫu ở fp32 và ở precision của model (kiêm warmup); lệch quá ngưỡng / lỗi -> fp32."""
+        try:
+            with inference_context("fp32"):
+                reference = model.probe(model.obj)
+            with inference_context(model.precision):
+                reduced = model.probe(model.obj)
+            passed, metrics = _check_drift(reference, reduced)
+        except Exception as e:
+            passed, metrics = False, {"error": f"{type(e).__name__}: {e}"}
+        model.drift = {"precision": model.precision, "passed": passed, **metrics}
+        if passed:
+            logger.info(f"🎯 {model.name} chạy {model.precision}, lệch so với fp32 trong ngưỡng: {metrics}")
+        else:
+            logger.warning(f"⚠️ {model.name} ở {model.precision} lệch so với fp32 ({metrics}) -> dùng fp32")
+            model.precision = "fp32"
+
+    def _resident_bytes(self, exclude):
+        return sum(m.bytes for m in self.models.values() if m is not exclude and m.location == settings.DEVICE)
+
+    def _make_room(self, keep):
+        if self.budget_bytes <= 0:
+            return
+        while self._resident_bytes(keep) + keep.bytes > self.budget_bytes:
+            idle = [m for m in self.models.values()
+                    if m is not keep and m.location == settings.DEVICE and m.in_use == 0]
+            victim = min(idle, key=lambda m: m.last_used, default=None)
+            if victim is None or not self._evict(victim, "budget"):
+                logger.warning(f"⚠️ Vượt ngân sách bộ nhớ model khi nạp {keep.name} (các model khác đang bận)")
+                return
+
+    def _evict(self, model, reason) -> bool:
+        # Không chờ lock: model đang được nạp / dùng thì bỏ qua (tránh deadlock giữa 2 lần nạp)
+        if not model.lock.acquire(blocking=False):
+            return False
+        try:
+            if model.in_use > 0 or model.location != settings.DEVICE:
+                return False
+            if self.offload == "cpu":
+                for module in model.modules(model.obj):
+                    module.to("cpu")
+                model.location = "cpu"
+            else:
+                model.obj = None
+                model.location = "unloaded"
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        finally:
+            model.lock.release()
+        MODEL_EVICTIONS_TOTAL.labels(model=model.name, reason=reason).inc()
+        MODEL_RESIDENT_BYTES.labels(model=model.name).set(0)
+        logger.info(f"📤 {'Offload' if self.offload == 'cpu' else 'Giải phóng'} model {model.name} ({reason})")
+        return True
+
+    def _idle_loop(self):
+        interval = min(max(self.idle_seconds / 4, 1.0), 30.0)
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            for model in list(self.models.values()):
+                if model.location == settings.DEVICE and model.in_use == 0 and now - model.last_used > self.idle_seconds:
+                    self._evict(model, "idle")
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "device": settings.DEVICE,
+            "budget_mb": round(self.budget_bytes / 2**20),
+            "resident_mb": round(self._resident_bytes(None) / 2**20),
+            "models": {
+                m.name: {
+                    "location": m.location,
+                    "size_mb": round(m.bytes / 2**20),
+                    "in_use": m.in_use,
+                    "idle_seconds": round(now - m.last_used, 1),
+                    "loads": m.loads,
+                    "last_load": m.last_load,
+                    "precision": m.precision,
+                    "drift": m.drift,
+                }
+                for m in self.models.values()
+            },
+        }
+
 
 class AIModels:
 
@@ -22,22 +351,47 @@ class AIModels:
     #     exit(1)
 
     def __init__(self):
-        print("🚀 Đang khởi động hệ thống AI (Loading Models)...")
-        
-        # 1. Load SigLIP (Cho ảnh)
-        print(f"   🔹 Loading Vision: {settings.VISION_MODEL_ID}...")
-        self.vision_processor = AutoProcessor.from_pretrained(settings.VISION_MODEL_ID)
-        self.vision_model = AutoModel.from_pretrained(settings.VISION_MODEL_ID).to(settings.DEVICE)
-        
-        # 2. Load VietnamEmbedding (Cho tìm kiếm text thô)
-        print(f"   🔹 Loading Text Embed: {settings.TEXT_MODEL_ID}...")
-        self.text_model = SentenceTransformer(settings.TEXT_MODEL_ID, device=settings.DEVICE)
-        
-        # 3. Load Reranker (Cho chấm điểm tinh)
-        print(f"   🔹 Loading Reranker: {settings.RERANKER_MODEL_ID}...")
-        self.reranker = CrossEncoder(settings.RERANKER_MODEL_ID, device=settings.DEVICE)
-        
-        print("✅ AI Core Sẵn Sàng!")
+        logger.info("🚀 Đang khởi động hệ thống AI (Loading Models)...")
+        self.residency = ModelResidency(
+            budget_bytes=settings.MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+            idle_seconds=settings.MODEL_IDLE_SECONDS,
+            offload=settings.MODEL_OFFLOAD,
+        )
+        precision = resolve_precision(settings.MODEL_PRECISION, settings.DEVICE)
+        logger.info(f"   🔹 Thiết bị: {settings.DEVICE}, độ chính xác: {precision}")
+        # 1. SigLIP (Cho ảnh). (scale, bias) đọc 1 lần lúc nạp, không cần đưa model lên DEVICE mỗi lần hỏi
+        self._logit_params = None
+        self.residency.register("vision", self._load_vision, lambda m: [m[1]], _probe_vision, precision)
+        # 2. VietnamEmbedding (Cho tìm kiếm text thô)
+        self.residency.register("text", _load_text, lambda m: [m],
+                                lambda m: m.encode(DRIFT_TEXTS, convert_to_numpy=True), precision)
+        # 3. Reranker (Cho chấm điểm tinh)
+        self.residency.register("reranker", _load_reranker, lambda m: [m.model],
+                                lambda m: m.predict(DRIFT_PAIRS, show_progress_bar=False), precision)
+
+        # Model không có trong MODEL_PRELOAD được nạp lười ở lần dùng đầu tiên
+        for name in settings.MODEL_PRELOAD.split(","):
+            if name.strip():
+                self.residency.preload(name.strip())
+        logger.info("✅ AI Core Sẵn Sàng!")
+
+    def _load_vision(self):
+        loaded = _load_vision()
+        model = loaded[1]
+        scale = float(model.logit_scale.exp()) if hasattr(model, "logit_scale") else 10.0
+        bias = float(model.logit_bias) if hasattr(model, "logit_bias") else 0.0
+        self._logit_params = (scale, bias)
+        return loaded
+
+    def use_text_model(self):
+        """
+        with ai_models.use_text_model() as model: ...
+        Truy cập trực tiếp bi-encoder (công cụ offline như eval_retrieval), không bị offload trong khối lệnh.
+        """
+        return self.residency.use("text")
+
+    def residency_stats(self):
+        return self.residency.stats()
 
     def get_image_embedding(self, image_source):
         """
@@ -45,58 +399,105 @@ class AIModels:
         - str (URL): Tải ảnh từ mạng
         - bytes: Ảnh upload từ frontend
         - Image: Đối tượng PIL
-        Output: List[float] (Vector 1152 chiều)
+        Output: List[float] (Vector 1152 chiều, đã chuẩn hóa L2 để dùng Cosine Similarity)
+        """
+        return self.get_image_embeddings([image_source])[0]
+
+    def get_image_embeddings(self, image_sources):
         """
+        Nhiều ảnh -> 1 lượt SigLIP duy nhất (batch).
+        Output: List[List[float] | None] cùng thứ tự đầu vào (None = ảnh lỗi)
+        """
+        with stage("decode"):
+            images = []
+            for source in image_sources:
+                try:
+                    images.append(load_vision_image(source, settings.VISION_IMAGE_SIZE))
+                except Exception as e:
+                    logger.warning(f"⚠️ Lỗi decode ảnh: {e}")
+                    images.append(None)
+        valid = [i for i, image in enumerate(images) if image is not None]
+        results = [None] * len(images)
+        if not valid:
+            return results
+
         try:
-            image = None
-            # 1. Chuẩn hóa đầu vào thành ảnh PIL
-            if isinstance(image_source, str) and image_source.startswith("http"):
-                response = requests.get(image_source, stream=True, timeout=10)
-                if response.status_code == 200:
-                    image = Image.open(response.raw).convert("RGB")
-            elif isinstance(image_source, bytes):
-                image = Image.open(io.BytesIO(image_source)).convert("RGB")
-            elif isinstance(image_source, Image.Image):
-                image = image_source.convert("RGB")
-                
-            if not image: return None
-
-            # 2. Tiền xử lý ảnh (Resize, Normalize theo chuẩn model)
-            inputs = self.vision_processor(images=image, return_tensors="pt").to(settings.DEVICE)
-            
-            # 3. Chạy qua model để lấy Vector
-            with torch.no_grad():
-                outputs = self.vision_model.get_image_features(**inputs)
-                
-            # 4. Chuẩn hóa Vector (L2 Norm) để dùng Cosine Similarity
-            outputs = outputs / outputs.norm(p=2, dim=-1, keepdim=True)
-            
-            # Trả về list số thực (float) để lưu vào Qdrant
-            return outputs[0].cpu().tolist()
+            with self.residency.use("vision") as (processor, model), stage("image_embedding"):
+                inputs = processor(images=[images[i] for i in valid], do_resize=False, return_tensors="pt").to(settings.DEVICE)
+                with model_trace("image_embedding"):
+                    outputs = model.get_image_features(**inputs).float()
+                outputs = outputs / outputs.norm(p=2, dim=-1, keepdim=True)
+                for i, vector in zip(valid, outputs.cpu().tolist()):
+                    results[i] = vector
+        except Exception as e:
+            logger.warning(f"⚠️ Lỗi Embed ảnh (batch {len(valid)}): {e}")
+        return results
 
+    def get_vision_text_embedding(self, texts):
+        """
+        SigLIP text tower: Text -> Vector cùng không gian với ảnh (so khớp ảnh - câu mô tả).
+        Output: List[List[float]] đã chuẩn hóa L2 (1 vector / câu)
+        """
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        try:
+            # SigLIP được huấn luyện với padding="max_length" -> phải pad giống vậy
+            with self.residency.use("vision") as (processor, model), stage("vision_text_embedding"):
+                inputs = processor(text=texts, padding="max_length", truncation=True, return_tensors="pt").to(settings.DEVICE)
+                with model_trace("vision_text_embedding"):
+                    outputs = model.get_text_features(**inputs).float()
+                outputs = outputs / outputs.norm(p=2, dim=-1, keepdim=True)
+                return outputs.cpu().tolist()
         except Exception as e:
-            print(f"⚠️ Lỗi Embed ảnh: {e}")
+            logger.error(f"❌ Lỗi SigLIP Text Embed: {e}")
             return None
-        
+
+    def vision_logit_params(self):
+        """(scale, bias) của SigLIP: xác suất khớp = sigmoid(cosine * scale + bias)"""
+        if self._logit_params is None:
+            # Chưa nạp lần nào (vision không có trong MODEL_PRELOAD) -> nạp, _load_vision ghi lại
+            self.residency.preload("vision")
+        return self._logit_params
+
     def get_text_embedding(self, text):
         """VietnamEmbedding: Text -> Vector"""
         try:
-            return self.text_model.encode(text).tolist()
+            with self.residency.use("text") as model, stage("text_embedding"), model_trace("text_embedding"):
+                return model.encode(text).tolist()
         except Exception as e:
-            print(f"❌ Lỗi Text Embed: {e}")
+            logger.error(f"❌ Lỗi Text Embed: {e}")
             return None
         
-    def rerank_docs(self, query: str, docs: list[str], top_k=3):
-        """PhoRanker: Chấm điểm lại độ liên quan"""
+    def rerank_docs(self, query: str, docs: list[str], top_k=3, return_scores=False):
+        """
+        PhoRanker: Chấm điểm lại độ liên quan
+        - return_scores=True: trả về List[(doc, score)] thay vì List[doc]
+        - Các cặp được sắp theo độ dài trước khi chia batch để giảm padding
+        """
         if not docs: return []
         try:
-            pairs = [[query, doc] for doc in docs]
-            scores = self.reranker.predict(pairs)
+            order = sorted(range(len(docs)), key=lambda i: len(docs[i]), reverse=True)
+            pairs = [[query, docs[i]] for i in order]
+            with self.residency.use("reranker") as reranker, stage("rerank"), model_trace("rerank"):
+                sorted_scores = reranker.predict(pairs, batch_size=settings.RERANK_BATCH_SIZE, show_progress_bar=False)
+            scores = [0.0] * len(docs)
+            for i, score in zip(order, sorted_scores):
+                scores[i] = score
             
             # Sắp xếp điểm cao lên đầu
-            results = sorted(zip(docs, scores), key=lambda x: x[1], reverse=True)
-            return [doc for doc, score in results[:top_k]]
+            results = sorted(zip(docs, scores), key=lambda x: x[1], reverse=True)[:top_k]
+            if return_scores:
+                return [(doc, float(score)) for doc, score in results]
+            return [doc for doc, score in results]
         except Exception as e:
-            print(f"❌ Lỗi Rerank: {e}")
+            logger.error(f"❌ Lỗi Rerank: {e}")
+            if return_scores:
+                return [(doc, None) for doc in docs[:top_k]]
             return docs[:top_k]
-ai_models = AIModels()
\ No newline at end of file
+
+
+if settings.MODEL_SERVER_SOCKET:
+    # Model nằm ở process model_server, worker chỉ giữ proxy (không nạp trọng số)
+    from .model_server import RemoteAIModels
+    ai_models = RemoteAIModels(settings.MODEL_SERVER_SOCKET)
+else:
+    ai_models = AIModels()
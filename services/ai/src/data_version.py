@@ -0,0 +1,29 @@
+# data_version.py
+# (Đánh dấu phiên bản dữ liệu kho tranh / kiến thức để các cache biết khi nào cần làm mới)
+import os
+import time
+from .config import settings
+from .logger import get_logger
+
+logger = get_logger("data_version")
+
+
+def data_version_file() -> str:
+    return settings.DATA_VERSION_FILE or os.path.join(settings.VECTOR_STORE_DIR, "data_version")
+
+
+def bump_data_version(source: str):
+    """Gọi sau khi index tranh hoặc nạp kiến thức xong."""
+    path = data_version_file()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"{source} {time.time()}\n")
+    logger.info(f"🔖 Đã cập nhật phiên bản dữ liệu ({source})")
+
+
+def current_data_version() -> float:
+    """Phiên bản hiện tại = mtime của file đánh dấu (0 nếu chưa có)."""
+    try:
+        return os.stat(data_version_file()).st_mtime
+    except OSError:
+        return 0.0
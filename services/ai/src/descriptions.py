@@ -0,0 +1,254 @@
+# descriptions.py
+# (Mô tả hình ảnh của từng tranh, sinh 1 lần bằng vision LLM rồi dùng lại cho mọi khách / mọi tin nhắn)
+#
+# Khóa = imageUrl: đổi ảnh sản phẩm -> URL mới -> tự sinh lại mô tả mới.
+# Sinh offline cho cả kho, hoặc tự sinh nền ở lần đầu có khách hỏi về 1 tranh (DESCRIPTIONS_LAZY):
+#   python -m src.descriptions build [--force]
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import ollama
+import requests
+from qdrant_client.http import models
+from .config import settings
+from .data_version import current_data_version
+from .images import prepare_image
+from .llm import llm_gateway, PRIORITY_BATCH
+from .logger import get_logger
+from .qdrant import client
+from .vector_store import vector_store
+
+logger = get_logger("descriptions")
+
+DESCRIBE_PROMPT = """Mô tả bức tranh trong ảnh bằng tiếng Việt, ngắn gọn (tối đa 120 từ), chỉ nêu những gì NHÌN THẤY:
+- Chủ đề, đối tượng chính và bố cục
+- Màu sắc chủ đạo
+- Phong cách, chất liệu (nếu nhận ra) và cảm xúc
+- Ngũ hành nổi bật (Kim/Mộc/Thủy/Hỏa/Thổ) theo màu sắc và chủ đề
+Không chào hỏi, không tư vấn, không nhắc tới giá."""
+
+
+def _key(image_url: str) -> str:
+    return hashlib.sha1(image_url.encode("utf-8")).hexdigest()
+
+
+class DescriptionStore:
+    """
+    File JSON {sha1(imageUrl): {"imageUrl", "description", "model", "created_at"}}.
+    Đọc từ bộ nhớ, tự nạp lại khi file đổi (build offline chạy ở process khác).
+    Ghi: khóa file (nhiều worker / build cùng ghi) -> đọc lại bản trên đĩa -> sửa -> ghi đè nguyên tử,
+    để không worker nào xóa mất mô tả worker khác vừa lưu.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    with open(self.path, encoding="utf-8") as f:
+                        self._entries = json.load(f)
+                    self._mtime = mtime
+
+    def get(self, image_url: str):
+        if not image_url:
+            return None
+        self._reload()
+        entry = self._entries.get(_key(image_url))
+        # So lại URL đầy đủ (phòng trùng hash) trước khi dùng
+        return entry["description"] if entry and entry.get("imageUrl") == image_url else None
+
+    def put(self, image_url: str, description: str, model: str):
+        entry = {
+            "imageUrl": image_url,
+            "description": description,
+            "model": model,
+            "created_at": time.time(),
+        }
+
+        def add(entries):
+            entries[_key(image_url)] = entry
+            return True
+
+        self._update(add)
+
+    def prune(self, image_urls):
+        """Bỏ mô tả của ảnh không còn trong kho (sản phẩm đã xóa / đổi ảnh)."""
+        keep = {_key(url) for url in image_urls if url}
+        removed = []
+
+        def drop(entries):
+            removed.extend(k for k in entries if k not in keep)
+            for k in removed:
+                del entries[k]
+            return bool(removed)
+
+        self._update(drop)
+        return len(removed)
+
+    def _update(self, change):
+        """change(entries) sửa dict tại chỗ, trả về True nếu cần ghi."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    entries = json.load(f)
+            except FileNotFoundError:
+                entries = {}
+            if change(entries):
+                tmp = self.path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+            self._entries = entries
+            self._mtime = os.stat(self.path).st_mtime if os.path.exists(self.path) else None
+
+
+description_store = DescriptionStore(settings.DESCRIPTIONS_FILE)
+
+
+def describe_image(image_bytes: bytes, priority=PRIORITY_BATCH, cancel=None):
+    """1 lượt vision LLM (không stream, qua hàng đợi llm_gateway). Trả về None nếu quá tải / lỗi."""
+    with llm_gateway.slot(priority, cancel=cancel) as admitted:
+        if not admitted:
+            return None
+        try:
+            response = ollama.chat(
+                model=settings.LLM_MODEL_ID,
+                messages=[{"role": "user", "content": DESCRIBE_PROMPT, "images": [image_bytes]}],
+                stream=False,
+                keep_alive=settings.LLM_KEEP_ALIVE,
+                options={"temperature": 0.2, "num_predict": settings.DESCRIPTION_MAX_TOKENS},
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Lỗi sinh mô tả ảnh: {e}")
+            return None
+    description = (response.message.content or "").strip()
+    return description or None
+
+
+def _attach_to_payload(image_url: str, description: str):
+    """Ghi kèm mô tả vào payload các tranh dùng ảnh này (đọc được ngay từ kết quả tìm kiếm)."""
+    try:
+        client.set_payload(
+            collection_name=settings.PAINTINGS_COLLECTION,
+            payload={"visual_description": description},
+            points=models.Filter(must=[models.FieldCondition(key="imageUrl", match=models.MatchValue(value=image_url))]),
+            wait=False,
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Không ghi được mô tả vào Qdrant: {e}")
+
+
+class DescriptionService:
+    """
+    Tra mô tả đã có; nếu chưa có thì sinh nền (mỗi ảnh chỉ 1 lần dù nhiều request cùng lúc).
+    Chỉ sinh cho ảnh của tranh đã index: imageUrl do client gửi lên, không để URL tùy ý
+    tốn lượt vision LLM và làm file mô tả phình mãi.
+    """
+
+    def __init__(self, store: DescriptionStore):
+        self.store = store
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._indexed = (None, frozenset())   # (phiên bản dữ liệu, imageUrl các tranh trong kho)
+
+    def _indexed_urls(self):
+        """imageUrl của mọi tranh trong kho (vector_store), nạp lại khi phiên bản dữ liệu đổi (sau index)."""
+        version = current_data_version()
+        if self._indexed[0] != version:
+            payloads = vector_store.read_payloads(settings.PAINTINGS_COLLECTION, ["imageUrl"])
+            self._indexed = (version, frozenset(p["imageUrl"] for p in payloads if p.get("imageUrl")))
+        return self._indexed[1]
+
+    def lookup(self, image_url: str):
+        return self.store.get(image_url)
+
+    def claim(self, image_url: str) -> bool:
+        """True nếu request này được giao sinh mô tả cho ảnh (chưa có và chưa ai đang sinh)."""
+        if not settings.DESCRIPTIONS_LAZY or not image_url:
+            return False
+        with self._lock:
+            if image_url in self._pending or self.store.get(image_url):
+                return False
+            self._pending.add(image_url)
+            return True
+
+    def generate(self, image_url: str, image_bytes: bytes):
+        """Blocking: gọi trong threadpool / tác vụ nền sau khi đã claim()."""
+        try:
+            try:
+                indexed = image_url in self._indexed_urls()
+            except Exception as e:
+                logger.warning(f"⚠️ Không kiểm tra được ảnh có trong kho: {e}")
+                return None
+            if not indexed:
+                logger.info(f"⏭️ Bỏ qua sinh mô tả: ảnh không thuộc tranh nào đã index ({image_url[:50]}...)")
+                return None
+            description = describe_image(image_bytes)
+            if description:
+                self.store.put(image_url, description, settings.LLM_MODEL_ID)
+                _attach_to_payload(image_url, description)
+                logger.info(f"📝 Đã lưu mô tả ảnh cho {image_url[:50]}... ({len(description)} ký tự)")
+            return description
+        finally:
+            with self._lock:
+                self._pending.discard(image_url)
+
+
+description_service = DescriptionService(description_store)
+
+
+def build_descriptions(force: bool = False):
+    """Sinh mô tả cho mọi tranh trong collection còn thiếu (hoặc tất cả nếu force)."""
+    payloads = vector_store.read_payloads(settings.PAINTINGS_COLLECTION, ["imageUrl", "name"])
+
+    image_urls = sorted({p.get("imageUrl") for p in payloads if p.get("imageUrl")})
+    removed = description_store.prune(image_urls)
+    todo = [url for url in image_urls if force or not description_store.get(url)]
+    logger.info(f"📝 {len(image_urls)} ảnh, cần sinh mô tả {len(todo)}, bỏ {removed} mô tả cũ")
+
+    done = 0
+    for i, url in enumerate(todo, 1):
+        try:
+            resp = requests.get(url, timeout=10)
+            resp.raise_for_status()
+            prepared = prepare_image(resp.content)
+        except Exception as e:
+            logger.warning(f"   ⚠️ Bỏ qua {url[:60]}: {e}")
+            continue
+        if prepared is None:
+            continue
+        description = describe_image(prepared.llm_bytes)
+        if description:
+            description_store.put(url, description, settings.LLM_MODEL_ID)
+            _attach_to_payload(url, description)
+            done += 1
+        logger.info(f"   [{i}/{len(todo)}] {url[:60]}")
+    logger.info(f"✅ Đã sinh {done}/{len(todo)} mô tả")
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sinh mô tả hình ảnh cho kho tranh (dùng thay ảnh khi chat)")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--force", action="store_true", help="Sinh lại cả mô tả đã có")
+    args = parser.parse_args()
+    build_descriptions(force=args.force)
+
+
+if __name__ == "__main__":
+    main()
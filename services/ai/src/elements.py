@@ -0,0 +1,225 @@
+# elements.py
+# (Chấm điểm ngũ hành / màu sắc / chủ đề cho mỗi tranh bằng SigLIP zero-shot, tính 1 lần lúc index)
+#
+# Chỉ cần vector ảnh đã có trong Qdrant + vector các câu mô tả (text tower của SigLIP, tính 1 lần)
+# -> mỗi tranh chỉ tốn 1 phép nhân ma trận nhỏ, không phải chạy lại model ảnh hay LLM.
+#
+#   python -m src.elements backfill      # chấm điểm lại toàn bộ collection tranh đang có
+import argparse
+import threading
+import numpy as np
+from qdrant_client.http import models
+from .config import settings
+from .core import ai_models
+from .data_version import bump_data_version
+from .logger import get_logger
+from .neighbors import build_neighbor_graph
+from .qdrant import client
+from .vector_store import vector_store
+
+logger = get_logger("elements")
+
+# Tăng khi đổi câu mô tả / cách tính -> backfill biết tranh nào cần chấm lại
+ELEMENTS_VERSION = 1
+
+# SigLIP huấn luyện trên chú thích tiếng Anh -> câu mô tả tiếng Anh, nhãn tiếng Việt.
+# Mỗi nhãn nhiều câu (prompt ensemble), lấy trung bình vector. Bám theo bảng ngũ hành trong llm.py.
+ELEMENT_PROMPTS = {
+    "Kim": [
+        "a painting in white, grey and silver tones",
+        "a painting with shiny gold leaf and metallic details",
+        "a painting of a full moon",
+        "a painting of a white tiger",
+        "a painting of white cranes or swans",
+    ],
+    "Mộc": [
+        "a painting in green tones",
+        "a painting of a green forest and trees",
+        "a painting of bamboo",
+        "a painting of flowers, branches and leaves",
+    ],
+    "Thủy": [
+        "a painting in black, dark blue and purple tones",
+        "a painting of a river, lake or the sea",
+        "a painting of a waterfall",
+        "a painting of koi fish swimming",
+        "a painting of a sailing boat on the water",
+    ],
+    "Hỏa": [
+        "a painting in red, orange and pink tones",
+        "a painting of a bright sunrise or sunset",
+        "a painting of galloping horses",
+        "a painting of a phoenix",
+        "a painting of fire and glowing light",
+    ],
+    "Thổ": [
+        "a painting in yellow, brown and beige earth tones",
+        "a painting of mountains and rocks",
+        "a painting of rice terraces and countryside fields",
+        "a painting of a desert landscape",
+        "a painting of ceramic pottery",
+    ],
+}
+
+# Khóa trùng cách đặt tag của crawler (mau_*, chu_de_*) để dùng chung bộ lọc
+COLOR_PROMPTS = {
+    "trang": ["a painting in white tones"],
+    "den": ["a painting in black tones"],
+    "xam": ["a painting in grey tones"],
+    "nau": ["a painting in brown tones"],
+    "vang": ["a painting in yellow and golden tones"],
+    "cam": ["a painting in orange tones"],
+    "do": ["a painting in red tones"],
+    "hong": ["a painting in pink tones"],
+    "tim": ["a painting in purple tones"],
+    "xanh_duong": ["a painting in blue tones"],
+    "xanh_la": ["a painting in green tones"],
+}
+
+THEME_PROMPTS = {
+    "phong_canh": ["a landscape painting", "a painting of scenery with mountains and rivers"],
+    "truu_tuong": ["an abstract painting with shapes and color fields"],
+    "dong_vat": ["a painting of animals"],
+    "hoa_la": ["a painting of flowers", "a still life painting of flowers"],
+    "thon_da": ["a painting of a Vietnamese village and countryside"],
+    "phat_giao": ["a painting of Buddha", "a Buddhist painting"],
+    "ca_chep": ["a painting of koi carp fish"],
+    "ma_dao": ["a painting of running horses"],
+    "thuyen_buom": ["a painting of a sailing boat"],
+    "thac_nuoc": ["a painting of a waterfall"],
+    "nui_non": ["a painting of mountains"],
+    "bien": ["a painting of the sea and beach"],
+    "hoa_sen": ["a painting of lotus flowers"],
+    "chim": ["a painting of birds"],
+}
+
+# Ngưỡng để sinh visual_tags (xác suất sigmoid của SigLIP cho màu / chủ đề, tỉ lệ softmax cho ngũ hành)
+ELEMENT_TAG_MIN = 0.3
+COLOR_TAG_MIN = 0.1
+THEME_TAG_MIN = 0.1
+
+ELEMENT_TAG_SLUGS = {"Kim": "kim", "Mộc": "moc", "Thủy": "thuy", "Hỏa": "hoa", "Thổ": "tho"}
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-np.clip(x, -50, 50)))
+
+
+class ElementScorer:
+    """Giữ ma trận vector câu mô tả (tính lười, 1 lần) và chấm điểm theo lô vector ảnh."""
+
+    def __init__(self):
+        self._groups = None
+        self._lock = threading.Lock()
+
+    def _label_matrix(self, prompts: dict):
+        labels = list(prompts)
+        texts = [t for label in labels for t in prompts[label]]
+        vectors = ai_models.get_vision_text_embedding(texts)
+        if vectors is None:
+            raise RuntimeError("Không tính được vector câu mô tả (SigLIP text)")
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        # Trung bình các câu của từng nhãn rồi chuẩn hóa lại
+        matrix, start = [], 0
+        for label in labels:
+            count = len(prompts[label])
+            mean = vectors[start:start + count].mean(axis=0)
+            matrix.append(mean / np.linalg.norm(mean))
+            start += count
+        return labels, np.stack(matrix)
+
+    def _load(self):
+        if self._groups is None:
+            with self._lock:
+                if self._groups is None:
+                    self._groups = {
+                        "element": self._label_matrix(ELEMENT_PROMPTS),
+                        "color": self._label_matrix(COLOR_PROMPTS),
+                        "theme": self._label_matrix(THEME_PROMPTS),
+                    }
+                    logger.info(f"🧭 Đã tính vector mô tả ngũ hành / màu / chủ đề ({settings.VISION_MODEL_ID})")
+        return self._groups
+
+    def score(self, image_vectors):
+        """
+        image_vectors: (N, dim) vector SigLIP của ảnh (đã chuẩn hóa, như trong Qdrant)
+        Output: List[dict] payload bổ sung cho từng tranh
+        """
+        groups = self._load()
+        images = np.atleast_2d(np.asarray(image_vectors, dtype=np.float32))
+        images = images / np.maximum(np.linalg.norm(images, axis=1, keepdims=True), 1e-12)
+        scale, bias = ai_models.vision_logit_params()
+
+        logits = {name: images @ matrix.T * scale for name, (_, matrix) in groups.items()}
+        # Ngũ hành: 5 lựa chọn loại trừ nhau -> softmax; màu / chủ đề: độc lập -> sigmoid như SigLIP
+        element = np.exp(logits["element"] - logits["element"].max(axis=1, keepdims=True))
+        element /= element.sum(axis=1, keepdims=True)
+        color = _sigmoid(logits["color"] + bias)
+        theme = _sigmoid(logits["theme"] + bias)
+
+        element_labels, color_labels, theme_labels = (groups[name][0] for name in ("element", "color", "theme"))
+        results = []
+        for e_row, c_row, t_row in zip(element, color, theme):
+            element_scores = {label: round(float(v), 4) for label, v in zip(element_labels, e_row)}
+            color_scores = {label: round(float(v), 4) for label, v in zip(color_labels, c_row)}
+            theme_scores = {label: round(float(v), 4) for label, v in zip(theme_labels, t_row)}
+            visual_tags = (
+                [f"menh_{ELEMENT_TAG_SLUGS[k]}" for k, v in element_scores.items() if v >= ELEMENT_TAG_MIN]
+                + [f"mau_{k}" for k, v in color_scores.items() if v >= COLOR_TAG_MIN]
+                + [f"chu_de_{k}" for k, v in theme_scores.items() if v >= THEME_TAG_MIN]
+            )
+            results.append({
+                "element_scores": element_scores,
+                "element_primary": max(element_scores, key=element_scores.get),
+                "color_scores": color_scores,
+                "theme_scores": theme_scores,
+                "visual_tags": visual_tags,
+                "elements_version": ELEMENTS_VERSION,
+            })
+        return results
+
+
+element_scorer = ElementScorer()
+
+
+def backfill(batch_size: int = 256, force: bool = False):
+    """Chấm điểm các tranh đã index (đọc vector có sẵn, chỉ ghi thêm payload)."""
+    updated, offset = 0, None
+    while True:
+        points, offset = client.scroll(
+            collection_name=settings.PAINTINGS_COLLECTION, limit=batch_size, offset=offset,
+            with_payload=["elements_version"], with_vectors=True,
+        )
+        todo = [p for p in points if force or (p.payload or {}).get("elements_version") != ELEMENTS_VERSION]
+        if todo:
+            scores = element_scorer.score([p.vector for p in todo])
+            client.batch_update_points(
+                collection_name=settings.PAINTINGS_COLLECTION,
+                update_operations=[
+                    models.SetPayloadOperation(set_payload=models.SetPayload(payload=payload, points=[p.id]))
+                    for p, payload in zip(todo, scores)
+                ],
+            )
+            updated += len(todo)
+        if offset is None:
+            break
+    logger.info(f"✅ Đã chấm điểm ngũ hành cho {updated} tranh")
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Điểm ngũ hành / màu / chủ đề (SigLIP zero-shot) cho tranh")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--force", action="store_true", help="Chấm lại cả tranh đã có điểm ở phiên bản hiện tại")
+    args = parser.parse_args()
+
+    if backfill(force=args.force):
+        # Payload đổi -> cập nhật snapshot / đồ thị tương tự / cache như sau khi index
+        vector_store.sync(settings.PAINTINGS_COLLECTION)
+        build_neighbor_graph()
+        bump_data_version("paintings")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+# eval_retrieval.py
+# (Đánh giá chất lượng vs độ trễ của RAG kiến thức: quét chunk size, embedding model,
+#  số candidate và rerank tắt / bật / thích ứng; in recall@k, MRR, latency và Pareto frontier)
+#
+# Bộ câu hỏi có nhãn (JSONL), mỗi dòng:
+#   {"question": "Mệnh Kim hợp màu gì?", "relevant": ["Mệnh Kim hợp với màu trắng, xám...", ...]}
+# "relevant" là đoạn văn bản gốc (không phải id chunk) để nhãn dùng được cho mọi chunk size.
+#
+# Chạy từ thư mục services/ai:
+#   python -m src.eval_retrieval --dataset knowledge/eval.jsonl
+#   python -m src.eval_retrieval --dataset eval.jsonl --chunk-sizes 300,500,800 --candidates 5,10,20 \
+#       --embedders bkai-foundation-models/vietnamese-bi-encoder,keepitreal/vietnamese-sbert --json eval.json
+#
+# Tìm tranh bằng câu tiếng Việt (SigLIP chỉ hiểu tiếng Anh, xem query_translation.py): so top-k của
+# câu tiếng Việt (nguyên câu / đã dịch) với top-k của câu tiếng Anh tương ứng trên kho tranh đã index:
+#   python -m src.eval_retrieval --paintings                 # bộ câu mẫu PAINTING_QUERY_PAIRS
+#   python -m src.eval_retrieval --paintings pairs.jsonl     # {"vi": "...", "en": "..."} mỗi dòng
+import argparse
+import json
+import re
+import statistics
+import time
+from contextlib import nullcontext
+from pathlib import Path
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from .config import settings
+from .core import ai_models
+from .ingest_pdf import chunk_text, extract_text_from_pdf
+from .query_translation import to_vision_query
+from .rag_service import plan_rerank
+from .vector_store import vector_store
+
+# Câu tìm tranh tiếng Việt + câu tiếng Anh cùng nghĩa (mốc so sánh)
+PAINTING_QUERY_PAIRS = [
+    ("tranh núi non tông vàng cho phòng khách", "a painting of mountains in yellow tones"),
+    ("tranh cá chép đỏ", "a painting of red koi carp"),
+    ("tranh hoa sen trắng", "a painting of white lotus flowers"),
+    ("tranh thuyền buồm trên biển lúc hoàng hôn", "a painting of a sailing boat on the sea at sunset"),
+    ("tranh ngựa phi nước đại", "a painting of galloping horses"),
+    ("tranh trừu tượng xanh dương", "an abstract painting in blue tones"),
+    ("tranh ruộng bậc thang vùng cao", "a painting of rice terraces in the highlands"),
+    ("tranh thác nước trong rừng", "a painting of a waterfall in a forest"),
+    ("tranh phật bình yên", "a peaceful painting of Buddha"),
+    ("tranh làng quê với con trâu", "a painting of a Vietnamese village with a water buffalo"),
+    ("tranh hoa mẫu đơn hồng", "a painting of pink peonies"),
+    ("tranh chim công sang trọng", "a luxurious painting of a peacock"),
+    ("tranh sơn mài phố cổ", "a lacquer painting of an old town street"),
+    ("tranh rừng trúc xanh lá", "a painting of a green bamboo forest"),
+]
+
+
+def load_dataset(path: str):
+    with open(path, encoding="utf-8") as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    return [item for item in items if item.get("question") and item.get("relevant")]
+
+
+def load_corpus(paths):
+    """Văn bản gốc của kho kiến thức (.pdf qua extract_text_from_pdf, còn lại đọc như text)."""
+    texts = []
+    for path in paths:
+        for file in sorted(Path(path).glob("*")) if Path(path).is_dir() else [Path(path)]:
+            if file.suffix.lower() == ".pdf":
+                texts.append(extract_text_from_pdf(str(file)))
+            elif file.suffix.lower() in (".txt", ".md"):
+                texts.append(file.read_text(encoding="utf-8"))
+    return [t for t in texts if t]
+
+
+def _shingles(text: str, n: int = 3):
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + n]) for i in range(max(len(words) - n + 1, 1))}
+
+
+class RelevanceJudge:
+    """
+    Chunk được coi là liên quan tới 1 đoạn nhãn nếu phần trùng (word trigram) chiếm
+    >= threshold của đoạn ngắn hơn -> đúng cả khi chunk nằm trong đoạn nhãn và ngược lại.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._cache = {}
+
+    def _get(self, text):
+        if text not in self._cache:
+            self._cache[text] = _shingles(text)
+        return self._cache[text]
+
+    def matches(self, chunk: str, snippet: str) -> bool:
+        a, b = self._get(chunk), self._get(snippet)
+        if not a or not b:
+            return False
+        return len(a & b) / min(len(a), len(b)) >= self.threshold
+
+
+def evaluate_ranking(ranked_chunks, relevant, judge):
+    """(recall@k, reciprocal rank) của 1 câu hỏi; ranked_chunks là top k cuối cùng."""
+    found = {s for s in relevant if any(judge.matches(c, s) for c in ranked_chunks)}
+    rr = 0.0
+    for rank, chunk in enumerate(ranked_chunks, 1):
+        if any(judge.matches(chunk, s) for s in relevant):
+            rr = 1.0 / rank
+            break
+    return len(found) / len(relevant), rr
+
+
+def pareto_frontier(results):
+    """Cấu hình không bị cấu hình nào khác tốt hơn-hoặc-bằng ở cả latency, recall và MRR."""
+    def dominates(a, b):
+        no_worse = a["latency_ms"] <= b["latency_ms"] and a["recall"] >= b["recall"] and a["mrr"] >= b["mrr"]
+        better = a["latency_ms"] < b["latency_ms"] or a["recall"] > b["recall"] or a["mrr"] > b["mrr"]
+        return no_worse and better
+    return [r for r in results if not any(dominates(other, r) for other in results if other is not r)]
+
+
+def sweep_embedder(model, embedder_id, dataset, corpus, args, judge):
+    """Các cấu hình (chunk size x candidates x rerank) với 1 embedding model."""
+    questions = [item["question"] for item in dataset]
+    results = []
+
+    # Embed câu hỏi từng câu một (giống lúc phục vụ request) để đo latency thật
+    query_vectors, embed_ms = [], []
+    for question in questions:
+        start = time.perf_counter()
+        query_vectors.append(model.encode(question, normalize_embeddings=True))
+        embed_ms.append((time.perf_counter() - start) * 1000)
+
+    for chunk_size in args.chunk_sizes:
+        overlap = int(chunk_size * args.overlap_ratio)
+        chunks = [c for text in corpus for c in chunk_text(text, chunk_size, overlap)]
+        matrix = model.encode(chunks, batch_size=32, normalize_embeddings=True)
+        print(f"📚 {embedder_id} | chunk {chunk_size}/{overlap}: {len(chunks)} chunks")
+
+        for candidates in args.candidates:
+            for rerank in args.rerank_modes:
+                recalls, rrs, latencies, rerank_ms = [], [], [], []
+                for item, qvec, q_embed_ms in zip(dataset, query_vectors, embed_ms):
+                    start = time.perf_counter()
+                    scores = matrix @ qvec
+                    top = np.argsort(-scores)[:candidates]
+                    search_ms = (time.perf_counter() - start) * 1000
+
+                    docs = [chunks[i] for i in top]
+                    start = time.perf_counter()
+                    num_rerank = len(docs) if rerank == "on" else 0
+                    if rerank == "adaptive":
+                        num_rerank = plan_rerank([float(scores[i]) for i in top], args.k)
+                    if num_rerank:
+                        ranked = ai_models.rerank_docs(item["question"], docs[:num_rerank], top_k=args.k)
+                    else:
+                        ranked = docs[:args.k]
+                    rerank_ms.append((time.perf_counter() - start) * 1000)
+
+                    recall, rr = evaluate_ranking(ranked, item["relevant"], judge)
+                    recalls.append(recall)
+                    rrs.append(rr)
+                    latencies.append(q_embed_ms + search_ms + rerank_ms[-1])
+
+                results.append({
+                    "embedder": embedder_id,
+                    "chunk_size": chunk_size,
+                    "overlap": overlap,
+                    "num_chunks": len(chunks),
+                    "candidates": candidates,
+                    "rerank": rerank,
+                    "recall": round(statistics.fmean(recalls), 4),
+                    "mrr": round(statistics.fmean(rrs), 4),
+                    "latency_ms": round(statistics.fmean(latencies), 2),
+                    "latency_p95_ms": round(float(np.percentile(latencies, 95)), 2),
+                    "rerank_ms": round(statistics.fmean(rerank_ms), 2),
+                })
+    return results
+
+
+def run_sweep(dataset, corpus, args):
+    judge = RelevanceJudge(args.match_threshold)
+    results = []
+
+    for embedder_id in args.embedders:
+        # Model đang phục vụ: giữ trong use() suốt lượt quét để không bị offload giữa chừng.
+        # Chế độ model server (MODEL_SERVER_SOCKET) không có model trong process -> nạp riêng
+        use_local = getattr(ai_models, "use_text_model", None)
+        if embedder_id == settings.TEXT_MODEL_ID and use_local is not None:
+            model_context = use_local()
+        else:
+            model_context = nullcontext(SentenceTransformer(embedder_id, device=settings.DEVICE))
+        with model_context as model:
+            results += sweep_embedder(model, embedder_id, dataset, corpus, args, judge)
+    return results
+
+
+def load_painting_pairs(path):
+    if path == "builtin":
+        return [{"vi": vi, "en": en} for vi, en in PAINTING_QUERY_PAIRS]
+    with open(path, encoding="utf-8") as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    return [item for item in items if item.get("vi") and item.get("en")]
+
+
+def evaluate_painting_queries(pairs, k, use_llm):
+    """
+    overlap@k của top-k tranh tìm bằng câu tiếng Việt với top-k của câu tiếng Anh cùng nghĩa.
+    "raw" = đưa nguyên câu tiếng Việt vào SigLIP (cách cũ), "translated" = qua to_vision_query.
+    """
+    translated = [to_vision_query(p["vi"], use_llm=use_llm) for p in pairs]
+    groups = {
+        "raw": [p["vi"] for p in pairs],
+        "translated": translated,
+        "en": [p["en"] for p in pairs],
+    }
+    vectors = {name: ai_models.get_vision_text_embedding(texts) for name, texts in groups.items()}
+    if any(v is None for v in vectors.values()):
+        raise RuntimeError("Không tính được vector SigLIP text")
+    hits = {name: vector_store.search_batch(settings.PAINTINGS_COLLECTION, v, k) for name, v in vectors.items()}
+
+    rows = []
+    for i, pair in enumerate(pairs):
+        reference = {h.id for h in hits["en"][i]}
+        row = {"vi": pair["vi"], "en": pair["en"], "translated": translated[i]}
+        for name in ("raw", "translated"):
+            row[f"{name}_overlap"] = len({h.id for h in hits[name][i]} & reference) / max(len(reference), 1)
+            a, b = np.asarray(vectors[name][i]), np.asarray(vectors["en"][i])
+            row[f"{name}_cosine"] = float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+        rows.append(row)
+    return rows
+
+
+def print_painting_results(rows, k):
+    print(f"\n{'Câu tiếng Việt':<44} {f'raw@{k}':>7} {f'dịch@{k}':>7} {'cos raw':>8} {'cos dịch':>8}  Câu đã dịch")
+    for r in rows:
+        print(f"{r['vi'][:44]:<44} {r['raw_overlap']:>7.2f} {r['translated_overlap']:>7.2f} "
+              f"{r['raw_cosine']:>8.3f} {r['translated_cosine']:>8.3f}  {r['translated']}")
+    mean = lambda key: statistics.fmean(r[key] for r in rows)
+    print(f"{'Trung bình':<44} {mean('raw_overlap'):>7.2f} {mean('translated_overlap'):>7.2f} "
+          f"{mean('raw_cosine'):>8.3f} {mean('translated_cosine'):>8.3f}")
+    print(f"overlap@{k} = tỉ lệ tranh trùng với top-{k} của câu tiếng Anh; cos = cosine vector câu với vector câu tiếng Anh")
+
+
+def print_results(results, frontier, k):
+    frontier_ids = {id(r) for r in frontier}
+    print(f"\n{'':1} {'Embedder':<42} {'Chunk':>6} {'Cand':>5} {'Rerank':>8} {f'R@{k}':>6} {'MRR':>6} {'ms':>8} {'p95':>8}")
+    for r in sorted(results, key=lambda r: r["latency_ms"]):
+        mark = "★" if id(r) in frontier_ids else " "
+        print(f"{mark} {r['embedder'][-42:]:<42} {r['chunk_size']:>6} {r['candidates']:>5} {r['rerank']:>8} "
+              f"{r['recall']:>6.3f} {r['mrr']:>6.3f} {r['latency_ms']:>8.1f} {r['latency_p95_ms']:>8.1f}")
+    print("★ = Pareto frontier (không cấu hình nào vừa nhanh hơn vừa chính xác hơn)")
+
+
+def main():
+    split = lambda cast: (lambda value: [cast(v) for v in value.split(",") if v.strip()])
+    parser = argparse.ArgumentParser(description="Đánh giá chất lượng / độ trễ của RAG kiến thức")
+    parser.add_argument("--dataset", help="JSONL: {question, relevant: [đoạn văn bản]}")
+    parser.add_argument("--paintings", nargs="?", const="builtin",
+                        help="Kiểm tra tìm tranh bằng câu tiếng Việt (JSONL {vi, en}, bỏ trống = bộ câu mẫu)")
+    parser.add_argument("--painting-k", type=int, default=10)
+    parser.add_argument("--no-llm-translate", action="store_true", help="--paintings: chỉ dịch bằng từ điển")
+    parser.add_argument("--corpus", type=split(str), default=["./knowledge"], help="File / thư mục .pdf, .txt")
+    parser.add_argument("--chunk-sizes", type=split(int), default=[settings.KNOWLEDGE_CHUNK_SIZE])
+    parser.add_argument("--overlap-ratio", type=float, default=settings.KNOWLEDGE_CHUNK_OVERLAP / settings.KNOWLEDGE_CHUNK_SIZE)
+    parser.add_argument("--candidates", type=split(int), default=[5, 10, 20])
+    parser.add_argument("--embedders", type=split(str), default=[settings.TEXT_MODEL_ID])
+    parser.add_argument("--rerank", choices=("all", "on", "off", "adaptive"), default="all")
+    parser.add_argument("--k", type=int, default=settings.KNOWLEDGE_TOP_K, help="Số đoạn đưa vào prompt")
+    parser.add_argument("--match-threshold", type=float, default=0.5)
+    parser.add_argument("--json", help="Ghi toàn bộ kết quả + frontier ra file")
+    args = parser.parse_args()
+    args.rerank_modes = ["off", "on", "adaptive"] if args.rerank == "all" else [args.rerank]
+
+    if args.paintings:
+        pairs = load_painting_pairs(args.paintings)
+        print(f"🖼️ {len(pairs)} câu tìm tranh tiếng Việt / tiếng Anh")
+        painting_rows = evaluate_painting_queries(pairs, args.painting_k, use_llm=not args.no_llm_translate)
+        print_painting_results(painting_rows, args.painting_k)
+        if args.json and not args.dataset:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"paintings": painting_rows}, f, ensure_ascii=False, indent=2)
+            print(f"💾 Đã lưu kết quả vào {args.json}")
+    if not args.dataset:
+        if not args.paintings:
+            parser.error("cần --dataset hoặc --paintings")
+        return
+
+    dataset = load_dataset(args.dataset)
+    corpus = load_corpus(args.corpus)
+    if not dataset or not corpus:
+        print("❌ Thiếu bộ câu hỏi hoặc kho kiến thức")
+        return
+    print(f"🧪 {len(dataset)} câu hỏi, {len(corpus)} tài liệu")
+
+    results = run_sweep(dataset, corpus, args)
+    frontier = pareto_frontier(results)
+    print_results(results, frontier, args.k)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "pareto": frontier}, f, ensure_ascii=False, indent=2)
+        print(f"💾 Đã lưu kết quả vào {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# fengshui.py
+# (Chấm độ hợp mệnh của tranh theo hồ sơ Bát Tự: tất định, vector hóa, vài ms cho cả kho)
+#
+# Mỗi tranh -> vector ngũ hành 5 chiều (Kim, Mộc, Thủy, Hỏa, Thổ) từ:
+#   - element_scores: điểm SigLIP zero-shot tính lúc index (elements.py)
+#   - tags: menh_*, mau_*, chu_de_* theo bảng ngũ hành - màu sắc - chủ đề (giống bảng trong prompt llm.py)
+# Hồ sơ -> vector trọng số (Dụng Thần +, Hỷ Thần +, Kỵ Thần -, Hung Thần -).
+# Điểm hợp mệnh = ma trận tranh @ vector trọng số -> LLM chỉ cần giải thích kết quả đã có.
+import threading
+import time
+import unicodedata
+import numpy as np
+from .config import settings
+from .data_version import current_data_version
+from .logger import get_logger
+from .metrics import stage
+from .vector_store import vector_store
+
+logger = get_logger("fengshui")
+
+ELEMENTS = ("Kim", "Mộc", "Thủy", "Hỏa", "Thổ")
+_ELEMENT_SLUGS = {"kim": 0, "moc": 1, "thuy": 2, "hoa": 3, "tho": 4}
+
+# Bảng ngũ hành - màu sắc - chủ đề (tag đã bỏ dấu, xem _slug)
+TAG_ELEMENTS = {
+    # Màu sắc (crawler: mau_<từ khóa>, elements.py: mau_<slug>)
+    "mau_trang": {"Kim": 1.0}, "mau_xam": {"Kim": 1.0}, "mau_bac": {"Kim": 1.0},
+    "mau_silver": {"Kim": 1.0}, "mau_gold": {"Kim": 1.0},
+    "mau_xanh_la": {"Mộc": 1.0}, "mau_xanh_luc": {"Mộc": 1.0},
+    "mau_den": {"Thủy": 1.0}, "mau_xanh_duong": {"Thủy": 1.0}, "mau_tim": {"Thủy": 1.0},
+    "mau_do": {"Hỏa": 1.0}, "mau_cam": {"Hỏa": 1.0}, "mau_hong": {"Hỏa": 1.0},
+    "mau_vang": {"Thổ": 1.0}, "mau_nau": {"Thổ": 1.0}, "mau_be": {"Thổ": 1.0},
+    # Chủ đề
+    "chu_de_thien_nhien": {"Mộc": 1.0}, "chu_de_hoa_la": {"Mộc": 1.0},
+    "chu_de_phong_canh": {"Mộc": 0.5, "Thổ": 0.5}, "chu_de_thon_da": {"Thổ": 1.0},
+    "chu_de_nui_non": {"Thổ": 1.0}, "chu_de_ca_chep": {"Thủy": 1.0}, "chu_de_thac_nuoc": {"Thủy": 1.0},
+    "chu_de_bien": {"Thủy": 1.0}, "chu_de_thuyen_buom": {"Thủy": 1.0}, "chu_de_ma_dao": {"Hỏa": 1.0},
+    "chu_de_hoa_sen": {"Thủy": 0.5, "Mộc": 0.5},
+}
+for _slug_name, _index in _ELEMENT_SLUGS.items():
+    TAG_ELEMENTS[f"menh_{_slug_name}"] = {ELEMENTS[_index]: 1.0}
+
+# Ngũ hành đóng góp dưới mức này không được nêu làm lý do
+REASON_MIN_CONTRIBUTION = 0.05
+
+VERDICT_LABELS = {"match": "✅ PHÙ HỢP", "neutral": "➖ TRUNG TÍNH", "avoid": "⚠️ NÊN TRÁNH"}
+
+# Trường trả về trong danh sách xếp hạng (bỏ các trường nặng như color_scores, visual_description)
+RESULT_FIELDS = ("original_id", "name", "price", "imageUrl", "category", "tags", "element_primary")
+
+
+def _slug(text: str) -> str:
+    """'mau_xanh lá' / 'Thuỷ' -> 'mau_xanh_la' / 'thuy'"""
+    text = unicodedata.normalize("NFD", str(text).lower().replace("đ", "d"))
+    text = "".join(c for c in text if unicodedata.category(c) != "Mn")
+    return "_".join(text.split())
+
+
+def element_index(name):
+    return _ELEMENT_SLUGS.get(_slug(name))
+
+
+def element_vector(payload: dict) -> np.ndarray:
+    """Vector ngũ hành (tổng = 1, hoặc toàn 0 nếu không có tín hiệu) của 1 tranh."""
+    tag_vec = np.zeros(len(ELEMENTS), dtype=np.float32)
+    for tag in list(payload.get("tags") or []) + list(payload.get("visual_tags") or []):
+        for element, weight in TAG_ELEMENTS.get(_slug(tag), {}).items():
+            tag_vec[ELEMENTS.index(element)] += weight
+
+    visual_vec = np.zeros(len(ELEMENTS), dtype=np.float32)
+    for element, score in (payload.get("element_scores") or {}).items():
+        index = element_index(element)
+        if index is not None:
+            visual_vec[index] = score
+
+    parts = []
+    if tag_vec.sum() > 0:
+        parts.append((1 - settings.FENGSHUI_VISUAL_WEIGHT, tag_vec / tag_vec.sum()))
+    if visual_vec.sum() > 0:
+        parts.append((settings.FENGSHUI_VISUAL_WEIGHT, visual_vec / visual_vec.sum()))
+    if not parts:
+        return tag_vec
+    total = sum(w for w, _ in parts)
+    return sum(w * v for w, v in parts) / total
+
+
+def profile_weights(profile: dict):
+    """Hồ sơ -> (vector trọng số 5 chiều, vai trò của từng ngũ hành); None nếu hồ sơ không có ngũ hành nào."""
+    if not profile:
+        return None
+    weights = np.zeros(len(ELEMENTS), dtype=np.float32)
+    roles = [None] * len(ELEMENTS)
+    # Thứ tự quan trọng: ngũ hành xuất hiện ở nhiều nhóm lấy trọng số của nhóm sau cùng (tránh > ưu tiên)
+    groups = (
+        ("hy_than", "Hỷ Thần", settings.FENGSHUI_WEIGHT_HY),
+        ("dung_than", "Dụng Thần", settings.FENGSHUI_WEIGHT_DUNG),
+        ("ky_than", "Kỵ Thần", settings.FENGSHUI_WEIGHT_KY),
+        ("hung_than", "Hung Thần", settings.FENGSHUI_WEIGHT_HUNG),
+    )
+    for field, role, weight in groups:
+        for name in profile.get(field) or []:
+            index = element_index(name)
+            if index is not None:
+                weights[index] = weight
+                roles[index] = role
+    return (weights, roles) if weights.any() else None
+
+
+def _verdict(score: float) -> str:
+    if score >= settings.FENGSHUI_MATCH_MIN:
+        return "match"
+    if score <= settings.FENGSHUI_AVOID_MAX:
+        return "avoid"
+    return "neutral"
+
+
+def _explain(vector, weights, roles, score):
+    """Kết luận + ngũ hành đóng góp nhiều nhất (dương / âm) để LLM và frontend giải thích."""
+    contrib = vector * weights
+    reasons = []
+    best, worst = int(np.argmax(contrib)), int(np.argmin(contrib))
+    if contrib[best] >= REASON_MIN_CONTRIBUTION:
+        reasons.append(f"{ELEMENTS[best]} ({vector[best]:.0%}) là {roles[best]}")
+    if contrib[worst] <= -REASON_MIN_CONTRIBUTION:
+        reasons.append(f"{ELEMENTS[worst]} ({vector[worst]:.0%}) là {roles[worst]}")
+    verdict = _verdict(score)
+    return {
+        "score": round(float(score), 4),
+        "verdict": verdict,
+        "label": VERDICT_LABELS[verdict],
+        "elements": {e: round(float(v), 3) for e, v in zip(ELEMENTS, vector)},
+        "reasons": reasons,
+    }
+
+
+class _Catalog:
+    def __init__(self, payloads, matrix, version):
+        self.payloads = payloads
+        self.matrix = matrix          # (N, 5)
+        self.version = version
+        self.row_of = {str(p.get("original_id")): i for i, p in enumerate(payloads)}
+
+
+class FengShuiRanker:
+    """Giữ ma trận ngũ hành của cả kho trong bộ nhớ, nạp lại khi phiên bản dữ liệu đổi (sau index)."""
+
+    def __init__(self):
+        self._catalog = None
+        self._lock = threading.Lock()
+
+    def catalog(self) -> _Catalog:
+        version = current_data_version()
+        if self._catalog is None or self._catalog.version != version:
+            with self._lock:
+                if self._catalog is None or self._catalog.version != version:
+                    self._catalog = self._load(version)
+        return self._catalog
+
+    @staticmethod
+    def _load(version):
+        start = time.perf_counter()
+        payloads = vector_store.read_payloads(
+            settings.PAINTINGS_COLLECTION, list(RESULT_FIELDS) + ["element_scores", "visual_tags"],
+        )
+        matrix = np.stack([element_vector(p) for p in payloads]) if payloads else np.zeros((0, len(ELEMENTS)), dtype=np.float32)
+        logger.info(f"☯️ Nạp ma trận ngũ hành: {len(payloads)} tranh ({(time.perf_counter() - start) * 1000:.0f}ms)")
+        return _Catalog(payloads, matrix.astype(np.float32), version)
+
+    def rank_catalog(self, profile: dict, limit: int = 20, category: str = None, exclude_avoid: bool = True):
+        """Xếp hạng toàn bộ kho theo hồ sơ. Trả về (danh sách, tổng số tranh hợp lệ)."""
+        parsed = profile_weights(profile)
+        if parsed is None:
+            return [], 0
+        weights, roles = parsed
+        catalog = self.catalog()
+        with stage("fengshui_rank"):
+            scores = catalog.matrix @ weights
+            valid = np.ones(len(scores), dtype=bool)
+            if category:
+                valid &= np.array([p.get("category") == category for p in catalog.payloads], dtype=bool)
+            if exclude_avoid:
+                valid &= scores > settings.FENGSHUI_AVOID_MAX
+            candidates = np.flatnonzero(valid)
+            order = candidates[np.argsort(-scores[candidates], kind="stable")][:limit]
+            results = [
+                {**{k: catalog.payloads[i].get(k) for k in RESULT_FIELDS},
+                 "fengshui": _explain(catalog.matrix[i], weights, roles, scores[i])}
+                for i in order
+            ]
+        return results, int(len(candidates))
+
+    def evaluate(self, product: dict, profile: dict):
+        """
+        Độ hợp mệnh của 1 tranh (vd. sản phẩm khách đang xem).
+        Ưu tiên dữ liệu trong kho (có element_scores) theo id, không có thì dùng tags gửi kèm.
+        """
+        parsed = profile_weights(profile)
+        if parsed is None or not product:
+            return None
+        weights, roles = parsed
+        catalog = self.catalog()
+        row = catalog.row_of.get(str(product.get("id", product.get("original_id"))))
+        vector = catalog.matrix[row] if row is not None else element_vector(product)
+        if not vector.any():
+            return None
+        return _explain(vector, weights, roles, float(vector @ weights))
+
+    def rerank(self, products, profile: dict):
+        """
+        Sắp lại danh sách tranh (vd. kết quả tìm bằng ảnh) theo điểm tương đồng + điểm hợp mệnh.
+        Ghi "fengshui" và điểm gộp "rank_score" vào từng tranh (sắp xếp + phân bổ ngân sách prompt),
+        "score" giữ nguyên điểm tìm kiếm gốc.
+        """
+        parsed = profile_weights(profile)
+        if parsed is None or not products:
+            return products
+        weights, roles = parsed
+        with stage("fengshui_rank"):
+            vectors = np.stack([element_vector(p) for p in products])
+            scores = vectors @ weights
+            ranked = []
+            for product, vector, score in zip(products, vectors, scores):
+                # Kết quả gộp nhiều ảnh (RRF) có "score" khác thang -> dùng cosine "similarity" nếu có
+                similarity = product.get("similarity", product.get("score")) or 0.0
+                ranked.append({
+                    **product,
+                    "similarity": similarity,
+                    "fengshui": _explain(vector, weights, roles, score),
+                    "rank_score": similarity + settings.FENGSHUI_BLEND * float(score),
+                })
+        return sorted(ranked, key=lambda p: p["rank_score"], reverse=True)
+
+
+fengshui_ranker = FengShuiRanker()
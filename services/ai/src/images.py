@@ -0,0 +1,108 @@
+# images.py
+# (Chuẩn bị ảnh: decode 1 lần, thu nhỏ, bỏ metadata, nén lại cho LLM và dùng chung cho SigLIP)
+import io
+from dataclasses import dataclass
+import requests
+from PIL import Image, ImageOps
+from .config import settings
+from .logger import get_logger
+from .metrics import stage
+
+logger = get_logger("images")
+
+# PIL tự báo lỗi DecompressionBombError với ảnh lớn hơn 2 lần ngưỡng này
+Image.MAX_IMAGE_PIXELS = settings.MAX_IMAGE_PIXELS
+
+# Phiên bản cách chuẩn bị ảnh cho SigLIP, ghi vào payload lúc index (vector truy vấn và vector
+# trong kho phải cùng cách resize). 1 = processor tự resize; 2 = load_vision_image (draft JPEG + BICUBIC).
+# Tranh index bằng phiên bản cũ: python -m src.index reembed
+VISION_PREPROCESS_VERSION = 2
+
+
+@dataclass
+class PreparedImage:
+    image: Image.Image   # Ảnh RGB đã thu nhỏ (dùng cho SigLIP)
+    llm_bytes: bytes     # JPEG đã nén lại (gửi cho Ollama)
+    original_size: tuple
+    original_bytes: int
+
+
+def decode_image(data, min_side: int) -> Image.Image:
+    """
+    Decode ảnh (bytes / file-like) với chi phí thấp nhất có thể:
+    - Kiểm tra kích thước từ header trước khi decode (chặn decompression bomb)
+    - JPEG: dùng draft mode để decoder tự giảm 1/2, 1/4, 1/8 tới mức nhỏ nhất vẫn >= min_side
+    - Xoay theo EXIF, chuyển RGB (bỏ metadata)
+    """
+    image = Image.open(io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data)
+    width, height = image.size
+    if width * height > settings.MAX_IMAGE_PIXELS:
+        raise ValueError(f"Ảnh quá lớn ({width}x{height} pixels)")
+
+    if image.format == "JPEG":
+        # draft() giữ tỉ lệ và chọn scale sao cho cả 2 cạnh vẫn >= kích thước yêu cầu
+        scale = min_side / min(width, height)
+        if scale < 1:
+            image.draft("RGB", (max(int(width * scale), 1), max(int(height * scale), 1)))
+
+    return ImageOps.exif_transpose(image).convert("RGB")
+
+
+def load_vision_image(image_source, size: int = None):
+    """
+    Chuẩn hóa đầu vào cho SigLIP thành ảnh RGB đúng size x size (processor không cần resize lại).
+    - str (URL) / bytes: decode nhanh bằng decode_image
+    - Image: ảnh đã decode sẵn (vd. PreparedImage.image)
+    Trả về None nếu không tải được.
+    """
+    size = size or settings.VISION_IMAGE_SIZE
+
+    if isinstance(image_source, str) and image_source.startswith("http"):
+        response = requests.get(image_source, timeout=10)
+        if response.status_code != 200:
+            return None
+        image = decode_image(response.content, size)
+    elif isinstance(image_source, (bytes, bytearray)):
+        image = decode_image(image_source, size)
+    elif isinstance(image_source, Image.Image):
+        image = image_source.convert("RGB")
+    else:
+        return None
+
+    # Resize giống SiglipImageProcessor (BICUBIC, không giữ tỉ lệ) nhưng trên ảnh đã được giảm sẵn
+    if image.size != (size, size):
+        image = image.resize((size, size), Image.Resampling.BICUBIC, reducing_gap=3.0)
+    return image
+
+
+def prepare_image(data: bytes, max_side: int = None):
+    """
+    Decode ảnh upload / ảnh sản phẩm đúng 1 lần.
+    - Xoay theo EXIF rồi bỏ toàn bộ metadata (EXIF, ICC, GPS...)
+    - Thu nhỏ về cạnh dài tối đa max_side (độ phân giải vision encoder của LLM)
+    - Nén lại JPEG để giảm payload base64 gửi Ollama
+    Trả về None nếu không decode được.
+    """
+    if not data:
+        return None
+    max_side = max_side or settings.LLM_IMAGE_MAX_SIDE
+
+    try:
+        with stage("image_prepare"):
+            original_size = Image.open(io.BytesIO(data)).size
+            # Cạnh ngắn cần >= max_side * tỉ lệ để sau thumbnail cạnh dài vẫn đạt max_side
+            min_side = max(int(max_side * min(original_size) / max(original_size)), 1)
+            image = decode_image(data, min_side)
+            if max(image.size) > max_side:
+                image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=settings.LLM_IMAGE_JPEG_QUALITY, optimize=True)
+            llm_bytes = buffer.getvalue()
+
+        logger.info(f"🖼️ Ảnh {original_size[0]}x{original_size[1]} ({len(data)} bytes) -> "
+                    f"{image.size[0]}x{image.size[1]} ({len(llm_bytes)} bytes)")
+        return PreparedImage(image=image, llm_bytes=llm_bytes, original_size=original_size, original_bytes=len(data))
+    except Exception as e:
+        logger.warning(f"⚠️ Lỗi xử lý ảnh: {e}")
+        return None
@@ -1,14 +1,23 @@
 # index.py
+import argparse
 import requests
 import uuid
 import json
-from qdrant_client import QdrantClient
+import numpy as np
 from qdrant_client.http import models
 from .config import settings
+from .qdrant import client
+from .vector_store import vector_store
+from .neighbors import build_neighbor_graph
 from .core import ai_models
+from .elements import element_scorer
+from .descriptions import description_store
+from .images import VISION_PREPROCESS_VERSION
+from .data_version import bump_data_version
+from .logger import get_logger
+
+logger = get_logger("index")
 
-# Kết nối Qdrant
-client = QdrantClient(url=settings.QDRANT_URL)
 
 def run_indexing():
     print(f"🔄 Bắt đầu Indexing vào Collection: {settings.PAINTINGS_COLLECTION}")
@@ -78,22 +87,22 @@ def run_indexing():
                 tags_list = []
                 
                 # DEBUG: In ra cấu trúc tags
-                print(f"      🔍 DEBUG - Product: {p['name']}")
-                print(f"         'tags' in p: {'tags' in p}")
-                print(f"         'productTags' in p: {'productTags' in p}")
+                logger.debug(f"      🔍 DEBUG - Product: {p['name']}")
+                logger.debug(f"         'tags' in p: {'tags' in p}")
+                logger.debug(f"         'productTags' in p: {'productTags' in p}")
                 
                 if 'tags' in p and p['tags']:
-                    print(f"         ✅ Found tags (direct): {p['tags']}")
+                    logger.debug(f"         ✅ Found tags (direct): {p['tags']}")
                     tags_list = p['tags']
 
                 elif 'productTags' in p and p['productTags']:
-                    print(f"         ✅ Found productTags: {p['productTags']}")
+                    logger.debug(f"         ✅ Found productTags: {p['productTags']}")
                     for pt in p['productTags'] : 
                         if 'tag' in pt and pt['tag'] and 'name' in pt['tag'] : 
                             if pt['tag']['name'] and pt['tag']['name'] not in tags_list : 
                                 tags_list.append(pt['tag']['name'])
                 
-                print(f"         📋 Final tags_list: {tags_list}")
+                logger.debug(f"         📋 Final tags_list: {tags_list}")
 
                 # Metadata: Lưu lại thông tin
                 payload = {
@@ -102,14 +111,28 @@ def run_indexing():
                     "price": p['price'],
                     "imageUrl": p['imageUrl'],
                     "category": p.get('category', {}).get('name', '') if p.get('category') else "",
-                    "tags": tags_list
+                    "tags": tags_list,
+                    "preprocess_version": VISION_PREPROCESS_VERSION,
                 }
+                # Mô tả hình ảnh đã sinh trước đó cho đúng ảnh này (descriptions.py)
+                description = description_store.get(p['imageUrl'])
+                if description:
+                    payload["visual_description"] = description
                 
                 points.append(models.PointStruct(id=point_id, vector=vector, payload=payload))
         except Exception as e:
             print(f"   ⚠️ Lỗi sản phẩm {p.get('name')}: {e}")
 
-    # 4. Upload lên Qdrant theo batch để tránh vượt quá 32MB
+    # 4. Điểm ngũ hành / màu / chủ đề từ chính vector ảnh (SigLIP zero-shot, xem elements.py)
+    if points:
+        try:
+            for point, scores in zip(points, element_scorer.score([p.vector for p in points])):
+                point.payload.update(scores)
+            print(f"🧭 Đã chấm điểm ngũ hành cho {len(points)} tranh")
+        except Exception as e:
+            print(f"   ⚠️ Lỗi chấm điểm ngũ hành (bỏ qua, có thể chạy lại: python -m src.elements backfill): {e}")
+
+    # 5. Upload lên Qdrant theo batch để tránh vượt quá 32MB
     if points:
         batch_size = 50  # Upload 50 vectors mỗi lần
         total_batches = (len(points) + batch_size - 1) // batch_size
@@ -121,9 +144,77 @@ def run_indexing():
             client.upsert(collection_name=settings.PAINTINGS_COLLECTION, points=batch)
         
         print(f"✅ HOÀN TẤT! Đã nạp {len(points)} kiến thức vào não AI.")
+        vector_store.sync(settings.PAINTINGS_COLLECTION)
+        build_neighbor_graph()
+        bump_data_version("paintings")
         print(f"🚫 Bị bỏ qua: {skipped_count}")
     else:
         print("⚠️ Không có dữ liệu nào được lưu.")
 
+
+def reembed_stale(dry_run: bool = False, batch_size: int = 64):
+    """
+    Tính lại vector các tranh index bằng cách chuẩn bị ảnh cũ (preprocess_version khác hiện tại),
+    đo độ lệch (cosine vector cũ / mới) để biết truy vấn mới lệch kho cũ bao nhiêu.
+    dry_run: chỉ đo, không ghi lại Qdrant.
+    """
+    cosines, updated, failed, offset = [], 0, 0, None
+    while True:
+        points, offset = client.scroll(
+            collection_name=settings.PAINTINGS_COLLECTION, limit=batch_size, offset=offset,
+            with_payload=["imageUrl", "preprocess_version"], with_vectors=True,
+        )
+        stale = [p for p in points if (p.payload or {}).get("preprocess_version") != VISION_PREPROCESS_VERSION]
+        vectors = ai_models.get_image_embeddings([p.payload.get("imageUrl") for p in stale]) if stale else []
+        done = [(p, v) for p, v in zip(stale, vectors) if v is not None]
+        failed += len(stale) - len(done)
+        for p, v in done:
+            old, new = np.asarray(p.vector, dtype=np.float32), np.asarray(v, dtype=np.float32)
+            cosines.append(float(old @ new / (np.linalg.norm(old) * np.linalg.norm(new) + 1e-12)))
+
+        if done and not dry_run:
+            client.update_vectors(
+                collection_name=settings.PAINTINGS_COLLECTION,
+                points=[models.PointVectors(id=p.id, vector=v) for p, v in done],
+            )
+            # Điểm ngũ hành tính từ vector -> chấm lại theo vector mới
+            payloads = element_scorer.score([v for _, v in done])
+            client.batch_update_points(
+                collection_name=settings.PAINTINGS_COLLECTION,
+                update_operations=[
+                    models.SetPayloadOperation(set_payload=models.SetPayload(
+                        payload={**payload, "preprocess_version": VISION_PREPROCESS_VERSION}, points=[p.id]))
+                    for (p, _), payload in zip(done, payloads)
+                ],
+            )
+            updated += len(done)
+        if offset is None:
+            break
+
+    if cosines:
+        c = np.asarray(cosines)
+        logger.info(f"📐 Độ lệch vector kho cũ / cách chuẩn bị ảnh mới ({len(c)} tranh): "
+                    f"cosine trung bình {c.mean():.4f}, p5 {np.percentile(c, 5):.4f}, nhỏ nhất {c.min():.4f}")
+    logger.info(f"{'🔍 (dry-run) ' if dry_run else '✅ '}Tranh cần tính lại: {len(cosines) + failed}, "
+                f"đã cập nhật {updated}, lỗi tải ảnh {failed}")
+    if updated:
+        vector_store.sync(settings.PAINTINGS_COLLECTION)
+        build_neighbor_graph()
+        bump_data_version("paintings")
+    return cosines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index kho tranh vào Qdrant")
+    parser.add_argument("command", nargs="?", default="full", choices=["full", "reembed"],
+                        help="full: index lại toàn bộ từ Product Service; reembed: tính lại vector tranh index bằng cách chuẩn bị ảnh cũ")
+    parser.add_argument("--dry-run", action="store_true", help="reembed: chỉ đo độ lệch, không ghi Qdrant")
+    args = parser.parse_args()
+    if args.command == "reembed":
+        reembed_stale(dry_run=args.dry_run)
+    else:
+        run_indexing()
+
+
 if __name__ == "__main__":
-    run_indexing()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -2,10 +2,12 @@ import os
 import uuid
 from pathlib import Path
 from typing import List
-from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from .config import settings
+from .qdrant import client
+from .vector_store import vector_store
 from .core import ai_models
+from .data_version import bump_data_version
 
 # PDF processing
 try:
@@ -14,7 +16,6 @@ except ImportError:
     print("⚠️ PyPDF2 not installed. Run: pip install PyPDF2")
     PyPDF2 = None
 
-client = QdrantClient(url=settings.QDRANT_URL)
 
 def extract_text_from_pdf(pdf_path: str) -> str:
     """Extract text from PDF file"""
@@ -141,7 +142,7 @@ def ingest_pdfs():
         
         # Chunk text
         print(f"   ✂️  Chunking text...")
-        chunks = chunk_text(text, chunk_size=500, overlap=50)
+        chunks = chunk_text(text, chunk_size=settings.KNOWLEDGE_CHUNK_SIZE, overlap=settings.KNOWLEDGE_CHUNK_OVERLAP)
         print(f"   ✅ Created {len(chunks)} chunks")
         
         # Embed and create points
@@ -186,6 +187,8 @@ def ingest_pdfs():
             client.upsert(collection_name=settings.DOCS_COLLECTION, points=batch)
         
         print(f"\n✅ HOÀN TẤT! Đã nạp {len(all_points)} chunks kiến thức vào Qdrant")
+        vector_store.sync(settings.DOCS_COLLECTION)
+        bump_data_version("knowledge_pdf")
         print(f"📊 Collection: {settings.DOCS_COLLECTION}")
         print(f"🔍 Vector size: {settings.TEXT_VECTOR_SIZE}")
     else:
@@ -1,11 +1,12 @@
 import os
 import uuid
-from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from .config import settings
+from .qdrant import client
+from .vector_store import vector_store
 from .core import ai_models
+from .data_version import bump_data_version
 
-client = QdrantClient(url=settings.QDRANT_URL)
 
 def ingest():
     print("📚 Đang nạp kiến thức phong thủy (Dùng VietnamEmbedding)...")
@@ -40,6 +41,8 @@ def ingest():
             
     client.upsert(collection_name=settings.DOCS_COLLECTION, points=points)
     print(f"✅ Đã nạp {len(points)} kiến thức thành công!")
+    vector_store.sync(settings.DOCS_COLLECTION)
+    bump_data_version("knowledge_text")
 
 if __name__ == "__main__":
     ingest()
\ No newline at end of file
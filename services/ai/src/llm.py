@@ -1,102 +1,261 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 import ollama
 from .config import settings
+from .context import assemble_context, truncate_to_tokens
+from .logger import get_logger
+from .metrics import (LLM_ACTIVE, LLM_QUEUE_DEPTH, LLM_REJECTED_TOTAL, LLM_TOKENS_PER_SECOND,
+                      LLM_TOKENS_TOTAL, LLM_TTFT_SECONDS, observe_stage, record_value, stage)
+
+logger = get_logger("llm")
+
+SYSTEM_PROMPT = "You are a helpful Vietnamese feng shui consultant. IMPORTANT: Respond DIRECTLY in Vietnamese. Do NOT show your thinking process. Do NOT use English. Just give the final answer immediately."
+
+# Giới hạn độ dài câu hỏi của khách để ngân sách token luôn dự đoán được
+MAX_QUESTION_TOKENS = 1024
+
+# Độ ưu tiên trong hàng đợi LLM (số nhỏ = ưu tiên cao)
+PRIORITY_INTERACTIVE = 0   # /ws/chat
+PRIORITY_CHAT = 1          # /api/chat
+PRIORITY_BATCH = 2         # /analyze, tác vụ nền (tóm tắt hội thoại...)
+
+OVERLOAD_MESSAGE = "Xin lỗi, hệ thống tư vấn AI đang quá tải. Bạn vui lòng thử lại sau ít phút nhé! 🙏"
+
+
+class LLMGateway:
+    """
+    Admission control cho Ollama:
+    - Tối đa max_concurrency stream chạy cùng lúc
+    - Hàng đợi ưu tiên có giới hạn; khi đầy, request ưu tiên thấp nhất bị loại
+    - Request chờ quá lâu (queue timeout) hoặc quá deadline sẽ bị từ chối để trả lời nhanh
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []               # heap: [priority, seq, ticket]
+        self._seq = itertools.count()
+        self._wait_times = deque(maxlen=512)
+        self.latency_ewma = 0.0          # TTFT trung bình (giây) gần đây, tính từ lúc có slot
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0, "deadline": 0, "evicted": 0, "cancelled": 0}
+
+    def acquire(self, priority=PRIORITY_CHAT, deadline=None, cancel=None) -> bool:
+        """
+        Chờ tới lượt. Trả về False nếu bị từ chối (quá tải) hoặc bị hủy.
+        - cancel: threading.Event, được set khi client ngắt kết nối / gửi tin nhắn mới
+        """
+        start = time.monotonic()
+        give_up_at = start + self.queue_timeout
+        if deadline is not None:
+            give_up_at = min(give_up_at, deadline)
+
+        with self._cond:
+            if self._active < self.max_concurrency and not self._waiting:
+                self._admit(start)
+                return True
+
+            ticket = {"state": "waiting"}
+            if len(self._waiting) >= self.max_queue:
+                worst = max(self._waiting)
+                if worst[0] <= priority:
+                    self._reject("queue_full")
+                    return False
+                # Hàng đợi đầy: loại request ưu tiên thấp nhất để nhường chỗ
+                self._waiting.remove(worst)
+                heapq.heapify(self._waiting)
+                worst[2]["state"] = "evicted"
+                self._reject("evicted")
+                self._cond.notify_all()
+
+            entry = [priority, next(self._seq), ticket]
+            heapq.heappush(self._waiting, entry)
+
+            while True:
+                if ticket["state"] == "evicted":
+                    self._wait_times.append(time.monotonic() - start)
+                    return False
+                if self._waiting[0] is entry and self._active < self.max_concurrency:
+                    heapq.heappop(self._waiting)
+                    self._admit(start)
+                    # Còn slot trống thì đánh thức request kế tiếp
+                    self._cond.notify_all()
+                    return True
+
+                if cancel is not None and cancel.is_set():
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._reject("cancelled")
+                    self._cond.notify_all()
+                    return False
+
+                remaining = give_up_at - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    reason = "deadline" if deadline is not None and give_up_at == deadline else "timeout"
+                    self._reject(reason)
+                    self._wait_times.append(time.monotonic() - start)
+                    self._cond.notify_all()
+                    return False
+                # Thức dậy định kỳ để kiểm tra cờ hủy
+                self._cond.wait(min(remaining, 0.25))
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        LLM_REJECTED_TOTAL.labels(reason=reason).inc()
+
+    def _admit(self, start):
+        self._active += 1
+        self.admitted += 1
+        self._wait_times.append(time.monotonic() - start)
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_CHAT, deadline=None, cancel=None):
+        """with llm_gateway.slot(...) as admitted: ..."""
+        admitted = self.acquire(priority, deadline, cancel)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release()
+
+    def record_latency(self, seconds: float, alpha: float = 0.2):
+        """Nạp TTFT (không phải cả lượt sinh: độ dài câu trả lời làm nhiễu tín hiệu quá tải)."""
+        self.latency_ewma = seconds if self.latency_ewma == 0 else (1 - alpha) * self.latency_ewma + alpha * seconds
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._wait_times)
+        pick = lambda q: round(waits[min(int(q * len(waits)), len(waits) - 1)], 3) if waits else 0.0
+        return {
+            "active": self._active,
+            "queue_depth": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "workers": settings.WEB_CONCURRENCY,   # Số liệu trên chỉ của worker trả lời request này
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "wait_seconds": {"p50": pick(0.5), "p95": pick(0.95), "max": waits[-1] if waits else 0.0},
+            "latency_ewma": round(self.latency_ewma, 3),
+        }
+
 
-def chat_stream(user_text, user_image_bytes=None, products_context=[], knowledge_context="", feng_shui_profile=None, current_product=None, product_image_bytes=None):
+def worker_share(total: int) -> int:
+    """Phần giới hạn của 1 worker khi chạy WEB_CONCURRENCY worker (chia đều làm tròn xuống, tối thiểu 1)."""
+    return max(1, total // max(settings.WEB_CONCURRENCY, 1))
+
+
+if settings.WEB_CONCURRENCY > settings.LLM_MAX_CONCURRENCY:
+    logger.warning(f"⚠️ {settings.WEB_CONCURRENCY} worker > LLM_MAX_CONCURRENCY={settings.LLM_MAX_CONCURRENCY}: "
+                   f"mỗi worker vẫn giữ 1 slot, Ollama có thể nhận tới {settings.WEB_CONCURRENCY} stream")
+
+llm_gateway = LLMGateway(
+    max_concurrency=worker_share(settings.LLM_MAX_CONCURRENCY),
+    max_queue=worker_share(settings.LLM_MAX_QUEUE),
+    queue_timeout=settings.LLM_QUEUE_TIMEOUT,
+)
+LLM_QUEUE_DEPTH.set_function(lambda: llm_gateway.queue_depth)
+LLM_ACTIVE.set_function(lambda: llm_gateway._active)
+
+
+# Model Ollama báo chưa có (404) lúc chạy -> không route sang nữa cho tới khi khởi động lại
+_missing_models = set()
+
+
+def _light_model():
+    model = settings.LLM_LIGHT_MODEL_ID
+    return model if model and model not in _missing_models else None
+
+
+def route_model(messages, token_usage):
+    """
+    Chọn model + num_predict cho request:
+    - Có ảnh: luôn dùng model chính (model nhỏ không đọc được ảnh), quá tải thì rút ngắn câu trả lời
+    - Câu hỏi đơn giản (không hồ sơ, không sản phẩm đang xem, context ngắn): model nhỏ
+    - Quá tải (hàng đợi dài hoặc TTFT tăng cao): model nhỏ + câu trả lời ngắn
+    Không cấu hình model nhỏ (hoặc Ollama chưa có): dùng model chính, quá tải thì rút ngắn câu trả lời.
+    """
+    sections = token_usage.get("sections", {})
+    has_images = any(m.get("images") for m in messages)
+    has_profile = sections.get("feng_shui_profile", 0) > 0 or sections.get("current_product", 0) > 0
+    context_tokens = sections.get("question", 0) + sections.get("knowledge", 0) + sections.get("products", 0)
+
+    queue_depth = llm_gateway.queue_depth
+    under_pressure = queue_depth >= worker_share(settings.LLM_ROUTE_QUEUE_DEPTH) or llm_gateway.latency_ewma >= settings.LLM_ROUTE_LATENCY
+    simple = not has_images and not has_profile and "session" not in token_usage and context_tokens < settings.LLM_ROUTE_SIMPLE_TOKENS
+
+    light_model = _light_model()
+    if has_images:
+        model = settings.LLM_MODEL_ID
+        num_predict = settings.LLM_PRESSURE_NUM_PREDICT if under_pressure else settings.LLM_NUM_PREDICT
+        reason = "images+pressure" if under_pressure else "images"
+    elif under_pressure and light_model:
+        model, num_predict, reason = light_model, settings.LLM_LIGHT_NUM_PREDICT, "pressure"
+    elif under_pressure:
+        model, num_predict, reason = settings.LLM_MODEL_ID, settings.LLM_PRESSURE_NUM_PREDICT, "pressure"
+    elif simple and light_model:
+        model, num_predict, reason = light_model, settings.LLM_LIGHT_NUM_PREDICT, "simple"
+    else:
+        model, num_predict, reason = settings.LLM_MODEL_ID, settings.LLM_NUM_PREDICT, "default"
+
+    decision = {
+        "model": model,
+        "num_predict": num_predict,
+        "reason": reason,
+        "queue_depth": queue_depth,
+        "latency_ewma": round(llm_gateway.latency_ewma, 3),
+    }
+    token_usage["route"] = decision
+    logger.info(f"🧭 Route: {model} (num_predict={num_predict}, lý do={reason}, queue={queue_depth})")
+    return decision
+
+
+def format_product(p, index):
+    """Format 1 tranh trong danh sách gợi ý."""
+    tags = p.get('tags', [])
+    if isinstance(tags, list):
+        tags = tags[:5]
+    tags_str = ", ".join(str(t) for t in tags)
     
-    # Format danh sách tranh tìm được
-    products_str = ""
+    price = p.get('price', 0)
+    price_str = f"{price:,} VNĐ" if isinstance(price, (int, float)) else str(price)
     
-    if isinstance(products_context, list) and len(products_context) > 0:
-        products_str = "DANH SÁCH TRANH GỢI Ý TỪ KHO:\n"
-        
-        for i, p in enumerate(products_context, 1):
-            if isinstance(p, dict):
-                tags = p.get('tags', [])
-                if isinstance(tags, list):
-                    tags = tags[:5]
-                tags_str = ", ".join(str(t) for t in tags)
-                
-                price = p.get('price', 0)
-                price_str = f"{price:,} VNĐ" if isinstance(price, (int, float)) else str(price)
-                
-                name = p.get('name', 'Tranh không tên')
-                
-                products_str += f"{i}. Tranh: {name}\n   - Giá: {price_str}\n   - Đặc điểm: {tags_str}\n\n"
-
-    # Format feng shui profile (Dụng Thần / Kỵ Thần)
-    feng_shui_str = ""
-    if feng_shui_profile:
-        dung_than = feng_shui_profile.get('dung_than', [])
-        hy_than = feng_shui_profile.get('hy_than', [])
-        ky_than = feng_shui_profile.get('ky_than', [])
-        hung_than = feng_shui_profile.get('hung_than', [])
-        day_master = feng_shui_profile.get('day_master_element', '')
-        day_status = feng_shui_profile.get('day_master_status', '')
-        
-        feng_shui_str = f"""
-HỒ SƠ PHONG THỦY KHÁCH HÀNG:
-- Mệnh chủ: {day_master} ({day_status})
-- DỤNG THẦN (Ngũ hành CẦN bổ sung, ƯU TIÊN chọn): {', '.join(dung_than) if dung_than else 'Chưa xác định'}
-- HỶ THẦN (Ngũ hành hỗ trợ tốt): {', '.join(hy_than) if hy_than else 'Không có'}
-- KỴ THẦN (Ngũ hành CẦN TRÁNH, KHÔNG nên chọn): {', '.join(ky_than) if ky_than else 'Không có'}
-- HUNG THẦN (Ngũ hành gây hại, TUYỆT ĐỐI TRÁNH): {', '.join(hung_than) if hung_than else 'Không có'}
-
-⚠️ QUY TẮC CHỌN SẢN PHẨM THEO MỆNH:
-1. ƯU TIÊN CAO NHẤT: Sản phẩm có màu sắc/chủ đề thuộc DỤNG THẦN
-2. ƯU TIÊN THỨ 2: Sản phẩm có màu sắc/chủ đề thuộc HỶ THẦN  
-3. TRÁNH: Sản phẩm có màu sắc/chủ đề thuộc KỴ THẦN hoặc HUNG THẦN
-4. Giải thích rõ lý do chọn dựa trên ngũ hành
-
-BẢNG THAM CHIẾU NGŨ HÀNH - MÀU SẮC - CHỦ ĐỀ:
-- Mộc: Xanh lá, xanh lục | Cây cối, rừng, tre trúc, hoa lá
-- Hỏa: Đỏ, cam, hồng | Mặt trời, lửa, ánh sáng, chim phượng
-- Thổ: Vàng, nâu, be | Núi, đất, sa mạc, gốm sứ
-- Kim: Trắng, xám, bạc, vàng kim | Kim loại, tròn, trăng, hổ
-- Thủy: Đen, xanh dương, tím | Nước, sông, biển, cá, thác
-"""
-
-    # Format current product context (product user is viewing)
-    current_product_str = ""
-    if current_product:
-        product_name = current_product.get('name', 'Sản phẩm')
-        product_price = current_product.get('price', 0)
-        product_desc = current_product.get('description', '')
-        product_category = current_product.get('categoryName', '')
-        product_tags = current_product.get('tags', [])
-        
-        price_str = f"{product_price:,} VNĐ" if isinstance(product_price, (int, float)) else str(product_price)
-        tags_str = ", ".join(product_tags[:5]) if product_tags else "Không có"
-        
-        current_product_str = f"""
-SẢN PHẨM KHÁCH ĐANG XEM:
-- Tên: {product_name}
-- Giá: {price_str}
-- Danh mục: {product_category}
-- Đặc điểm: {tags_str}
-- Mô tả: {product_desc[:200] if product_desc else 'Không có mô tả'}
+    name = p.get('name', 'Tranh không tên')
+
+    # Điểm ngũ hành tính sẵn từ ảnh lúc index (elements.py)
+    element_str = ""
+    element_scores = p.get('element_scores')
+    if element_scores:
+        top = sorted(element_scores.items(), key=lambda x: x[1], reverse=True)[:2]
+        element_str = "\n   - Ngũ hành (theo ảnh): " + ", ".join(f"{k} {v:.0%}" for k, v in top)
+    # Kết luận hợp mệnh đã tính sẵn theo hồ sơ (fengshui.py)
+    fengshui = p.get('fengshui')
+    if fengshui:
+        element_str += f"\n   - Hợp mệnh: {fengshui['label']}" + (f" ({'; '.join(fengshui['reasons'])})" if fengshui['reasons'] else "")
+    
+    return f"{index}. Tranh: {name}\n   - Giá: {price_str}\n   - Đặc điểm: {tags_str}{element_str}\n\n"
 
-⚠️ HƯỚNG DẪN KHI KHÁCH HỎI VỀ SẢN PHẨM NÀY:
-1. NẾU CÓ ẢNH SẢN PHẨM (đã được cung cấp để phân tích):
-   - QUAN SÁT KỸ ảnh sản phẩm: màu sắc chủ đạo, chủ đề, phong cách
-   - Xác định ngũ hành dựa trên những gì bạn THẤY trong ảnh
-   - KHÔNG chỉ dựa vào tags, hãy mô tả chi tiết những gì bạn thấy
 
-2. NẾU CÓ HỒ SƠ PHONG THỦY:
-   - So sánh ngũ hành của sản phẩm (từ ảnh) với Dụng Thần và Kỵ Thần của khách
-   - Đưa ra kết luận: PHÙ HỢP ✅ hoặc KHÔNG PHÙ HỢP ⚠️
-   - Giải thích lý do cụ thể dựa trên màu sắc/chủ đề bạn thấy trong ảnh
-   
-3. NẾU KHÔNG CÓ HỒ SƠ PHONG THỦY:
-   - Vẫn mô tả sản phẩm từ ảnh (màu sắc, phong cách, cảm xúc)
-   - Gợi ý khách tạo hồ sơ Bát Tự tại trang /bazi để được tư vấn chính xác
-   - Có thể hỏi khách về mệnh để tư vấn sơ bộ
-   
-4. NẾU KHÁCH HỎI VỀ PHỐI HỢP NỘI THẤT:
-   - Gợi ý khách sử dụng tính năng "Tư Vấn AI" tại /ai-consult
-   - Ở đó khách có thể upload ảnh căn phòng để AI phân tích chi tiết
-"""
-
-    prompt = f"""
+def build_prompt(user_text, feng_shui_str="", current_product_str="", knowledge_str="", products_str=""):
+    """Ghép các phần context vào prompt tư vấn."""
+    return f"""
 VAI TRÒ:
 Bạn là **chuyên gia tư vấn đồ decor và phong thủy hiện đại**, thân thiện và chuyên nghiệp.
 Mục tiêu của bạn là giúp khách **chọn sản phẩm phù hợp mệnh gia chủ VÀ phù hợp không gian nội thất**.
@@ -114,9 +273,9 @@ NGUYÊN TẮC BẮT BUỘC
   (4) **[PHÂN TÍCH KHÔNG GIAN]** - Phong cách, màu sắc, ánh sáng căn phòng
   
 - **KHI CÓ HỒ SƠ PHONG THỦY:**
-  • BẮT BUỘC ưu tiên sản phẩm có ngũ hành thuộc DỤNG THẦN
-  • TRÁNH gợi ý sản phẩm có ngũ hành thuộc KỴ THẦN / HUNG THẦN
-  • Giải thích rõ: "Vì bạn mệnh X, Dụng Thần là Y nên..."
+  • Mỗi tranh đã có "Hợp mệnh" / "Kết luận hợp mệnh (đã tính theo hồ sơ)": đó là kết luận CUỐI CÙNG, KHÔNG tự xét lại
+  • Ưu tiên gợi ý tranh ✅ PHÙ HỢP, sau đó ➖ TRUNG TÍNH
+  • Giải thích bằng lý do đi kèm kết luận: "Vì bạn mệnh X, Dụng Thần là Y nên..."
   
 - **KHI PHÂN TÍCH ẢNH CĂN PHÒNG:**
   • Nhận diện phong cách nội thất (hiện đại, cổ điển, tối giản, Á Đông...)
@@ -133,7 +292,7 @@ CẤM TUYỆT ĐỐI
 - Không dùng các từ: *tai họa, đại hung, phá sản, chết chóc, vận hạn*.
 - Không khẳng định phong thủy có thể thay đổi số phận.
 - Không bịa giá, bịa công dụng, bịa mệnh hoặc suy diễn thông tin.
-- **KHÔNG gợi ý sản phẩm thuộc KỴ THẦN** nếu biết mệnh khách.
+- **KHÔNG đưa ra kết luận hợp mệnh khác** với kết luận đã tính sẵn của tranh.
 
 ========================
 HỒ SƠ PHONG THỦY KHÁCH HÀNG
@@ -145,7 +304,7 @@ HỒ SƠ PHONG THỦY KHÁCH HÀNG
 ========================
 KIẾN THỨC CHUYÊN GIA
 ========================
-{knowledge_context if knowledge_context else "Không có kiến thức cụ thể cho câu hỏi này."}
+{knowledge_str if knowledge_str else "Không có kiến thức cụ thể cho câu hỏi này."}
 
 ========================
 SẢN PHẨM CÓ SẴN (từ tìm kiếm)
@@ -165,10 +324,10 @@ CÁCH TRẢ LỜI
 
 1️⃣ **NẾU CÓ HỒ SƠ PHONG THỦY + CẦN CHỌN SẢN PHẨM:**
 - **Bước 1**: Xác nhận mệnh và Dụng Thần của khách
-- **Bước 2**: Lọc sản phẩm phù hợp Dụng Thần, loại bỏ Kỵ Thần
+- **Bước 2**: Chọn trong danh sách theo "Hợp mệnh" đã tính sẵn (✅ PHÙ HỢP trước, ➖ TRUNG TÍNH sau)
 - **Bước 3**: Phân tích không gian (nếu có ảnh) để chọn phong cách phù hợp
 - **Bước 4**: Đưa ra 1 lựa chọn CHÍNH với lý do:
-  • Phù hợp Dụng Thần vì... (giải thích ngũ hành)
+  • Hợp mệnh vì... (giải thích theo lý do đi kèm kết luận)
   • Phù hợp không gian vì... (giải thích phong cách, màu sắc)
 - **Bước 5**: Đưa thêm 1-2 lựa chọn thay thế
 - **Bước 6**: Tư vấn cách bố trí
@@ -182,7 +341,7 @@ CÁCH TRẢ LỜI
 
 3️⃣ **NẾU KHÁCH HỎI VỀ SẢN PHẨM ĐANG XEM:**
 - Xác định ngũ hành của sản phẩm (từ màu sắc, chủ đề trong tags)
-- NẾU CÓ hồ sơ phong thủy → So sánh với Dụng Thần/Kỵ Thần và kết luận
+- NẾU CÓ "Kết luận hợp mệnh (đã tính theo hồ sơ)" → Dùng đúng kết luận đó, giải thích lý do
 - NẾU KHÔNG CÓ hồ sơ → Gợi ý tạo hồ sơ tại /bazi
 - NẾU khách hỏi về phối hợp nội thất → Gợi ý dùng /ai-consult để upload ảnh phòng
 
@@ -246,15 +405,141 @@ PHONG CÁCH TRÌNH BÀY
 - Markdown rõ ràng, dễ đọc
 - Emoji vừa phải (🏠 🌿 🎨 💡 ✨ ✅ ⚠️)
 - Highlight rõ lý do hợp mệnh
-- Cảnh báo nếu sản phẩm thuộc Kỵ Thần
+- Cảnh báo rõ khi kết luận tính sẵn là ⚠️ NÊN TRÁNH
 """
 
+def build_messages(user_text, user_image_bytes=None, products_context=[], knowledge_context="", feng_shui_profile=None, current_product=None, product_image_bytes=None, reserve_tokens=0):
+    """
+    Dựng danh sách messages gửi Ollama.
+
+    - knowledge_context: str hoặc List[{"content", "score"}] (từ search_knowledge_docs)
+    - reserve_tokens: số token chừa lại cho lịch sử hội thoại (chat nhiều lượt)
+
+    Returns:
+        (messages, token_usage)
+    """
+    
+    # Format feng shui profile (Dụng Thần / Kỵ Thần)
+    feng_shui_str = ""
+    if feng_shui_profile:
+        dung_than = feng_shui_profile.get('dung_than', [])
+        hy_than = feng_shui_profile.get('hy_than', [])
+        ky_than = feng_shui_profile.get('ky_than', [])
+        hung_than = feng_shui_profile.get('hung_than', [])
+        day_master = feng_shui_profile.get('day_master_element', '')
+        day_status = feng_shui_profile.get('day_master_status', '')
+        
+        feng_shui_str = f"""
+HỒ SƠ PHONG THỦY KHÁCH HÀNG:
+- Mệnh chủ: {day_master} ({day_status})
+- DỤNG THẦN (Ngũ hành CẦN bổ sung, ƯU TIÊN chọn): {', '.join(dung_than) if dung_than else 'Chưa xác định'}
+- HỶ THẦN (Ngũ hành hỗ trợ tốt): {', '.join(hy_than) if hy_than else 'Không có'}
+- KỴ THẦN (Ngũ hành CẦN TRÁNH, KHÔNG nên chọn): {', '.join(ky_than) if ky_than else 'Không có'}
+- HUNG THẦN (Ngũ hành gây hại, TUYỆT ĐỐI TRÁNH): {', '.join(hung_than) if hung_than else 'Không có'}
+
+⚠️ QUY TẮC CHỌN SẢN PHẨM THEO MỆNH:
+1. Tranh có "Hợp mệnh" / "Kết luận hợp mệnh (đã tính theo hồ sơ)": kết luận đó là CUỐI CÙNG, KHÔNG tự xét lại
+2. Gợi ý tranh ✅ PHÙ HỢP trước, ➖ TRUNG TÍNH sau (tranh nên tránh đã được loại khỏi danh sách)
+3. Giải thích lý do bằng ngũ hành nêu trong kết luận và bảng tham chiếu bên dưới
+4. Chỉ khi tranh KHÔNG có kết luận tính sẵn mới tự so màu sắc/chủ đề với Dụng Thần / Kỵ Thần
+
+BẢNG THAM CHIẾU NGŨ HÀNH - MÀU SẮC - CHỦ ĐỀ:
+- Mộc: Xanh lá, xanh lục | Cây cối, rừng, tre trúc, hoa lá
+- Hỏa: Đỏ, cam, hồng | Mặt trời, lửa, ánh sáng, chim phượng
+- Thổ: Vàng, nâu, be | Núi, đất, sa mạc, gốm sứ
+- Kim: Trắng, xám, bạc, vàng kim | Kim loại, tròn, trăng, hổ
+- Thủy: Đen, xanh dương, tím | Nước, sông, biển, cá, thác
+"""
+
+    # Format current product context (product user is viewing)
+    current_product_str = ""
+    if current_product:
+        product_name = current_product.get('name', 'Sản phẩm')
+        product_price = current_product.get('price', 0)
+        product_desc = current_product.get('description', '')
+        product_category = current_product.get('categoryName', '')
+        product_tags = current_product.get('tags', [])
+        # Mô tả hình ảnh sinh sẵn (descriptions.py) thay cho việc gửi ảnh
+        visual_description = current_product.get('visual_description')
+        visual_str = f"\n- Mô tả hình ảnh (đã phân tích từ ảnh sản phẩm): {visual_description}" if visual_description else ""
+        fengshui = current_product.get('fengshui')
+        if fengshui:
+            visual_str += f"\n- Kết luận hợp mệnh (đã tính theo hồ sơ): {fengshui['label']}" + (f" - {'; '.join(fengshui['reasons'])}" if fengshui['reasons'] else "")
+        
+        price_str = f"{product_price:,} VNĐ" if isinstance(product_price, (int, float)) else str(product_price)
+        tags_str = ", ".join(product_tags[:5]) if product_tags else "Không có"
+        
+        current_product_str = f"""
+SẢN PHẨM KHÁCH ĐANG XEM:
+- Tên: {product_name}
+- Giá: {price_str}
+- Danh mục: {product_category}
+- Đặc điểm: {tags_str}
+- Mô tả: {product_desc[:200] if product_desc else 'Không có mô tả'}{visual_str}
+
+⚠️ HƯỚNG DẪN KHI KHÁCH HỎI VỀ SẢN PHẨM NÀY:
+1. NẾU CÓ ẢNH SẢN PHẨM hoặc MÔ TẢ HÌNH ẢNH:
+   - Dựa vào ảnh / mô tả hình ảnh: màu sắc chủ đạo, chủ đề, phong cách
+   - Xác định ngũ hành dựa trên những gì THẤY trong ảnh (hoặc trong mô tả hình ảnh)
+   - KHÔNG chỉ dựa vào tags, hãy mô tả chi tiết bức tranh
+
+2. NẾU CÓ HỒ SƠ PHONG THỦY:
+   - "Kết luận hợp mệnh (đã tính theo hồ sơ)" ở trên là kết luận CUỐI CÙNG: nêu đúng kết luận đó, KHÔNG tự xét lại
+   - Giải thích lý do bằng ngũ hành nêu trong kết luận, minh họa bằng màu sắc/chủ đề thấy trong ảnh
+   - Chỉ khi không có kết luận tính sẵn mới tự so ngũ hành của sản phẩm với Dụng Thần / Kỵ Thần
+   
+3. NẾU KHÔNG CÓ HỒ SƠ PHONG THỦY:
+   - Vẫn mô tả sản phẩm từ ảnh (màu sắc, phong cách, cảm xúc)
+   - Gợi ý khách tạo hồ sơ Bát Tự tại trang /bazi để được tư vấn chính xác
+   - Có thể hỏi khách về mệnh để tư vấn sơ bộ
+   
+4. NẾU KHÁCH HỎI VỀ PHỐI HỢP NỘI THẤT:
+   - Gợi ý khách sử dụng tính năng "Tư Vấn AI" tại /ai-consult
+   - Ở đó khách có thể upload ảnh căn phòng để AI phân tích chi tiết
+"""
+
+    # Lắp ráp context theo ngân sách token (kiến thức + tranh theo điểm liên quan)
+    user_text = truncate_to_tokens(user_text, MAX_QUESTION_TOKENS)
+
+    if isinstance(knowledge_context, str):
+        knowledge_docs = [{"content": knowledge_context, "score": None}] if knowledge_context else []
+    else:
+        knowledge_docs = knowledge_context or []
+
+    # Tranh có kết luận "nên tránh" (fengshui.py) không đưa vào prompt: LLM không gợi ý được tranh không thấy
+    products = [
+        p for p in products_context
+        if isinstance(p, dict) and (p.get('fengshui') or {}).get('verdict') != "avoid"
+    ] if isinstance(products_context, list) else []
+    # user_image_bytes: 1 ảnh hoặc list ảnh (nhiều góc chụp cùng 1 phòng)
+    user_images = list(user_image_bytes) if isinstance(user_image_bytes, (list, tuple)) else [user_image_bytes] if user_image_bytes else []
+    num_images = len(user_images) + int(bool(product_image_bytes))
+
+    knowledge_str, products_str, token_usage = assemble_context(
+        knowledge_docs,
+        products,
+        render_product=format_product,
+        fixed_parts={
+            "system": SYSTEM_PROMPT,
+            "template": build_prompt(""),
+            "feng_shui_profile": feng_shui_str,
+            "current_product": current_product_str,
+            "question": user_text,
+        },
+        num_images=num_images,
+        reserve_tokens=reserve_tokens,
+    )
+    
+    if products_str:
+        products_str = "DANH SÁCH TRANH GỢI Ý TỪ KHO:\n" + products_str
+
+    prompt = build_prompt(user_text, feng_shui_str, current_product_str, knowledge_str, products_str)
 
     # Payload gửi Ollama
     messages = [
         {
             "role": "system",
-            "content": "You are a helpful Vietnamese feng shui consultant. IMPORTANT: Respond DIRECTLY in Vietnamese. Do NOT show your thinking process. Do NOT use English. Just give the final answer immediately."
+            "content": SYSTEM_PROMPT
         },
         {
             "role": "user",
@@ -266,59 +551,157 @@ PHONG CÁCH TRÌNH BÀY
     images_to_send = []
     
     # Add room/space image (from /ai-consult upload)
-    if user_image_bytes:
-        images_to_send.append(user_image_bytes)
-        print("🖼️ Đã thêm ảnh căn phòng vào prompt")
+    if user_images:
+        images_to_send.extend(user_images)
+        logger.debug("🖼️ Đã thêm ảnh căn phòng vào prompt")
     
     # Add product image (from PDP context)
     if product_image_bytes:
         images_to_send.append(product_image_bytes)
-        print("🛍️ Đã thêm ảnh sản phẩm vào prompt")
+        logger.debug("🛍️ Đã thêm ảnh sản phẩm vào prompt")
     
     if images_to_send:
         messages[1]['images'] = images_to_send
 
-    # Gọi Stream
+    return messages, token_usage
+
+
+def chat_stream(user_text, user_image_bytes=None, products_context=[], knowledge_context="", feng_shui_profile=None, current_product=None, product_image_bytes=None, usage=None, priority=PRIORITY_CHAT, deadline=None, cancel=None):
+    """
+    Stream câu trả lời của LLM.
+
+    - usage: dict (tùy chọn) sẽ được điền thống kê token của request
+    - priority / deadline (time.monotonic()): dùng cho hàng đợi của llm_gateway
+    - cancel: threading.Event, set để dừng sinh và trả slot ngay
+    """
+    with stage("prompt_assembly"):
+        messages, token_usage = build_messages(
+            user_text, user_image_bytes, products_context, knowledge_context,
+            feng_shui_profile, current_product, product_image_bytes
+        )
+    if usage is not None:
+        usage.update(token_usage)
+        token_usage = usage
+
+    yield from stream_messages(messages, token_usage, priority=priority, deadline=deadline, cancel=cancel)
+
+
+def stream_messages(messages, token_usage, priority=PRIORITY_CHAT, deadline=None, cancel=None):
+    """
+    Gọi Ollama (stream) với messages đã dựng sẵn, điền số token thực tế vào token_usage.
+    Phải chờ llm_gateway cấp slot; nếu bị từ chối thì trả về ngay thông báo quá tải.
+
+    Lưu ý: hàm chặn (blocking) khi chờ slot, nên phía async phải chạy qua threadpool.
+    """
+    # Quyết định model theo tải lúc request đến (trước khi vào hàng đợi)
+    route = route_model(messages, token_usage)
+
+    queued_at = time.monotonic()
+    with llm_gateway.slot(priority, deadline, cancel) as admitted:
+        queue_wait = time.monotonic() - queued_at
+        token_usage["queue_wait"] = round(queue_wait, 3)
+        observe_stage("llm_queue_wait", queue_wait)
+        if cancel is not None and cancel.is_set():
+            token_usage["cancelled"] = True
+            return
+        if not admitted:
+            logger.info(f"🚦 LLM quá tải, từ chối request (priority={priority}, queue={llm_gateway.queue_depth})")
+            token_usage["rejected"] = True
+            yield OVERLOAD_MESSAGE
+            return
+
+        started_at = time.monotonic()
+        try:
+            yield from _stream_ollama(messages, token_usage, route, cancel)
+        finally:
+            observe_stage("llm_generate", time.monotonic() - started_at)
+
+
+def _stream_ollama(messages, token_usage, route, cancel=None):
+    model = route["model"]
+    chunk_count = 0
+    content_count = 0
     try:
-        
+        started_at = time.monotonic()
         stream = ollama.chat(
-            model=settings.LLM_MODEL_ID,
+            model=model,
             messages=messages,
             stream=True,
+            keep_alive=settings.LLM_KEEP_ALIVE,
             options={
                 "temperature": 0.7,
-                "num_ctx": 8192,
-                "num_predict": 2048,
+                "num_ctx": settings.LLM_NUM_CTX,
+                "num_predict": route["num_predict"],
             }
         )
 
-        chunk_count = 0
-        content_count = 0
         for chunk in stream:
+            # Client đã bỏ đi / gửi tin nhắn mới: đóng kết nối HTTP tới Ollama để nó dừng sinh
+            if cancel is not None and cancel.is_set():
+                stream.close()
+                token_usage["cancelled"] = True
+                logger.info(f"🛑 Đã hủy sinh câu trả lời sau {chunk_count} chunks")
+                return
+            
             chunk_count += 1
             
             message = chunk.message if hasattr(chunk, 'message') else chunk.get('message', {})
             
             content = getattr(message, 'content', '') or ''
             
+            # Chunk cuối chứa số token thực tế Ollama đã xử lý
+            if getattr(chunk, 'done', False):
+                token_usage["prompt_tokens"] = getattr(chunk, 'prompt_eval_count', None)
+                token_usage["completion_tokens"] = getattr(chunk, 'eval_count', None)
+                _record_generation(chunk, model)
+            
             if chunk_count == 1:
                 thinking = getattr(message, 'thinking', '') or ''
-                print(f"🔍 First chunk - thinking: '{thinking[:50] if thinking else 'N/A'}', content: '{content[:50] if content else 'N/A'}'")
+                logger.debug(f"🔍 First chunk - thinking: '{thinking[:50] if thinking else 'N/A'}', content: '{content[:50] if content else 'N/A'}'")
             
             if content:
                 content_count += 1
                 if content_count == 1:
-                    print(f"✅ First content chunk: {content[:100]}...")
+                    ttft = time.monotonic() - started_at
+                    LLM_TTFT_SECONDS.labels(model=model).observe(ttft)
+                    record_value("llm_ttft", round(ttft, 4))
+                    llm_gateway.record_latency(ttft)
+                    logger.debug(f"✅ First content chunk: {content[:100]}...")
                 yield content
             
         if content_count == 0:
-            print(f"⚠️ No content chunks! Total chunks: {chunk_count}")
+            logger.warning(f"⚠️ No content chunks! Total chunks: {chunk_count}")
             yield "Xin lỗi, AI không trả lời được. Vui lòng thử lại."
         else:
-            print(f"✅ Total: {chunk_count} chunks, {content_count} with content")
+            logger.info(f"✅ Total: {chunk_count} chunks, {content_count} with content")
+        
+        logger.info(f"📊 Token usage: prompt={token_usage.get('prompt_tokens')} (ước tính {token_usage.get('prompt_tokens_estimate')}/{token_usage.get('prompt_budget')}), "
+                    f"completion={token_usage.get('completion_tokens')}, sections={token_usage.get('sections')}, dropped={token_usage.get('dropped')}")
             
     except Exception as e:
-        print(f"❌ Lỗi Ollama: {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
-        yield f"Xin lỗi, hệ thống AI gặp lỗi: {str(e)}"
\ No newline at end of file
+        # Model nhỏ chưa được pull trên Ollama: trả lời bằng model chính thay vì báo lỗi
+        missing = isinstance(e, ollama.ResponseError) and e.status_code == 404
+        if missing and model != settings.LLM_MODEL_ID and content_count == 0:
+            logger.warning(f"⚠️ Ollama chưa có model {model}, chuyển sang {settings.LLM_MODEL_ID}")
+            _missing_models.add(model)
+            fallback = {**route, "model": settings.LLM_MODEL_ID, "num_predict": settings.LLM_NUM_PREDICT,
+                        "reason": f"{route['reason']}+fallback"}
+            token_usage["route"] = fallback
+            yield from _stream_ollama(messages, token_usage, fallback, cancel)
+            return
+        logger.exception(f"❌ Lỗi Ollama: {type(e).__name__}: {e}")
+        yield f"Xin lỗi, hệ thống AI gặp lỗi: {str(e)}"
+
+
+def _record_generation(chunk, model):
+    """Số liệu từ chunk cuối của Ollama: số token + tốc độ sinh (eval_duration tính bằng ns)."""
+    prompt_tokens = getattr(chunk, 'prompt_eval_count', None) or 0
+    completion_tokens = getattr(chunk, 'eval_count', None) or 0
+    eval_duration = getattr(chunk, 'eval_duration', None) or 0
+
+    LLM_TOKENS_TOTAL.labels(model=model, kind="prompt").inc(prompt_tokens)
+    LLM_TOKENS_TOTAL.labels(model=model, kind="completion").inc(completion_tokens)
+    if completion_tokens and eval_duration:
+        tokens_per_second = completion_tokens / (eval_duration / 1e9)
+        LLM_TOKENS_PER_SECOND.labels(model=model).observe(tokens_per_second)
+        record_value("llm_tokens_per_second", round(tokens_per_second, 1))
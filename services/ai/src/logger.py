@@ -0,0 +1,33 @@
+# logger.py
+# (Logging có cấp độ, không chặn: request chỉ đẩy record vào queue, 1 thread nền ghi ra stdout)
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+from .config import settings
+
+
+def _setup_logging() -> logging.Logger:
+    log_queue = queue.SimpleQueue()
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger("ai")
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(settings.LOG_LEVEL.upper())
+    root.propagate = False
+    return root
+
+
+_root_logger = _setup_logging()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger con của "ai", vd. get_logger("llm") -> "ai.llm"."""
+    return _root_logger.getChild(name)
@@ -1,13 +1,33 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Form, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from typing import Optional, List
-import base64
+import asyncio
 import json
+import threading
+import time
 import httpx
 
-from .rag_service import search_paintings_by_image, search_knowledge
-from .llm import chat_stream
+from .config import settings
+from .core import ai_models
+from .rag_service import search_paintings_by_image, search_paintings_by_images, search_paintings_by_text, search_knowledge_docs
+from .llm import chat_stream, llm_gateway, PRIORITY_CHAT, PRIORITY_BATCH
+from .answer_cache import answer_cache, context_fingerprint, replay_stream
+from .session import ChatSession
+from .images import prepare_image
+from .neighbors import neighbor_service
+from .descriptions import description_service
+from .fengshui import fengshui_ranker
+from .singleflight import Abandoned, SingleFlight, fingerprint as request_fingerprint
+from .ws_protocol import ChatEmitterV1, ChatEmitterV2, receive_v1, receive_v2
+from .logger import get_logger
+from .metrics import stage, track_request
+from . import profiling
+
+logger = get_logger("main")
 
 async def fetch_image_from_url(url: str) -> Optional[bytes]:
     """
@@ -18,23 +38,88 @@ async def fetch_image_from_url(url: str) -> Optional[bytes]:
         return None
     
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(url)
+        with stage("image_fetch"):
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.get(url)
             if response.status_code == 200:
                 content_type = response.headers.get('content-type', '')
                 if 'image' in content_type:
-                    print(f"✅ Downloaded image from {url[:50]}... ({len(response.content)} bytes)")
+                    logger.info(f"✅ Downloaded image from {url[:50]}... ({len(response.content)} bytes)")
                     return response.content
                 else:
-                    print(f"⚠️ URL is not an image: {content_type}")
+                    logger.warning(f"⚠️ URL is not an image: {content_type}")
                     return None
             else:
-                print(f"⚠️ Failed to download image: HTTP {response.status_code}")
+                logger.warning(f"⚠️ Failed to download image: HTTP {response.status_code}")
                 return None
     except Exception as e:
-        print(f"⚠️ Error downloading image: {e}")
+        logger.warning(f"⚠️ Error downloading image: {e}")
         return None
 
+_background_tasks = set()
+
+
+def spawn_background(coro):
+    """Chạy tác vụ nền sau request (giữ tham chiếu để task không bị GC giữa chừng)."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# Gộp request trùng nội dung đang chạy đồng thời (double-click, retry), xem singleflight.py
+analyze_flights = SingleFlight("analyze", settings.SINGLEFLIGHT_WINDOW)
+analyze_batch_flights = SingleFlight("analyze_batch", settings.SINGLEFLIGHT_WINDOW)
+chat_flights = SingleFlight("chat", settings.SINGLEFLIGHT_WINDOW)
+
+
+def _profile_key(feng_shui_profile: Optional[str]):
+    """Hồ sơ gửi dạng chuỗi JSON: parse lại để khác biệt khoảng trắng / thứ tự khóa không làm lệch fingerprint."""
+    try:
+        return json.loads(feng_shui_profile) if feng_shui_profile else None
+    except json.JSONDecodeError:
+        return feng_shui_profile
+
+
+async def run_coalesced(flights: SingleFlight, key: str, compute, http_request: Request):
+    """
+    Chạy compute(cancel) qua single-flight. Client ngắt kết nối chỉ rời khỏi phép tính dùng chung;
+    phép tính bị hủy khi không còn client nào chờ.
+    """
+    disconnected = threading.Event()
+    watcher = asyncio.create_task(watch_disconnect(http_request, disconnected))
+    try:
+        result, role = await flights.do(key, compute, abandon=watcher)
+    except Abandoned:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        watcher.cancel()
+    return result if role == "leader" else {**result, "coalesced": True}
+
+
+async def relay_generator(generator, cancel: threading.Event, on_token):
+    """
+    Chạy generator LLM (blocking) trong threadpool, chuyển từng token cho on_token.
+    Luôn set cờ hủy và đóng generator khi kết thúc (kể cả khi task bị hủy) để trả slot LLM ngay.
+    """
+    try:
+        async for token in iterate_in_threadpool(generator):
+            await on_token(token)
+    finally:
+        cancel.set()
+        await run_in_threadpool(generator.close)
+
+
+async def watch_disconnect(request: Request, cancel: threading.Event):
+    """Set cờ hủy khi HTTP client ngắt kết nối giữa chừng."""
+    while not cancel.is_set():
+        if await request.is_disconnected():
+            logger.info("🔌 HTTP client đã ngắt kết nối, hủy request")
+            cancel.set()
+            return
+        await asyncio.sleep(0.5)
+
+
 class FengShuiProfile(BaseModel):
     dung_than: List[str] = []      # Favorable elements (Dụng Thần)
     hy_than: List[str] = []        # Helpful elements (Hỷ Thần)
@@ -54,6 +139,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def track_http_request(request: Request, call_next):
+    """Đo thời gian từng request HTTP (trừ chính /metrics)."""
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    profile = profiling.RequestProfile(request.url.path) if profiling.should_profile(request) else None
+    with profiling.activate(profile):
+        # Nhãn theo route template (/products/{product_id}/similar) thay vì path thật;
+        # path không khớp route nào (404, quét URL) gom chung 1 nhãn để không sinh label vô hạn
+        with track_request("unmatched") as timings:
+            try:
+                response = await call_next(request)
+            finally:
+                route = request.scope.get("route")
+                if route is not None:
+                    timings["endpoint"] = route.path
+            if response.status_code >= 400:
+                timings["status"] = str(response.status_code)
+    if profile is not None:
+        await run_in_threadpool(profile.save, timings)
+        response.headers["X-Profile-Id"] = profile.id
+    return response
+
 class CurrentProduct(BaseModel):
     id: str
     name: str
@@ -73,6 +182,7 @@ class ChatRequest(BaseModel):
 # ==========================================
 @app.post("/analyze")
 async def analyze_room(
+    http_request: Request,
     file: UploadFile = File(...),
     feng_shui_profile: Optional[str] = Form(None)
 ):
@@ -81,22 +191,33 @@ async def analyze_room(
     - Input: File ảnh (Multipart/Form-data), optional feng_shui_profile JSON
     - Output: JSON chứa lời tư vấn và danh sách tranh tìm được.
     """
+    # 1. Đọc ảnh
+    image_bytes = await file.read()
+    key = request_fingerprint(image_bytes, _profile_key(feng_shui_profile))
+    return await run_coalesced(
+        analyze_flights, key, lambda cancel: _analyze_room(image_bytes, feng_shui_profile, cancel), http_request
+    )
+
+
+async def _analyze_room(image_bytes: bytes, feng_shui_profile: Optional[str], cancel: threading.Event):
+    deadline = time.monotonic() + settings.LLM_REQUEST_DEADLINE
     try:
-        # 1. Đọc ảnh
-        image_bytes = await file.read()
-        
         # 2. Parse feng shui profile if provided
         feng_shui_data = None
         if feng_shui_profile:
             try:
                 feng_shui_data = json.loads(feng_shui_profile)
-                print(f"📊 Received Feng Shui profile: Dụng Thần={feng_shui_data.get('dung_than', [])}, Kỵ Thần={feng_shui_data.get('ky_than', [])}")
+                logger.info(f"📊 Received Feng Shui profile: Dụng Thần={feng_shui_data.get('dung_than', [])}, Kỵ Thần={feng_shui_data.get('ky_than', [])}")
             except json.JSONDecodeError:
-                print("⚠️ Failed to parse feng_shui_profile JSON")
+                logger.warning("⚠️ Failed to parse feng_shui_profile JSON")
 
         # 3. Tìm tranh trong Qdrant (Visual Search)
         # Logic này nằm trong rag_service.py
-        products_found = search_paintings_by_image(image_bytes, limit=8)  # Get more products for filtering
+        # Decode 1 lần: ảnh thu nhỏ dùng chung cho SigLIP và LLM
+        prepared = await run_in_threadpool(prepare_image, image_bytes)
+        products_found = await run_in_threadpool(search_paintings_by_image, prepared.image, limit=8) if prepared else []  # Get more products for filtering
+        # Xếp hạng hợp mệnh tính sẵn (tất định), LLM chỉ giải thích
+        products_found = fengshui_ranker.rerank(products_found, feng_shui_data)
 
         if not products_found:
             return {
@@ -107,34 +228,130 @@ async def analyze_room(
 
         # 4. Gọi LLM tư vấn (Non-stream)
         # Chúng ta dùng lại hàm chat_stream nhưng gom lại thành 1 chuỗi
-        print("🤖 AI đang phân tích ảnh...")
+        logger.info("🤖 AI đang phân tích ảnh...")
         
         prompt_trigger = "Hãy phân tích căn phòng trong ảnh và gợi ý tranh phù hợp từ danh sách."
         
+        usage = {}
         generator = chat_stream(
             user_text=prompt_trigger,
-            user_image_bytes=image_bytes,
+            user_image_bytes=prepared.llm_bytes,
             products_context=products_found,
-            feng_shui_profile=feng_shui_data
+            feng_shui_profile=feng_shui_data,
+            usage=usage,
+            priority=PRIORITY_BATCH,
+            deadline=deadline,
+            cancel=cancel
         )
         
         full_advice = ""
         chunk_count = 0
-        for chunk in generator:
+
+        async def collect(chunk):
+            nonlocal full_advice, chunk_count
             chunk_count += 1
             full_advice += chunk
             if chunk_count % 100 == 0:  # Log mỗi 100 chunks
-                print(f"📝 Accumulated {chunk_count} chunks, length: {len(full_advice)}")
+                logger.debug(f"📝 Accumulated {chunk_count} chunks, length: {len(full_advice)}")
+
+        # Chạy generator trong threadpool: chờ slot LLM không được chặn event loop
+        await relay_generator(generator, cancel, collect)
         
-        print(f"✅ Final analysis length: {len(full_advice)} chars from {chunk_count} chunks")
+        logger.info(f"✅ Final analysis length: {len(full_advice)} chars from {chunk_count} chunks")
 
         return {
             "products": products_found,
-            "analysis": full_advice
+            "analysis": full_advice,
+            "usage": usage
         }
 
     except Exception as e:
-        print(f"❌ Error: {e}")
+        logger.error(f"❌ Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/analyze/batch")
+async def analyze_room_batch(
+    http_request: Request,
+    files: List[UploadFile] = File(...),
+    feng_shui_profile: Optional[str] = Form(None),
+    fusion: Optional[str] = Form(None),
+    limit: int = Form(8),
+    advise: bool = Form(True)
+):
+    """
+    Nhiều ảnh chụp cùng 1 căn phòng (nhiều góc) trong 1 request:
+    - 1 lượt SigLIP cho cả batch + 1 lượt batch query, gộp kết quả (rrf / centroid)
+    - advise=True: thêm 1 lần gọi LLM duy nhất cho cả bộ ảnh
+    """
+    if not files or len(files) > settings.BATCH_SEARCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Cần 1-{settings.BATCH_SEARCH_MAX_IMAGES} ảnh")
+    if fusion and fusion not in ("rrf", "centroid"):
+        raise HTTPException(status_code=400, detail="fusion phải là 'rrf' hoặc 'centroid'")
+
+    raw_images = [await f.read() for f in files]
+    key = request_fingerprint(*raw_images, _profile_key(feng_shui_profile), fusion, limit, advise)
+    return await run_coalesced(
+        analyze_batch_flights, key,
+        lambda cancel: _analyze_room_batch(raw_images, feng_shui_profile, fusion, limit, advise, cancel),
+        http_request,
+    )
+
+
+async def _analyze_room_batch(raw_images, feng_shui_profile, fusion, limit, advise, cancel: threading.Event):
+    deadline = time.monotonic() + settings.LLM_REQUEST_DEADLINE
+    try:
+        feng_shui_data = None
+        if feng_shui_profile:
+            try:
+                feng_shui_data = json.loads(feng_shui_profile)
+            except json.JSONDecodeError:
+                logger.warning("⚠️ Failed to parse feng_shui_profile JSON")
+
+        # Decode mỗi ảnh 1 lần (dùng chung cho SigLIP và LLM)
+        prepared = [p for p in await run_in_threadpool(lambda: [prepare_image(raw) for raw in raw_images]) if p]
+        if not prepared:
+            raise HTTPException(status_code=400, detail="Không đọc được ảnh nào")
+
+        products_found = await run_in_threadpool(
+            search_paintings_by_images, [p.image for p in prepared], max(1, min(limit, 50)), fusion
+        )
+        products_found = fengshui_ranker.rerank(products_found, feng_shui_data)
+        logger.info(f"🖼️ Batch {len(prepared)}/{len(raw_images)} ảnh -> {len(products_found)} tranh ({fusion or settings.BATCH_SEARCH_FUSION})")
+
+        if not products_found or not advise:
+            return {"images": len(prepared), "products": products_found, "analysis": None}
+
+        # 1 lần gọi LLM cho cả bộ ảnh (chỉ gửi kèm vài ảnh đầu để giữ ngân sách token)
+        llm_images = [p.llm_bytes for p in prepared[:settings.BATCH_LLM_IMAGES]]
+        prompt_trigger = (
+            f"Đây là {len(prepared)} ảnh chụp cùng 1 căn phòng từ nhiều góc (gửi kèm {len(llm_images)} ảnh). "
+            "Hãy phân tích căn phòng và gợi ý tranh phù hợp từ danh sách."
+        )
+        usage = {}
+        generator = chat_stream(
+            user_text=prompt_trigger,
+            user_image_bytes=llm_images,
+            products_context=products_found,
+            feng_shui_profile=feng_shui_data,
+            usage=usage,
+            priority=PRIORITY_BATCH,
+            deadline=deadline,
+            cancel=cancel
+        )
+        full_advice = ""
+
+        async def collect(chunk):
+            nonlocal full_advice
+            full_advice += chunk
+
+        await relay_generator(generator, cancel, collect)
+        return {"images": len(prepared), "products": products_found, "analysis": full_advice, "usage": usage}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -142,12 +359,18 @@ async def analyze_room(
 # 2. API TEST CHAT TEXT (Text RAG)
 # ==========================================
 @app.post("/api/chat")
-async def chat_http(request: ChatRequest):
+async def chat_http(request: ChatRequest, http_request: Request):
     """
     Endpoint này dùng để Test tính năng Hỏi đáp phong thủy (RAG).
     - Input: JSON { "text": "Mệnh kim hợp màu gì?", "feng_shui_profile": {...}, "current_product": {...} }
     - Output: JSON câu trả lời.
     """
+    key = request_fingerprint(request.model_dump())
+    return await run_coalesced(chat_flights, key, lambda cancel: _answer_chat(request, cancel), http_request)
+
+
+async def _answer_chat(request: ChatRequest, cancel: threading.Event):
+    deadline = time.monotonic() + settings.LLM_REQUEST_DEADLINE
     try:
         user_text = request.text
         feng_shui_data = request.feng_shui_profile.model_dump() if request.feng_shui_profile else None
@@ -158,39 +381,85 @@ async def chat_http(request: ChatRequest):
         
         if request.current_product:
             current_product_data = request.current_product.model_dump()
-            print(f"🛍️ Sản phẩm đang xem: {current_product_data.get('name')}")
-            
-            # Fetch product image if available
+            logger.info(f"🛍️ Sản phẩm đang xem: {current_product_data.get('name')}")
+        
+        # 0. Semantic cache: câu hỏi tương tự với cùng hồ sơ + sản phẩm -> trả lại câu trả lời cũ
+        query_vector = await run_in_threadpool(ai_models.get_text_embedding, user_text) if settings.ANSWER_CACHE_ENABLED else None
+        fingerprint = context_fingerprint(feng_shui_data, current_product_data)
+        cached_answer = answer_cache.lookup(query_vector, fingerprint)
+        if cached_answer:
+            return {
+                "question": user_text,
+                "context_found": cached_answer.meta.get("context_found", False),
+                "has_feng_shui_profile": feng_shui_data is not None,
+                "has_current_product": current_product_data is not None,
+                "has_product_image": False,
+                "answer": "".join(replay_stream(cached_answer.answer)),
+                "cached": True
+            }
+        
+        if current_product_data:
             image_url = current_product_data.get('imageUrl')
-            if image_url:
-                print(f"🖼️ Đang tải ảnh sản phẩm từ: {image_url[:50]}...")
-                product_image_bytes = await fetch_image_from_url(image_url)
+            # Đã có mô tả hình ảnh của tranh -> gửi text, không cần tải ảnh / prefill ảnh
+            description = description_service.lookup(image_url)
+            if description:
+                current_product_data['visual_description'] = description
+                logger.info("📝 Dùng mô tả hình ảnh đã lưu thay cho ảnh sản phẩm")
+            # Fetch product image if available
+            elif image_url:
+                logger.info(f"🖼️ Đang tải ảnh sản phẩm từ: {image_url[:50]}...")
+                raw_image = await fetch_image_from_url(image_url)
+                prepared = await run_in_threadpool(prepare_image, raw_image) if raw_image else None
+                product_image_bytes = prepared.llm_bytes if prepared else None
                 if product_image_bytes:
-                    print(f"✅ Đã tải ảnh sản phẩm ({len(product_image_bytes)} bytes)")
+                    logger.info(f"✅ Đã tải ảnh sản phẩm ({len(product_image_bytes)} bytes)")
+                    # Sinh mô tả nền cho các lượt sau (ưu tiên thấp, không chặn request này)
+                    if description_service.claim(image_url):
+                        spawn_background(run_in_threadpool(description_service.generate, image_url, product_image_bytes))
                 else:
-                    print(f"⚠️ Không thể tải ảnh sản phẩm")
+                    logger.warning(f"⚠️ Không thể tải ảnh sản phẩm")
         
         if feng_shui_data:
-            print(f"📊 Hồ sơ bát tự: Dụng Thần={feng_shui_data.get('dung_than', [])}")
+            logger.info(f"📊 Hồ sơ bát tự: Dụng Thần={feng_shui_data.get('dung_than', [])}")
+            if current_product_data:
+                try:
+                    current_product_data['fengshui'] = await run_in_threadpool(fengshui_ranker.evaluate, current_product_data, feng_shui_data)
+                except Exception as e:
+                    logger.warning(f"⚠️ Lỗi chấm hợp mệnh sản phẩm: {e}")
         
         # 1. Tìm kiến thức phong thủy (Text RAG)
         # Logic nằm trong rag_service.py (VietnamEmbedding + PhoRanker)
-        knowledge_found = search_knowledge(user_text)
+        knowledge_found = await run_in_threadpool(search_knowledge_docs, user_text, query_vector=query_vector)
+        if cancel.is_set():
+            raise HTTPException(status_code=499, detail="Client disconnected")
         
         # 2. Gọi LLM trả lời (Non-stream)
-        print(f"🤖 AI đang suy nghĩ câu hỏi: {user_text}")
+        logger.info(f"🤖 AI đang suy nghĩ câu hỏi: {user_text}")
         
+        usage = {}
         generator = chat_stream(
             user_text=user_text,
             knowledge_context=knowledge_found,
             feng_shui_profile=feng_shui_data,
             current_product=current_product_data,
-            product_image_bytes=product_image_bytes
+            product_image_bytes=product_image_bytes,
+            usage=usage,
+            priority=PRIORITY_CHAT,
+            deadline=deadline,
+            cancel=cancel
         )
         
         full_response = ""
-        for chunk in generator:
+
+        async def collect(chunk):
+            nonlocal full_response
             full_response += chunk
+
+        await relay_generator(generator, cancel, collect)
+        
+        # Chỉ cache khi LLM trả lời thành công (không cache thông báo lỗi)
+        if usage.get("completion_tokens"):
+            answer_cache.store(query_vector, fingerprint, full_response, {"context_found": bool(knowledge_found)})
             
         return {
             "question": user_text,
@@ -198,67 +467,266 @@ async def chat_http(request: ChatRequest):
             "has_feng_shui_profile": feng_shui_data is not None,
             "has_current_product": current_product_data is not None,
             "has_product_image": product_image_bytes is not None,
-            "answer": full_response
+            "has_product_description": bool(current_product_data and current_product_data.get('visual_description')),
+            "answer": full_response,
+            "usage": usage,
+            "cached": False
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Error: {e}")
+        logger.error(f"❌ Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class FengShuiRankRequest(BaseModel):
+    feng_shui_profile: FengShuiProfile
+    limit: int = 20
+    category: Optional[str] = None
+    exclude_avoid: bool = True     # Bỏ tranh thuộc Kỵ / Hung Thần
+
+
+@app.post("/fengshui/rank")
+async def rank_by_fengshui(request: FengShuiRankRequest):
+    """Danh sách tranh hợp mệnh (xếp hạng tất định theo hồ sơ, không cần LLM)."""
+    start = time.perf_counter()
+    try:
+        products, total = await run_in_threadpool(
+            fengshui_ranker.rank_catalog,
+            request.feng_shui_profile.model_dump(),
+            max(1, min(request.limit, 100)),
+            request.category,
+            request.exclude_avoid,
+        )
+    except Exception as e:
+        logger.error(f"❌ Lỗi xếp hạng hợp mệnh: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "products": products,
+        "total": total,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
+class PaintingSearchRequest(BaseModel):
+    query: str
+    limit: int = 12
+    category: Optional[str] = None
+    tags: Optional[List[str]] = None          # Khớp bất kỳ tag nào
+    element: Optional[str] = None             # Ngũ hành chính theo ảnh (element_primary)
+    feng_shui_profile: Optional[FengShuiProfile] = None   # Có thì sắp lại theo độ hợp mệnh
+
+
+@app.post("/search/paintings")
+async def search_paintings_text(request: PaintingSearchRequest):
+    """Tìm tranh bằng câu mô tả (SigLIP text encoder; câu tiếng Việt dịch qua từ điển, TEXT_SEARCH_LLM_TRANSLATE thì nhờ LLM khi từ điển không đủ)."""
+    filters = {
+        field: value
+        for field, value in (("category", request.category), ("tags", request.tags), ("element_primary", request.element))
+        if value
+    }
+    products = await run_in_threadpool(
+        search_paintings_by_text, request.query, max(1, min(request.limit, 100)), filters or None
+    )
+    if request.feng_shui_profile:
+        products = fengshui_ranker.rerank(products, request.feng_shui_profile.model_dump())
+    return {"query": request.query, "products": products}
+
+
+@app.get("/products/{product_id}/similar")
+async def similar_paintings(product_id: str, limit: int = 8):
+    """Tranh tương tự (đồ thị láng giềng tính sẵn sau khi index, xem neighbors.py)."""
+    similar = neighbor_service.similar(product_id, max(1, min(limit, settings.NEIGHBORS_TOP_N)))
+    if similar is None:
+        raise HTTPException(status_code=404, detail="Product not found in similarity index")
+    return {"product_id": product_id, "similar": similar}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+    """Trạng thái hàng đợi LLM, semantic cache và single-flight."""
+    return {
+        "gateway": llm_gateway.stats(),
+        "answer_cache": answer_cache.stats(),
+        "singleflight": {f.name: f.stats() for f in (analyze_flights, analyze_batch_flights, chat_flights)}
+    }
+
+
+@app.get("/models/stats")
+async def models_stats():
+    """Model nào đang nằm trên thiết bị, dung lượng, thời gian rảnh và thời gian nạp gần nhất."""
+    return await run_in_threadpool(ai_models.residency_stats)
+
+
+@app.get("/admin/profiles")
+async def list_profiles(http_request: Request):
+    """Danh sách profile đã lưu (cần header X-Admin-Token)."""
+    if not profiling.is_admin(http_request.headers):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return {"profiles": await run_in_threadpool(profiling.list_profiles)}
+
+
+@app.get("/admin/profiles/{profile_id}/{filename}")
+async def download_profile(profile_id: str, filename: str, http_request: Request):
+    """Tải artifact: summary.json, profile.pstats, profile.txt, torch_*.json"""
+    if not profiling.is_admin(http_request.headers):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    path = profiling.artifact_path(profile_id, filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=filename)
+
+
 # ==========================================
-# 3. WEBSOCKET (Chat Real-time - Giữ nguyên)
+# 3. WEBSOCKET (Chat Real-time)
 # ==========================================
-@app.websocket("/ws/chat")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    print("🔌 Client Connected via WebSocket")
+async def _handle_ws_message(emitter, session: ChatSession, message: dict, cancel: threading.Event, profile=None):
+    """Xử lý 1 tin nhắn, đo thời gian (và profile nếu được bật) như 1 request riêng."""
+    with profiling.activate(profile):
+        with track_request("ws_chat") as timings:
+            try:
+                await _answer_ws_message(emitter, session, message, cancel)
+            except asyncio.CancelledError:
+                timings["status"] = "cancelled"
+                raise
+    if profile is not None:
+        await run_in_threadpool(profile.save, timings)
+
+
+async def _answer_ws_message(emitter, session: ChatSession, message: dict, cancel: threading.Event):
+    """Xử lý 1 tin nhắn: { "text", "image_bytes", "feng_shui_profile" } (đã được receiver giải mã)"""
+    emitter.reset()
+    user_text = message.get("text", "")
+    user_image_bytes = message.get("image_bytes")
+    prepared = await run_in_threadpool(prepare_image, user_image_bytes) if user_image_bytes else None
+
+    feng_shui_data = message.get("feng_shui_profile")
+    query_vector = await run_in_threadpool(ai_models.get_text_embedding, user_text) if user_text else None
+
+    # Semantic cache (chỉ áp dụng cho lượt đầu, không kèm ảnh)
+    fingerprint = context_fingerprint(feng_shui_data)
+    use_cache = session.is_fresh and query_vector and not user_image_bytes and settings.ANSWER_CACHE_ENABLED
+    if use_cache:
+        cached_answer = answer_cache.lookup(query_vector, fingerprint)
+        if cached_answer:
+            for token in replay_stream(cached_answer.answer):
+                await emitter.token(token)
+            await emitter.done(cached=True)
+            return
+
+    usage = {}
+    if session.needs_retrieval(user_text, query_vector, user_image_bytes, feng_shui_data):
+        # --- PHASE 1: TÌM KIẾM DỮ LIỆU (chạy song song, bị hủy cùng tin nhắn) ---
+        products_task = run_in_threadpool(search_paintings_by_image, prepared.image, limit=8) if prepared else asyncio.sleep(0, result=[])
+        knowledge_task = run_in_threadpool(search_knowledge_docs, user_text, query_vector=query_vector) if user_text else asyncio.sleep(0, result=[])
+        products_found, knowledge_found = await asyncio.gather(products_task, knowledge_task)
+        products_found = fengshui_ranker.rerank(products_found, feng_shui_data)
+        
+        if products_found:
+            await emitter.products(products_found)
+
+        # --- PHASE 2: TRẢ LỜI STREAM ---
+        generator = session.start_context(
+            user_text,
+            prepared.llm_bytes if prepared else None,
+            products_found,
+            knowledge_found,
+            feng_shui_data,
+            query_vector=query_vector,
+            usage=usage,
+            cancel=cancel
+        )
+    else:
+        # Câu hỏi nối tiếp: dùng lại tranh + kiến thức và prompt của lượt trước
+        logger.info("♻️ Câu hỏi nối tiếp, dùng lại context của phiên")
+        generator = session.follow_up(user_text, usage=usage, cancel=cancel)
     
+    full_response = ""
+
+    async def send_token(token):
+        nonlocal full_response
+        full_response += token
+        await emitter.token(token)
+
+    answered = False
     try:
-        while True:
-            # Nhận JSON: { "text": "...", "image": "base64..." }
-            data = await websocket.receive_json()
-            
-            user_text = data.get("text", "")
-            image_b64 = data.get("image")
-            
-            # Decode ảnh Base64
-            user_image_bytes = None
-            if image_b64:
-                if "," in image_b64: image_b64 = image_b64.split(",")[1]
-                user_image_bytes = base64.b64decode(image_b64)
-
-            # --- PHASE 1: TÌM KIẾM DỮ LIỆU ---
-            products_found = []
-            knowledge_found = ""
-            feng_shui_data = data.get("feng_shui_profile")
-
-            if user_image_bytes:
-                products_found = search_paintings_by_image(user_image_bytes, limit=8)
-            
-            if user_text:
-                knowledge_found = search_knowledge(user_text)
+        await relay_generator(generator, cancel, send_token)
+        if usage.get("cancelled"):
+            return
+        await emitter.done(usage=usage)
+        answered = True
+        session.record_answer(full_response)
+    finally:
+        # Bị thay bởi tin nhắn mới (task bị hủy) hoặc ngắt giữa chừng: không để câu hỏi chưa trả lời trong phiên
+        if not answered:
+            session.discard_turn()
+    # Tóm tắt lịch sử bằng LLM chạy nền (slot ưu tiên thấp), tin nhắn tiếp theo không phải chờ
+    summary_job = session.take_summary_job()
+    if summary_job:
+        spawn_background(run_in_threadpool(session.run_summary_job, summary_job))
+    if use_cache and usage.get("completion_tokens"):
+        answer_cache.store(query_vector, fingerprint, full_response)
+
+
+async def _serve_chat(websocket: WebSocket, emitter, inbox: asyncio.Queue, receiver: asyncio.Task):
+    """
+    Vòng xử lý chung cho mọi protocol: mỗi tin nhắn là 1 task; tin nhắn mới hoặc ngắt kết nối
+    đến khi đang trả lời sẽ hủy lượt hiện tại và trả slot LLM ngay.
+    """
+    session = ChatSession()
+    try:
+        message = await inbox.get()
+        while message is not None:
+            cancel = threading.Event()
+            profile = profiling.RequestProfile("ws_chat") if profiling.should_profile(websocket) else None
+            turn = asyncio.create_task(_handle_ws_message(emitter, session, message, cancel, profile))
+            next_message = asyncio.create_task(inbox.get())
             
-            if products_found:
-                await websocket.send_json({
-                    "type": "products",
-                    "data": products_found
-                })
-
-            # --- PHASE 2: TRẢ LỜI STREAM ---
-            generator = chat_stream(
-                user_text,
-                user_image_bytes,
-                products_found,
-                knowledge_found,
-                feng_shui_profile=feng_shui_data
-            )
+            done, _ = await asyncio.wait({turn, next_message}, return_when=asyncio.FIRST_COMPLETED)
+            superseded = turn not in done
+            if superseded:
+                logger.info("🛑 Tin nhắn mới / ngắt kết nối, hủy câu trả lời đang sinh")
+                cancel.set()
+                turn.cancel()
+            results = await asyncio.gather(turn, return_exceptions=True)
+            if isinstance(results[0], Exception) and not isinstance(results[0], WebSocketDisconnect):
+                logger.error(f"❌ Error: {results[0]}")
             
-            for token in generator:
-                await websocket.send_text(token)
-                
-    except WebSocketDisconnect:
-        print("👋 Client Disconnected")
-    except Exception as e:
-        print(f"❌ Error: {e}")
-        await websocket.close()
\ No newline at end of file
+            message = await next_message
+            if superseded and message is not None:
+                # Client còn kết nối: báo stream của lượt cũ đã dừng trước khi bắt đầu lượt mới
+                await emitter.cancelled()
+    finally:
+        receiver.cancel()
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+
+@app.websocket("/ws/chat")
+async def websocket_endpoint(websocket: WebSocket):
+    """Protocol v1 (client cũ): JSON + ảnh base64, mỗi token 1 text frame."""
+    await websocket.accept()
+    logger.info("🔌 Client Connected via WebSocket")
+    inbox = asyncio.Queue()
+    receiver = asyncio.create_task(receive_v1(websocket, inbox))
+    await _serve_chat(websocket, ChatEmitterV1(websocket), inbox, receiver)
+
+
+@app.websocket("/ws/chat/v2")
+async def websocket_endpoint_v2(websocket: WebSocket):
+    """Protocol v2: ảnh gửi dạng binary frame, token được gom thành event 'delta' (xem ws_protocol.py)."""
+    await websocket.accept()
+    logger.info("🔌 Client Connected via WebSocket (v2)")
+    emitter = ChatEmitterV2(websocket)
+    inbox = asyncio.Queue()
+    receiver = asyncio.create_task(receive_v2(websocket, inbox, emitter))
+    await _serve_chat(websocket, emitter, inbox, receiver)
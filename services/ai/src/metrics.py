@@ -0,0 +1,101 @@
+# metrics.py
+# (Đo thời gian từng bước của pipeline + Prometheus metrics cho endpoint /metrics)
+import contextvars
+import json
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+from .logger import get_logger
+from .profiling import profile_section
+
+logger = get_logger("metrics")
+
+# Bucket chung cho các bước từ vài ms (Qdrant) tới vài chục giây (LLM)
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+REQUEST_SECONDS = Histogram("ai_request_seconds", "Tổng thời gian xử lý request", ["endpoint"], buckets=_BUCKETS)
+REQUESTS_TOTAL = Counter("ai_requests_total", "Số request", ["endpoint", "status"])
+STAGE_SECONDS = Histogram("ai_stage_seconds", "Thời gian từng bước của pipeline", ["stage"], buckets=_BUCKETS)
+
+LLM_TTFT_SECONDS = Histogram("ai_llm_time_to_first_token_seconds", "Thời gian tới token đầu tiên", ["model"], buckets=_BUCKETS)
+LLM_TOKENS_PER_SECOND = Histogram("ai_llm_tokens_per_second", "Tốc độ sinh token", ["model"],
+                                  buckets=(1, 2.5, 5, 10, 20, 40, 80, 160))
+LLM_TOKENS_TOTAL = Counter("ai_llm_tokens_total", "Số token đã xử lý", ["model", "kind"])
+LLM_QUEUE_DEPTH = Gauge("ai_llm_queue_depth", "Số request đang chờ slot LLM")
+LLM_ACTIVE = Gauge("ai_llm_active", "Số stream LLM đang chạy")
+LLM_REJECTED_TOTAL = Counter("ai_llm_rejected_total", "Số request LLM bị từ chối", ["reason"])
+ANSWER_CACHE_TOTAL = Counter("ai_answer_cache_total", "Kết quả tra semantic cache", ["result"])
+RERANK_DECISIONS_TOTAL = Counter("ai_rerank_decisions_total", "Rerank thích ứng: bỏ qua / chạy", ["decision"])
+SINGLEFLIGHT_TOTAL = Counter("ai_singleflight_total", "Request theo vai trò single-flight (leader / follower / late)", ["endpoint", "role"])
+QUERY_EMBEDDING_CACHE_TOTAL = Counter("ai_query_embedding_cache_total", "Cache vector câu tìm tranh bằng chữ", ["result"])
+QUERY_TRANSLATIONS_TOTAL = Counter("ai_query_translations_total", "Cách đổi câu tìm tranh sang tiếng Anh cho SigLIP", ["method"])
+MODEL_LOAD_SECONDS = Histogram("ai_model_load_seconds", "Thời gian nạp model lên thiết bị (gồm warmup)", ["model", "source"], buckets=_BUCKETS)
+MODEL_RESIDENT_BYTES = Gauge("ai_model_resident_bytes", "Dung lượng model đang nằm trên thiết bị (0 = đã offload / giải phóng)", ["model"])
+MODEL_EVICTIONS_TOTAL = Counter("ai_model_evictions_total", "Số lần offload / giải phóng model", ["model", "reason"])
+RERANK_CANDIDATES = Histogram("ai_rerank_candidates", "Số candidate được rerank", buckets=(1, 2, 4, 6, 8, 10, 15, 20, 30))
+
+# Thời gian các bước của request hiện tại (contextvar được copy sang threadpool nên
+# các bước chạy trong run_in_threadpool vẫn ghi vào đúng request)
+_current_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_SECONDS.labels(stage=name).observe(seconds)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + seconds, 4)
+
+
+@contextmanager
+def stage(name: str):
+    """with stage("embedding"): ... -> ghi vào histogram + timings của request."""
+    with profile_section(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            observe_stage(name, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_timings():
+    """Gom timings các bước vào 1 dict riêng (vd. model_server gửi kèm kết quả về worker)."""
+    timings = {}
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+def record_value(name: str, value):
+    """Ghi thêm giá trị (không phải thời gian) vào timings của request, vd. tokens/sec."""
+    timings = _current_timings.get()
+    if timings is not None:
+        timings[name] = value
+
+
+@contextmanager
+def track_request(endpoint: str):
+    """
+    Bao quanh 1 request (HTTP hoặc 1 tin nhắn websocket): đo tổng thời gian, đếm trạng thái
+    và ghi 1 dòng log có cấu trúc với thời gian từng bước.
+    timings["endpoint"] (nếu được gán trong lúc xử lý) thay cho nhãn endpoint ban đầu.
+    """
+    timings = {}
+    token = _current_timings.set(timings)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield timings
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        total = time.perf_counter() - start
+        _current_timings.reset(token)
+        endpoint = timings.pop("endpoint", endpoint)
+        REQUEST_SECONDS.labels(endpoint=endpoint).observe(total)
+        REQUESTS_TOTAL.labels(endpoint=endpoint, status=timings.pop("status", status)).inc()
+        timings["total"] = round(total, 4)
+        logger.info("request_timings %s", json.dumps({"endpoint": endpoint, **timings}, ensure_ascii=False))
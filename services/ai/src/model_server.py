@@ -0,0 +1,238 @@
+# model_server.py
+# (Chạy nhiều worker HTTP mà chỉ nạp model 1 lần: SigLIP / bi-encoder / PhoRanker nằm trong 1 process riêng)
+#
+# Mỗi worker uvicorn import core.py sẽ nạp 1 bản trọng số riêng -> bộ nhớ nhân theo số worker.
+# Ở chế độ này process model_server giữ bản duy nhất, các worker gọi sang qua Unix socket
+# (ai_models trong core.py là RemoteAIModels, cùng các hàm như AIModels):
+#
+#   python -m src.model_server                       # 1 process / node, mở socket khi model đã sẵn sàng
+#   MODEL_SERVER_SOCKET=/tmp/ai-models.sock WEB_CONCURRENCY=4 uvicorn src.main:app
+#
+# WEB_CONCURRENCY (uvicorn dùng làm số worker) còn để chia LLM_MAX_CONCURRENCY / LLM_MAX_QUEUE cho từng
+# worker (llm.worker_share) -> Ollama không nhận quá LLM_MAX_CONCURRENCY stream. Trạng thái còn lại vẫn riêng
+# từng worker: answer cache, single-flight (request trùng chỉ được gộp khi vào cùng worker), EWMA độ trễ.
+#
+# Giao thức: mỗi frame = 4 byte độ dài (big-endian) + pickle.
+#   request  (method, args, kwargs)
+#   response (ok, kết quả | thông báo lỗi, timings các bước phía model server)
+# pickle chỉ an toàn giữa các process tin cậy -> socket chỉ mở cho cùng user / group (chmod 660).
+import argparse
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+import time
+from .config import settings
+from .logger import get_logger
+from .metrics import collect_timings, observe_stage, stage
+
+logger = get_logger("model_server")
+
+# Các hàm của AIModels được phép gọi từ worker
+REMOTE_METHODS = (
+    "get_image_embeddings", "get_vision_text_embedding", "vision_logit_params",
+    "get_text_embedding", "rerank_docs", "residency_stats",
+)
+
+_HEADER = struct.Struct(">I")
+
+
+class ModelServerError(RuntimeError):
+    """Không gọi được model server (chưa chạy, mất kết nối, hết thời gian)."""
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    chunks, remaining = [], size
+    while remaining:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Kết nối model server bị đóng")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_frame(sock, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock):
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return pickle.loads(_recv_exact(sock, size))
+
+
+# --- Phía server ---
+
+class _Handler(socketserver.BaseRequestHandler):
+    """1 kết nối = 1 thread, nhận nhiều lời gọi nối tiếp (mỗi thread của worker giữ 1 kết nối)."""
+
+    def handle(self):
+        models = self.server.models
+        while True:
+            try:
+                method, args, kwargs = recv_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            if method == "ping":
+                send_frame(self.request, (True, {"pid": os.getpid(), "uptime": round(time.time() - self.server.started_at, 1)}, {}))
+                continue
+            if method not in REMOTE_METHODS:
+                send_frame(self.request, (False, f"Hàm không hỗ trợ: {method}", {}))
+                continue
+            # stage() bên trong AIModels ghi vào timings này, gửi về worker để gộp vào request đang xử lý
+            with collect_timings() as timings:
+                try:
+                    response = (True, getattr(models, method)(*args, **kwargs), timings)
+                except Exception as e:
+                    logger.error(f"❌ Lỗi {method}: {e}")
+                    response = (False, f"{type(e).__name__}: {e}", timings)
+            try:
+                send_frame(self.request, response)
+            except OSError:
+                return
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path: str):
+    # Import ở đây: core import lại module này khi chạy ở chế độ worker
+    from . import core
+    models = core.ai_models if isinstance(core.ai_models, core.AIModels) else core.AIModels()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)   # Socket cũ của lần chạy trước
+    server = _Server(socket_path, _Handler)
+    os.chmod(socket_path, 0o660)
+    server.models = models
+    server.started_at = time.time()
+    logger.info(f"🔌 Model server sẵn sàng tại {socket_path} (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+# --- Phía worker ---
+
+class RemoteAIModels:
+    """
+    Thay thế AIModels trong worker HTTP: cùng hàm, cùng giá trị trả về khi lỗi,
+    nhưng tính toán ở model server. Mỗi thread (threadpool của FastAPI) giữ 1 kết nối riêng.
+    """
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._local = threading.local()
+        self._logit_params = None
+        self._ready = False   # Đã kết nối được ít nhất 1 lần
+
+    def _connect(self):
+        # Lần đầu model server có thể còn đang nạp model (socket chỉ mở khi đã sẵn sàng) -> chờ tối đa CONNECT_TIMEOUT.
+        # Sau đó mất kết nối nghĩa là server chết / khởi động lại: báo lỗi nhanh thay vì giữ request hàng phút
+        timeout = settings.MODEL_SERVER_RECONNECT_TIMEOUT if self._ready else settings.MODEL_SERVER_CONNECT_TIMEOUT
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(settings.MODEL_SERVER_TIMEOUT)
+            try:
+                sock.connect(self.socket_path)
+                self._ready = True
+                return sock
+            except OSError as e:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise ModelServerError(f"Không kết nối được model server {self.socket_path}: {e}") from e
+                time.sleep(0.5)
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def _call(self, method, *args, **kwargs):
+        with stage("model_rpc"):
+            # Thử lại 1 lần với kết nối mới (model server vừa khởi động lại)
+            for attempt in range(2):
+                try:
+                    if getattr(self._local, "sock", None) is None:
+                        self._local.sock = self._connect()
+                    send_frame(self._local.sock, (method, args, kwargs))
+                    ok, result, timings = recv_frame(self._local.sock)
+                    break
+                except (ConnectionError, OSError, EOFError, pickle.UnpicklingError) as e:
+                    self._close()
+                    if attempt == 1:
+                        raise ModelServerError(f"Lỗi gọi model server ({method}): {e}") from e
+        for name, seconds in timings.items():
+            observe_stage(name, seconds)
+        if not ok:
+            raise ModelServerError(result)
+        return result
+
+    def ping(self):
+        return self._call("ping")
+
+    def residency_stats(self):
+        return {**self._call("residency_stats"), "model_server": self.socket_path}
+
+    def get_image_embedding(self, image_source):
+        return self.get_image_embeddings([image_source])[0]
+
+    def get_image_embeddings(self, image_sources):
+        image_sources = list(image_sources)
+        try:
+            return self._call("get_image_embeddings", image_sources)
+        except ModelServerError as e:
+            logger.warning(f"⚠️ Lỗi Embed ảnh (model server): {e}")
+            return [None] * len(image_sources)
+
+    def get_vision_text_embedding(self, texts):
+        try:
+            return self._call("get_vision_text_embedding", texts)
+        except ModelServerError as e:
+            logger.error(f"❌ Lỗi SigLIP Text Embed (model server): {e}")
+            return None
+
+    def vision_logit_params(self):
+        if self._logit_params is None:
+            self._logit_params = tuple(self._call("vision_logit_params"))
+        return self._logit_params
+
+    def get_text_embedding(self, text):
+        try:
+            return self._call("get_text_embedding", text)
+        except ModelServerError as e:
+            logger.error(f"❌ Lỗi Text Embed (model server): {e}")
+            return None
+
+    def rerank_docs(self, query: str, docs: list[str], top_k=3, return_scores=False):
+        if not docs: return []
+        try:
+            return self._call("rerank_docs", query, docs, top_k=top_k, return_scores=return_scores)
+        except ModelServerError as e:
+            logger.error(f"❌ Lỗi Rerank (model server): {e}")
+            if return_scores:
+                return [(doc, None) for doc in docs[:top_k]]
+            return docs[:top_k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process giữ model AI dùng chung cho các worker HTTP")
+    parser.add_argument("--socket", default=settings.MODEL_SERVER_SOCKET or "/tmp/ai-models.sock",
+                        help="Đường dẫn Unix socket (worker đặt cùng giá trị vào MODEL_SERVER_SOCKET)")
+    args = parser.parse_args()
+    serve(args.socket)
+
+
+if __name__ == "__main__":
+    main()
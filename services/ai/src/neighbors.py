@@ -0,0 +1,269 @@
+# neighbors.py
+# ("Tranh tương tự": đồ thị top-N láng giềng theo vector SigLIP, tính offline sau khi index,
+#  phục vụ từ bộ nhớ bằng 1 lần tra dict - không cần tải ảnh hay chạy model khi xem trang sản phẩm)
+#
+#   python -m src.neighbors build                 # tính lại toàn bộ (index.run_indexing tự gọi)
+#   python -m src.neighbors update <product_id>   # cập nhật 1 sản phẩm vừa upsert lại vào Qdrant
+#   python -m src.neighbors remove <product_id>   # xóa 1 sản phẩm khỏi đồ thị
+import argparse
+import json
+import os
+import threading
+import uuid
+import numpy as np
+from .config import settings
+from .logger import get_logger
+from .vector_store import read_collection, vector_store
+
+logger = get_logger("neighbors")
+
+# Chỉ giữ các trường cần để hiển thị gợi ý
+PAYLOAD_FIELDS = ("original_id", "name", "price", "imageUrl", "category", "tags", "element_primary")
+
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+
+def _top_n(scores, n):
+    """Top-n theo từng hàng (đã sắp giảm dần) -> (chỉ số, điểm)."""
+    n = min(n, scores.shape[1])
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    return top, np.take_along_axis(scores, top, axis=1)
+
+
+def compute_neighbors(vectors, top_n: int, block_rows: int = 1024):
+    """
+    Top-N láng giềng (cosine) của mọi vector bằng nhân ma trận theo khối:
+    mỗi lần chỉ giữ block_rows x N điểm trong RAM thay vì cả ma trận N x N.
+    """
+    vectors = _normalize(vectors)
+    count = len(vectors)
+    top_n = min(top_n, count - 1)
+    neighbor_idx = np.zeros((count, max(top_n, 0)), dtype=np.int32)
+    neighbor_scores = np.zeros((count, max(top_n, 0)), dtype=np.float16)
+    if top_n <= 0:
+        return neighbor_idx, neighbor_scores
+
+    for start in range(0, count, block_rows):
+        block = vectors[start:start + block_rows]
+        scores = block @ vectors.T
+        rows = np.arange(len(block))
+        scores[rows, start + rows] = -np.inf   # Bỏ chính nó
+        idx, top_scores = _top_n(scores, top_n)
+        neighbor_idx[start:start + len(block)] = idx
+        neighbor_scores[start:start + len(block)] = top_scores
+    return neighbor_idx, neighbor_scores
+
+
+class NeighborGraph:
+    """
+    Cấu trúc gọn trong bộ nhớ:
+    - product_ids: list id sản phẩm, row_of: id -> hàng
+    - neighbor_idx (int32, N x top_n), neighbor_scores (float16, N x top_n)
+    - vectors (float16, đã chuẩn hóa): chỉ dùng để cập nhật tăng dần
+    """
+
+    def __init__(self, product_ids, payloads, vectors, neighbor_idx, neighbor_scores, top_n):
+        self.product_ids = list(product_ids)
+        self.payloads = list(payloads)
+        self.vectors = np.asarray(vectors, dtype=np.float16)
+        self.neighbor_idx = neighbor_idx
+        self.neighbor_scores = neighbor_scores
+        self.top_n = top_n
+        self.row_of = {pid: i for i, pid in enumerate(self.product_ids)}
+
+    @classmethod
+    def build(cls, product_ids, payloads, vectors, top_n):
+        neighbor_idx, neighbor_scores = compute_neighbors(vectors, top_n)
+        return cls(product_ids, payloads, _normalize(vectors), neighbor_idx, neighbor_scores, top_n)
+
+    def similar(self, product_id: str, limit: int):
+        row = self.row_of.get(product_id)
+        if row is None:
+            return None
+        return [
+            {**self.payloads[j], "score": float(score)}
+            for j, score in zip(self.neighbor_idx[row][:limit], self.neighbor_scores[row][:limit])
+        ]
+
+    # --- Cập nhật tăng dần ---
+
+    def _recompute_rows(self, rows):
+        if len(rows) == 0:
+            return
+        vectors = self.vectors.astype(np.float32)
+        scores = vectors[rows] @ vectors.T
+        scores[np.arange(len(rows)), rows] = -np.inf
+        idx, top_scores = _top_n(scores, self.neighbor_idx.shape[1])
+        self.neighbor_idx[rows] = idx
+        self.neighbor_scores[rows] = top_scores
+
+    def upsert(self, product_id, vector, payload):
+        """
+        Thêm / thay 1 sản phẩm. Chỉ tính lại các hàng bị ảnh hưởng:
+        - Hàng của chính sản phẩm (1 phép nhân vector x ma trận)
+        - Hàng đang chứa sản phẩm này (điểm cũ không còn đúng)
+        - Hàng mà sản phẩm mới lọt vào top-N (điểm mới > điểm láng giềng thấp nhất)
+        """
+        vector = _normalize(np.asarray(vector)[None, :])[0]
+        row = self.row_of.get(product_id)
+        if row is None:
+            row = len(self.product_ids)
+            self.product_ids.append(product_id)
+            self.payloads.append(payload)
+            self.row_of[product_id] = row
+            self.vectors = np.vstack([self.vectors, vector.astype(np.float16)])
+            width = min(self.top_n, len(self.product_ids) - 1)
+            if width > self.neighbor_idx.shape[1]:
+                # Đồ thị đang nhỏ hơn top_n: tính lại toàn bộ (chỉ xảy ra khi kho gần như rỗng)
+                self.neighbor_idx, self.neighbor_scores = compute_neighbors(self.vectors, self.top_n)
+                return
+            self.neighbor_idx = np.vstack([self.neighbor_idx, np.zeros((1, self.neighbor_idx.shape[1]), dtype=np.int32)])
+            self.neighbor_scores = np.vstack([self.neighbor_scores, np.zeros((1, self.neighbor_scores.shape[1]), dtype=np.float16)])
+        else:
+            self.payloads[row] = payload
+            self.vectors[row] = vector.astype(np.float16)
+
+        if self.neighbor_idx.shape[1] == 0:
+            return
+        sims = self.vectors.astype(np.float32) @ vector
+        sims[row] = -np.inf
+        contains = np.any(self.neighbor_idx == row, axis=1)
+        enters = sims > self.neighbor_scores[:, -1].astype(np.float32)
+        affected = np.flatnonzero(contains | enters)
+        self._recompute_rows(np.union1d(affected, [row]).astype(np.int64))
+
+    def remove(self, product_id):
+        row = self.row_of.get(product_id)
+        if row is None:
+            return False
+        keep = np.array([i for i in range(len(self.product_ids)) if i != row], dtype=np.int64)
+        affected_old = np.flatnonzero(np.any(self.neighbor_idx == row, axis=1))
+
+        self.product_ids.pop(row)
+        self.payloads.pop(row)
+        self.vectors = self.vectors[keep]
+        # Đánh lại chỉ số sau khi bỏ 1 hàng
+        idx = self.neighbor_idx[keep]
+        self.neighbor_idx = np.where(idx > row, idx - 1, idx).astype(np.int32)
+        self.neighbor_scores = self.neighbor_scores[keep]
+        self.row_of = {pid: i for i, pid in enumerate(self.product_ids)}
+
+        if self.neighbor_idx.shape[1] > len(self.product_ids) - 1:
+            self.neighbor_idx, self.neighbor_scores = compute_neighbors(self.vectors, self.top_n)
+        else:
+            affected = np.array([r if r < row else r - 1 for r in affected_old if r != row], dtype=np.int64)
+            self._recompute_rows(affected)
+        return True
+
+    # --- Lưu / nạp ---
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp.npz"
+        np.savez(
+            tmp,
+            product_ids=np.array(self.product_ids, dtype=object).astype(str),
+            payloads=np.array(json.dumps(self.payloads, ensure_ascii=False)),
+            vectors=self.vectors,
+            neighbor_idx=self.neighbor_idx,
+            neighbor_scores=self.neighbor_scores,
+            top_n=np.array(self.top_n),
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(
+                data["product_ids"].tolist(),
+                json.loads(str(data["payloads"])),
+                data["vectors"],
+                data["neighbor_idx"],
+                data["neighbor_scores"],
+                int(data["top_n"]),
+            )
+
+
+def _product_payload(payload):
+    return {k: payload.get(k) for k in PAYLOAD_FIELDS}
+
+
+def build_neighbor_graph():
+    """Tính lại toàn bộ đồ thị từ collection tranh trong Qdrant."""
+    _, vectors, payloads = read_collection(settings.PAINTINGS_COLLECTION)
+    product_ids = [str(p.get("original_id")) for p in payloads]
+    graph = NeighborGraph.build(product_ids, [_product_payload(p) for p in payloads], vectors, settings.NEIGHBORS_TOP_N)
+    graph.save(settings.NEIGHBORS_FILE)
+    logger.info(f"🕸️ Đồ thị tranh tương tự: {len(product_ids)} tranh x top {graph.neighbor_idx.shape[1]} -> {settings.NEIGHBORS_FILE}")
+    return graph
+
+
+def update_product(product_id: str):
+    """Cập nhật 1 sản phẩm từ điểm của nó trong kho vector (id điểm = uuid5 của original_id, xem index.py)."""
+    point_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, str(product_id)))
+    point = vector_store.retrieve(settings.PAINTINGS_COLLECTION, point_id)
+    graph = NeighborGraph.load(settings.NEIGHBORS_FILE)
+    if point:
+        vector, payload = point
+        graph.upsert(str(product_id), vector, _product_payload(payload))
+    else:
+        graph.remove(str(product_id))
+    graph.save(settings.NEIGHBORS_FILE)
+    return graph
+
+
+class NeighborService:
+    """Giữ đồ thị trong bộ nhớ, tự nạp lại khi file được build / update."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._graph = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def graph(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._graph = NeighborGraph.load(self.path)
+                    self._mtime = mtime
+        return self._graph
+
+    def similar(self, product_id: str, limit: int):
+        graph = self.graph()
+        return graph.similar(product_id, limit) if graph is not None else None
+
+
+neighbor_service = NeighborService(settings.NEIGHBORS_FILE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đồ thị tranh tương tự")
+    parser.add_argument("command", choices=["build", "update", "remove"])
+    parser.add_argument("product_id", nargs="?")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_neighbor_graph()
+    elif not args.product_id:
+        parser.error("Cần product_id")
+    elif args.command == "update":
+        update_product(args.product_id)
+    else:
+        graph = NeighborGraph.load(settings.NEIGHBORS_FILE)
+        if graph.remove(args.product_id):
+            graph.save(settings.NEIGHBORS_FILE)
+
+
+if __name__ == "__main__":
+    main()
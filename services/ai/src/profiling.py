@@ -0,0 +1,223 @@
+# profiling.py
+# (Profile 1 request cụ thể: cProfile cho code Python + torch profiler cho các lần gọi model.
+#  Khi không bật, chi phí trên hot path chỉ là 1 lần đọc contextvar.)
+import asyncio
+import contextvars
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from .config import settings
+from .logger import get_logger
+
+logger = get_logger("profiling")
+
+_active_profile = contextvars.ContextVar("active_profile", default=None)
+# cProfile: mỗi lúc chỉ 1 profiler cho cả process (Python 3.12 báo lỗi
+# "Another profiling tool is already active" nếu thread khác đang profile, kể cả lồng nhau)
+_cprofile_lock = threading.Lock()
+# torch profiler dùng chung cho cả process: mỗi lúc chỉ 1 trace
+_torch_lock = threading.Lock()
+
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def is_admin(headers) -> bool:
+    token = headers.get("x-admin-token", "")
+    # So sánh bytes: compare_digest báo TypeError với str có ký tự ngoài ASCII
+    return bool(settings.ADMIN_TOKEN) and hmac.compare_digest(token.encode("utf-8"), settings.ADMIN_TOKEN.encode("utf-8"))
+
+
+def should_profile(conn) -> bool:
+    """conn: Request / WebSocket. Bật khi admin yêu cầu (header / query) hoặc được chọn ngẫu nhiên."""
+    if not settings.ADMIN_TOKEN and settings.PROFILE_SAMPLE_RATE <= 0:
+        return False
+    requested = conn.headers.get("x-profile") == "1" or conn.query_params.get("profile") == "1"
+    # Trình duyệt không gửi được header tùy ý khi mở websocket -> cho phép token qua query
+    if requested and (is_admin(conn.headers) or is_admin({"x-admin-token": conn.query_params.get("admin_token", "")})):
+        return True
+    return settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE
+
+
+class RequestProfile:
+    """Gom kết quả profile của 1 request (có thể chạy trên nhiều thread của threadpool)."""
+
+    def __init__(self, endpoint: str):
+        self.id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.started_at = time.time()
+        self.dir = os.path.join(settings.PROFILE_DIR, self.id)
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._sections = []
+        self._trace_count = 0
+
+    @contextmanager
+    def section(self, name: str):
+        """
+        cProfile cho 1 bước. Bỏ qua trên event loop (sẽ lẫn coroutine của request khác),
+        khi lồng nhau và khi thread khác đang profile.
+        """
+        if _on_event_loop() or not _cprofile_lock.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Công cụ profile khác (debugger, coverage...) đang chạy
+                logger.warning(f"⚠️ Không bật được cProfile cho {name}: {e}")
+                profiler = None
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    with self._lock:
+                        self._profiles.append(profiler)
+                        self._sections.append({"name": name, "seconds": round(time.perf_counter() - start, 4)})
+        finally:
+            _cprofile_lock.release()
+
+    @contextmanager
+    def torch_trace(self, name: str):
+        """torch profiler quanh 1 lần gọi model, xuất ra Chrome trace (mở bằng chrome://tracing / Perfetto)."""
+        if not _torch_lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            yield from self._torch_trace(name)
+        finally:
+            _torch_lock.release()
+
+    def _torch_trace(self, name):
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        with self._lock:
+            self._trace_count += 1
+            path = os.path.join(self.dir, f"torch_{self._trace_count:02d}_{name}.json")
+        os.makedirs(self.dir, exist_ok=True)
+
+        with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+            yield
+        prof.export_chrome_trace(path)
+
+    def save(self, timings: dict):
+        """Ghi artifacts: profile.pstats (snakeviz / pstats), profile.txt (top hàm), summary.json."""
+        os.makedirs(self.dir, exist_ok=True)
+        with self._lock:
+            profiles = list(self._profiles)
+            sections = list(self._sections)
+
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for profiler in profiles[1:]:
+                stats.add(profiler)
+            stats.dump_stats(os.path.join(self.dir, "profile.pstats"))
+
+            text = io.StringIO()
+            pstats.Stats(os.path.join(self.dir, "profile.pstats"), stream=text).sort_stats("cumulative").print_stats(60)
+            with open(os.path.join(self.dir, "profile.txt"), "w", encoding="utf-8") as f:
+                f.write(text.getvalue())
+
+        summary = {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "started_at": self.started_at,
+            "timings": timings,
+            "sections": sections,
+            "files": sorted(os.listdir(self.dir)) + ["summary.json"],
+        }
+        with open(os.path.join(self.dir, "summary.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+        logger.info(f"🔬 Đã lưu profile {self.id} ({self.endpoint}, {timings.get('total')}s)")
+        _prune_artifacts()
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def _prune_artifacts():
+    """Chỉ giữ PROFILE_MAX_ARTIFACTS profile mới nhất."""
+    entries = list_profiles()
+    for entry in entries[settings.PROFILE_MAX_ARTIFACTS:]:
+        shutil.rmtree(os.path.join(settings.PROFILE_DIR, entry["id"]), ignore_errors=True)
+
+
+@contextmanager
+def activate(profile):
+    """Gắn profile vào context của request (contextvar được copy sang threadpool)."""
+    if profile is None:
+        yield None
+        return
+    token = _active_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _active_profile.reset(token)
+
+
+def profile_section(name: str):
+    """Dùng trong metrics.stage: nullcontext nếu request hiện tại không được profile."""
+    profile = _active_profile.get()
+    return profile.section(name) if profile is not None else nullcontext()
+
+
+def model_trace(name: str):
+    """Dùng quanh các lần gọi model trong AIModels."""
+    profile = _active_profile.get()
+    if profile is None or not settings.PROFILE_TORCH:
+        return nullcontext()
+    return profile.torch_trace(name)
+
+
+def list_profiles():
+    """Danh sách profile đã lưu, mới nhất trước."""
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return []
+    entries = []
+    for profile_id in os.listdir(settings.PROFILE_DIR):
+        summary_path = os.path.join(settings.PROFILE_DIR, profile_id, "summary.json")
+        if not PROFILE_ID_PATTERN.match(profile_id) or not os.path.isfile(summary_path):
+            continue
+        with open(summary_path, encoding="utf-8") as f:
+            summary = json.load(f)
+        entries.append({
+            "id": profile_id,
+            "endpoint": summary.get("endpoint"),
+            "started_at": summary.get("started_at"),
+            "total": summary.get("timings", {}).get("total"),
+            "files": summary.get("files", []),
+        })
+    return sorted(entries, key=lambda e: e["started_at"] or 0, reverse=True)
+
+
+def artifact_path(profile_id: str, filename: str):
+    """Đường dẫn file artifact, None nếu không tồn tại (chặn path traversal)."""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    profile_dir = os.path.join(settings.PROFILE_DIR, profile_id)
+    if not os.path.isdir(profile_dir) or filename not in os.listdir(profile_dir):
+        return None
+    return os.path.join(profile_dir, filename)
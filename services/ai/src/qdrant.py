@@ -0,0 +1,21 @@
+# qdrant.py
+# (1 client Qdrant dùng chung cho cả service: tìm kiếm, index, nạp kiến thức)
+from qdrant_client import QdrantClient
+from .config import settings
+
+
+def make_client() -> QdrantClient:
+    """
+    QDRANT_URL:
+    - "http://..."  : Qdrant server (mặc định)
+    - ":memory:"    : Qdrant local trong process (benchmark / chạy thử không cần docker)
+    - đường dẫn thư mục: Qdrant local lưu trên đĩa
+    """
+    if settings.QDRANT_URL == ":memory:":
+        return QdrantClient(location=":memory:")
+    if not settings.QDRANT_URL.startswith("http"):
+        return QdrantClient(path=settings.QDRANT_URL)
+    return QdrantClient(url=settings.QDRANT_URL)
+
+
+client = make_client()
@@ -0,0 +1,217 @@
+# query_translation.py
+# (Câu tìm tranh tiếng Việt -> câu mô tả tiếng Anh cho text tower của SigLIP)
+#
+# SigLIP so400m chỉ học chú thích tiếng Anh: đưa thẳng "tranh núi non tông vàng" vào thì vector
+# gần như ngẫu nhiên so với ảnh. Giống elements.py (câu mô tả tiếng Anh, nhãn tiếng Việt):
+#   1. Từ điển cụm từ tranh / màu / phong cách -> "a painting of mountains in yellow tones" (không tốn LLM)
+#   2. Còn từ có nghĩa ngoài từ điển ("tranh mèo đỏ") -> nhờ LLM dịch cả câu
+#      (TEXT_SEARCH_LLM_TRANSLATE, mặc định tắt; slot PRIORITY_BATCH để không chen hàng chat,
+#       chờ tối đa TEXT_SEARCH_TRANSLATE_TIMEOUT)
+#   3. LLM tắt / không kịp -> câu từ từ điển nếu có, không thì dùng nguyên câu (như trước)
+#      (kết quả dự phòng do LLM không kịp thì không cache, xem rag_service.search_paintings_by_text)
+# Kiểm tra: python -m src.eval_retrieval --paintings
+import re
+import time
+import unicodedata
+import ollama
+from .config import settings
+from .llm import llm_gateway, PRIORITY_BATCH
+from .logger import get_logger
+from .metrics import QUERY_TRANSLATIONS_TOTAL
+
+logger = get_logger("query_translation")
+
+# Đối tượng / chủ đề (bám theo TAG_RULES của crawler và THEME_PROMPTS trong elements.py)
+SUBJECT_TERMS = {
+    "phong cảnh": "a landscape", "núi": "mountains", "núi non": "mountains", "đồi": "hills",
+    "đồi núi": "hills and mountains", "vùng cao": "highland mountains", "ruộng bậc thang": "rice terraces",
+    "ruộng": "rice fields", "đồng lúa": "rice fields", "cánh đồng": "fields", "lúa chín": "ripe rice fields",
+    "làng quê": "a Vietnamese village", "đồng quê": "countryside", "cổng làng": "a village gate",
+    "sân đình": "a village temple yard", "tre làng": "village bamboo", "trâu": "a water buffalo",
+    "sông": "a river", "suối": "a stream", "sông suối": "rivers and streams", "thác nước": "a waterfall",
+    "thác": "a waterfall", "biển": "the sea", "bãi biển": "a beach", "sóng": "waves", "hồ": "a lake",
+    "mặt hồ": "a lake", "thuyền": "a boat", "thuyền buồm": "a sailing boat", "thuận buồm": "a sailing boat",
+    "rừng": "a forest", "rừng cây": "a forest", "cây": "trees", "cây xanh": "green trees", "lá": "leaves",
+    "lá vàng": "yellow autumn leaves", "trúc": "bamboo", "tre": "bamboo", "tùng": "pine trees", "mây": "clouds",
+    "mặt trời": "the sun", "mặt trăng": "the moon", "trăng": "the moon", "hoàng hôn": "a sunset",
+    "bình minh": "a sunrise", "mưa": "rain", "tuyết": "snow", "mùa thu": "autumn", "đá": "rocks",
+    "hoa": "flowers", "hoa lá": "flowers and leaves", "hoa sen": "lotus flowers", "sen": "lotus flowers",
+    "mẫu đơn": "peonies", "hoa mẫu đơn": "peonies", "hướng dương": "sunflowers", "hoa hồng": "roses",
+    "hoa cúc": "daisies", "cúc": "daisies", "hoa mai": "apricot blossoms", "hoa đào": "peach blossoms",
+    "tulip": "tulips", "tĩnh vật": "a still life", "hoa quả": "fruit",
+    "ngựa": "horses", "mã đáo": "galloping horses", "mã đáo thành công": "galloping horses",
+    "cá": "fish", "cá chép": "koi carp", "cá koi": "koi fish", "cửu ngư": "nine koi fish",
+    "chim": "birds", "chim công": "a peacock", "công": "a peacock", "hạc": "cranes", "thiên nga": "swans",
+    "đại bàng": "an eagle", "phượng hoàng": "a phoenix", "rồng": "a dragon", "hổ": "a tiger",
+    "bạch hổ": "a white tiger", "voi": "elephants", "hươu": "deer", "sói": "wolves", "gà": "a rooster",
+    "uyên ương": "a pair of mandarin ducks", "động vật": "animals",
+    "phật": "Buddha", "quán thế âm": "Guanyin", "bồ tát": "a bodhisattva", "thiền": "meditation",
+    "chùa": "a pagoda", "đền": "a temple", "phố cổ": "an old town street", "hạ long": "Ha Long Bay",
+    "người": "people", "cô gái": "a girl", "thiếu nữ": "a young woman", "chân dung": "a portrait",
+    "đồng tiền": "coins", "lửa": "fire",
+}
+
+# Màu -> "in ... tones"
+COLOR_TERMS = {
+    "trắng": "white", "đen": "black", "xám": "grey", "nâu": "brown", "vàng": "yellow",
+    "vàng kim": "gold", "cam": "orange", "đỏ": "red", "hồng": "pink", "tím": "purple",
+    "xanh": "blue and green", "xanh dương": "blue", "xanh lam": "blue", "xanh nước biển": "blue",
+    "xanh lá": "green", "xanh lá cây": "green", "xanh ngọc": "turquoise", "be": "beige",
+    "bạc": "silver", "pastel": "pastel", "đơn sắc": "monochrome", "tối": "dark", "sáng": "bright",
+}
+
+# Phong cách / chất liệu / cảm xúc -> tính từ đứng trước "painting"
+STYLE_TERMS = {
+    "trừu tượng": "abstract", "hiện đại": "modern", "tối giản": "minimalist", "cổ điển": "classical",
+    "sơn dầu": "oil", "sơn mài": "lacquer", "thủy mặc": "ink wash", "sơn thủy": "Chinese landscape",
+    "màu nước": "watercolor", "đông hồ": "Dong Ho folk", "dân gian": "folk", "hình học": "geometric",
+    "dát vàng": "gold leaf", "3d": "3D", "vintage": "vintage", "hoài cổ": "vintage",
+    "bình yên": "peaceful", "tĩnh lặng": "calm", "an yên": "peaceful", "lãng mạn": "romantic",
+    "sang trọng": "luxurious", "ấm áp": "warm", "mạnh mẽ": "powerful", "huyền bí": "mysterious",
+    "tươi sáng": "bright", "rực rỡ": "vibrant",
+}
+
+GLOSSARY = {
+    **{k: ("subject", v) for k, v in SUBJECT_TERMS.items()},
+    **{k: ("color", v) for k, v in COLOR_TERMS.items()},
+    **{k: ("style", v) for k, v in STYLE_TERMS.items()},
+}
+MAX_PHRASE_WORDS = max(len(k.split()) for k in GLOSSARY)
+
+# Khi gõ không dấu: bỏ các khóa trùng từ thông dụng ("tim" ~ tìm, "do" ~ do, "den" ~ đến...)
+AMBIGUOUS_UNACCENTED = {"do", "den", "tim", "mai", "dao", "cong", "be", "sang", "toi", "ho", "ca", "tre"}
+
+# Từ không mô tả nội dung tranh: bỏ qua khi xét câu còn từ nào ngoài từ điển
+FILLER_WORDS = set("""
+tranh bức bộ tấm cho phòng khách ngủ bếp ăn làm việc treo tường màu tông tone có với và của mình tôi em anh chị
+muốn tìm cần mua xem một con cái những các đẹp nhà hợp mệnh phong thủy giá rẻ khổ lớn nhỏ to kiểu loại về
+ạ nhé không nào gì như thế là được hay nào sắc gam chủ đạo vẽ in trên canvas
+""".split())
+
+TRANSLATE_PROMPT = """Translate this Vietnamese search query for wall paintings into one short English image caption
+that starts with "a painting". Keep only what the painting shows (subject, colors, style); drop rooms, prices and feng shui.
+Reply with the caption only.
+Query: {query}"""
+
+
+def _fold(text: str) -> str:
+    """Bỏ dấu tiếng Việt (đ -> d)."""
+    text = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    return "".join(c for c in text if unicodedata.category(c) != "Mn")
+
+
+def _build_unaccented():
+    folded = {}
+    for key, value in GLOSSARY.items():
+        # Khóa vốn không dấu (tulip, pastel, vintage...) trùng tiếng Anh -> câu tiếng Anh giữ nguyên
+        if key.isascii():
+            continue
+        folded.setdefault(_fold(key), set()).add(value)
+    # Khóa không dấu trùng nhau mà nghĩa khác (lúa / lửa...) thì bỏ
+    return {k: next(iter(v)) for k, v in folded.items() if len(v) == 1 and k not in AMBIGUOUS_UNACCENTED}
+
+
+GLOSSARY_UNACCENTED = _build_unaccented()
+FILLER_WORDS_UNACCENTED = {_fold(w) for w in FILLER_WORDS}
+
+
+def _words(text: str):
+    return re.findall(r"\w+", unicodedata.normalize("NFC", text.lower()))
+
+
+def _join(items):
+    return items[0] if len(items) == 1 else ", ".join(items[:-1]) + " and " + items[-1]
+
+
+def glossary_terms(query: str):
+    """
+    (các cụm khớp từ điển theo thứ tự xuất hiện, các từ có nghĩa còn lại ngoài từ điển).
+    Khớp cụm dài nhất trước; câu không dấu dùng bảng không dấu.
+    """
+    words = _words(query)
+    accented = " ".join(words) != _fold(" ".join(words))
+    glossary, fillers = (GLOSSARY, FILLER_WORDS) if accented else (GLOSSARY_UNACCENTED, FILLER_WORDS_UNACCENTED)
+    terms, unknown, i = [], [], 0
+    while i < len(words):
+        for size in range(min(MAX_PHRASE_WORDS, len(words) - i), 0, -1):
+            match = glossary.get(" ".join(words[i:i + size]))
+            if match:
+                if match not in terms:
+                    terms.append(match)
+                i += size
+                break
+        else:
+            if words[i] not in fillers and not words[i].isdigit():
+                unknown.append(words[i])
+            i += 1
+    return terms, unknown
+
+
+def compose_prompt(terms) -> str:
+    """[("subject", "mountains"), ("color", "yellow")] -> "a painting of mountains in yellow tones"."""
+    by_kind = {kind: [v for k, v in terms if k == kind] for kind in ("subject", "color", "style")}
+    styles = " ".join(by_kind["style"])
+    prompt = f"{'an' if styles[:1].lower() in 'aeiou' and styles else 'a'} {styles + ' ' if styles else ''}painting"
+    if by_kind["subject"]:
+        prompt += " of " + _join(by_kind["subject"])
+    if by_kind["color"]:
+        prompt += " in " + _join(by_kind["color"]) + " tones"
+    return prompt
+
+
+def looks_vietnamese(query: str) -> bool:
+    words = _words(query)
+    return " ".join(words) != _fold(" ".join(words)) or "tranh" in words
+
+
+def translate_with_llm(query: str):
+    """1 lượt LLM ngắn (không stream). None nếu không có slot kịp / lỗi."""
+    deadline = time.monotonic() + settings.TEXT_SEARCH_TRANSLATE_TIMEOUT
+    with llm_gateway.slot(PRIORITY_BATCH, deadline=deadline) as admitted:
+        if not admitted:
+            return None
+        try:
+            response = ollama.chat(
+                model=settings.LLM_MODEL_ID,
+                messages=[{"role": "user", "content": TRANSLATE_PROMPT.format(query=query)}],
+                stream=False,
+                keep_alive=settings.LLM_KEEP_ALIVE,
+                options={"temperature": 0.0, "num_predict": 40},
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Lỗi dịch câu tìm tranh: {e}")
+            return None
+    caption = (response.message.content or "").strip().strip('"').splitlines()
+    return caption[0].strip() if caption and caption[0].strip() else None
+
+
+def translate_vision_query(query: str, use_llm: bool = None):
+    """
+    (câu đưa vào SigLIP text tower, exact).
+    exact=False: LLM được bật nhưng không kịp / lỗi -> câu dự phòng (từ điển một phần / nguyên câu),
+    không nên cache vì lần sau LLM có thể dịch được.
+    """
+    terms, unknown = glossary_terms(query)
+    if not terms and not looks_vietnamese(query):
+        QUERY_TRANSLATIONS_TOTAL.labels(method="none").inc()
+        return query, True
+    if terms and not unknown:
+        QUERY_TRANSLATIONS_TOTAL.labels(method="glossary").inc()
+        return compose_prompt(terms), True
+
+    use_llm = settings.TEXT_SEARCH_LLM_TRANSLATE if use_llm is None else use_llm
+    translated = translate_with_llm(query) if use_llm else None
+    if translated:
+        QUERY_TRANSLATIONS_TOTAL.labels(method="llm").inc()
+        return translated, True
+    if terms:
+        QUERY_TRANSLATIONS_TOTAL.labels(method="glossary_partial").inc()
+        return compose_prompt(terms), not use_llm
+    QUERY_TRANSLATIONS_TOTAL.labels(method="untranslated").inc()
+    logger.info(f"⚠️ Không dịch được câu tìm tranh, dùng nguyên câu: {query[:60]}")
+    return query, not use_llm
+
+
+def to_vision_query(query: str, use_llm: bool = None) -> str:
+    """Câu đưa vào SigLIP text tower: tiếng Anh giữ nguyên, tiếng Việt dịch theo từ điển / LLM."""
+    return translate_vision_query(query, use_llm)[0]
@@ -1,50 +1,192 @@
-from qdrant_client import QdrantClient
+import threading
+from collections import OrderedDict
+import numpy as np
 from .config import settings
+from .vector_store import vector_store
 from .core import ai_models
+from .logger import get_logger
+from .metrics import QUERY_EMBEDDING_CACHE_TOTAL, RERANK_CANDIDATES, RERANK_DECISIONS_TOTAL, record_value, stage
+from .query_translation import translate_vision_query
+
+logger = get_logger("rag_service")
 
-client = QdrantClient(url=settings.QDRANT_URL)
 
 # --- 1. TÌM TRANH (Bằng ảnh phòng) ---
 def search_paintings_by_image(image_bytes, limit=3):
+    """image_bytes: bytes ảnh hoặc ảnh PIL đã decode sẵn (images.prepare_image)"""
     vector = ai_models.get_image_embedding(image_bytes)
     if not vector: return []
     
     try:
-        results = client.query_points(
-            collection_name=settings.PAINTINGS_COLLECTION,
-            query=vector,  # Lưu ý: tham số là 'query' chứ không phải 'query_vector'
-            limit=limit
-        )
-        # Kết quả trả về nằm trong thuộc tính .points
-        return [point.payload for point in results.points]
+        with stage("vector_search"):
+            hits = vector_store.search(settings.PAINTINGS_COLLECTION, vector, limit)
+        # Kèm điểm tương đồng để xếp hạng context
+        return [{**hit.payload, "score": hit.score} for hit in hits]
         
     except Exception as e:
-        print(f"⚠️ Lỗi tìm tranh: {e}")
+        logger.warning(f"⚠️ Lỗi tìm tranh: {e}")
+        return []
+
+def _fuse_rrf(result_lists, limit):
+    """Reciprocal Rank Fusion: tranh xếp cao ở nhiều ảnh được ưu tiên, không phụ thuộc thang điểm."""
+    fused = {}
+    for hits in result_lists:
+        for rank, hit in enumerate(hits, 1):
+            entry = fused.setdefault(hit.id, {"payload": hit.payload, "rrf": 0.0, "similarity": hit.score, "matches": 0})
+            entry["rrf"] += 1.0 / (settings.BATCH_SEARCH_RRF_K + rank)
+            entry["similarity"] = max(entry["similarity"], hit.score)
+            entry["matches"] += 1
+    ranked = sorted(fused.values(), key=lambda e: e["rrf"], reverse=True)[:limit]
+    return [
+        {**e["payload"], "score": e["rrf"], "similarity": e["similarity"], "matched_images": e["matches"]}
+        for e in ranked
+    ]
+
+
+def search_paintings_by_images(images, limit=8, fusion=None):
+    """
+    Nhiều ảnh cùng 1 căn phòng -> 1 danh sách tranh gợi ý.
+    - 1 lượt SigLIP cho cả batch
+    - fusion="centroid": 1 truy vấn với vector trung bình
+    - fusion="rrf": 1 lượt batch query (mỗi ảnh 1 truy vấn) rồi gộp thứ hạng
+    """
+    fusion = fusion or settings.BATCH_SEARCH_FUSION
+    vectors = [v for v in ai_models.get_image_embeddings(images) if v is not None]
+    if not vectors: return []
+
+    try:
+        with stage("vector_search"):
+            if fusion == "centroid" or len(vectors) == 1:
+                centroid = np.mean(np.asarray(vectors, dtype=np.float32), axis=0)
+                hits = vector_store.search(settings.PAINTINGS_COLLECTION, centroid / np.linalg.norm(centroid), limit)
+                return [{**hit.payload, "score": hit.score} for hit in hits]
+            # Lấy dư mỗi ảnh để tranh hợp với nhiều góc chụp có cơ hội lọt vào danh sách gộp
+            result_lists = vector_store.search_batch(settings.PAINTINGS_COLLECTION, vectors, limit * 2)
+        return _fuse_rrf(result_lists, limit)
+    except Exception as e:
+        logger.warning(f"⚠️ Lỗi tìm tranh (nhiều ảnh): {e}")
+        return []
+
+
+class QueryEmbeddingCache:
+    """LRU: câu truy vấn (đã chuẩn hóa khoảng trắng, chữ thường) -> vector SigLIP text."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, query: str, compute):
+        """compute() -> (vector, cacheable); cacheable=False thì trả vector nhưng không lưu."""
+        with self._lock:
+            vector = self._entries.get(query)
+            if vector is not None:
+                self._entries.move_to_end(query)
+        if vector is not None:
+            QUERY_EMBEDDING_CACHE_TOTAL.labels(result="hit").inc()
+            return vector
+
+        QUERY_EMBEDDING_CACHE_TOTAL.labels(result="miss").inc()
+        vector, cacheable = compute()
+        if vector is not None and not cacheable:
+            QUERY_EMBEDDING_CACHE_TOTAL.labels(result="uncached").inc()
+        elif vector is not None:
+            with self._lock:
+                self._entries[query] = vector
+                self._entries.move_to_end(query)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return vector
+
+
+query_embedding_cache = QueryEmbeddingCache(settings.TEXT_SEARCH_CACHE_SIZE)
+
+
+# --- 1b. TÌM TRANH (Bằng câu mô tả) ---
+def search_paintings_by_text(query_text, limit=12, filters=None):
+    """
+    "tranh núi non tông vàng cho phòng khách" -> tranh gần nhất trong không gian SigLIP (ảnh <-> chữ).
+    Câu tiếng Việt được đổi sang câu mô tả tiếng Anh trước (query_translation.py), cache theo câu gốc
+    (trừ bản dịch dự phòng khi LLM không kịp).
+    - filters: {field: value | [values]} trên payload (category, tags, element_primary...)
+    """
+    query = " ".join((query_text or "").split()).lower()
+    if not query: return []
+
+    def embed():
+        with stage("query_translate"):
+            vision_query, exact = translate_vision_query(query)
+        vectors = ai_models.get_vision_text_embedding([vision_query])
+        # Bản dịch dự phòng (LLM không kịp) không cache: lần sau còn cơ hội dịch đúng
+        return (vectors[0] if vectors else None), exact
+
+    vector = query_embedding_cache.get_or_compute(query, embed)
+    if vector is None: return []
+
+    try:
+        with stage("vector_search"):
+            hits = vector_store.search(settings.PAINTINGS_COLLECTION, vector, limit, filters)
+        return [{**hit.payload, "score": hit.score} for hit in hits]
+    except Exception as e:
+        logger.warning(f"⚠️ Lỗi tìm tranh bằng chữ: {e}")
         return []
 
+
+def plan_rerank(dense_scores, top_k):
+    """
+    Số candidate cần rerank dựa trên điểm dense (đã sắp giảm dần), 0 = bỏ qua rerank.
+    - top1 vượt hẳn top2 -> thứ tự dense đã đủ tin cậy
+    - Ngược lại chỉ rerank các candidate trong cửa sổ điểm quanh top1 (tối thiểu top_k + 2)
+    """
+    if len(dense_scores) <= 1:
+        return 0
+    top = dense_scores[0]
+    if top >= settings.RERANK_SKIP_MIN_SCORE and top - dense_scores[1] >= settings.RERANK_SKIP_MARGIN:
+        return 0
+    in_window = sum(1 for score in dense_scores if top - score <= settings.RERANK_SCORE_WINDOW)
+    return min(len(dense_scores), max(in_window, top_k + 2))
+
+
 # --- 2. TÌM KIẾN THỨC (Bằng câu hỏi) - RAG CHUẨN ---
-def search_knowledge(query_text, limit=3):
-    if not query_text: return ""
+def search_knowledge_docs(query_text, limit=None, query_vector=None):
+    """
+    Trả về List[{"content": str, "score": float}] đã được rerank,
+    điểm dùng để phân bổ ngân sách token khi lắp ráp prompt.
+    - query_vector: embedding câu hỏi đã tính sẵn (tránh encode 2 lần)
+    """
+    if not query_text: return []
+    limit = limit or settings.KNOWLEDGE_TOP_K
     
     # Bước 1: Retrieval (Tìm thô bằng VietnamEmbedding)
-    vector = ai_models.get_text_embedding(query_text)
-    if not vector: return ""
+    vector = query_vector or ai_models.get_text_embedding(query_text)
+    if not vector: return []
     
     try:
-        results = client.query_points(
-            collection_name=settings.DOCS_COLLECTION,
-            query=vector,
-            limit=10 # Lấy dư ra 10 đoạn để Reranker chọn
-        )
+        with stage("vector_search"):
+            # Lấy dư ra để Reranker chọn
+            hits = vector_store.search(settings.DOCS_COLLECTION, vector, settings.KNOWLEDGE_CANDIDATES)
         
-        # Trích xuất nội dung từ kết quả thô
-        rough_docs = [point.payload['content'] for point in results.points]
+        # Trích xuất nội dung từ kết quả thô (đã sắp theo điểm giảm dần)
+        rough_docs = [hit.payload['content'] for hit in hits]
+        dense_scores = [hit.score for hit in hits]
         
-        # Bước 2: Reranking (Lọc tinh bằng PhoRanker)
-        final_docs = ai_models.rerank_docs(query_text, rough_docs, top_k=limit)
+        # Bước 2: Reranking thích ứng (Lọc tinh bằng PhoRanker khi cần)
+        num_candidates = plan_rerank(dense_scores, limit)
+        record_value("rerank_candidates", num_candidates)
+        RERANK_CANDIDATES.observe(num_candidates)
+        if num_candidates == 0:
+            RERANK_DECISIONS_TOTAL.labels(decision="skipped").inc()
+            return [{"content": doc, "score": score} for doc, score in zip(rough_docs[:limit], dense_scores[:limit])]
         
-        return "\n\n".join(final_docs)
+        RERANK_DECISIONS_TOTAL.labels(decision="reranked").inc()
+        ranked = ai_models.rerank_docs(query_text, rough_docs[:num_candidates], top_k=limit, return_scores=True)
+        
+        return [{"content": doc, "score": score} for doc, score in ranked]
         
     except Exception as e:
-        print(f"⚠️ Lỗi tìm kiến thức: {e}")
-        return ""
\ No newline at end of file
+        logger.warning(f"⚠️ Lỗi tìm kiến thức: {e}")
+        return []
+
+def search_knowledge(query_text, limit=None):
+    """Giống search_knowledge_docs nhưng ghép thành 1 chuỗi."""
+    return "\n\n".join(doc["content"] for doc in search_knowledge_docs(query_text, limit))
@@ -0,0 +1,226 @@
+# session.py
+# (Phiên chat nhiều lượt cho /ws/chat: giữ lịch sử, dùng lại kết quả tìm kiếm)
+import numpy as np
+import ollama
+from .config import settings
+from .context import count_tokens, truncate_to_tokens
+from .llm import build_messages, stream_messages, llm_gateway, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from .logger import get_logger
+
+logger = get_logger("session")
+
+# Từ ngữ chỉ xuất hiện trong câu hỏi nối tiếp (tham chiếu tới câu trả lời trước).
+# Không dùng từ đơn "còn", "vậy", "nó", "tại sao": câu chủ đề mới ("Vậy mệnh Thủy nên treo tranh gì?")
+# cũng có -> để so vector câu hỏi quyết định.
+FOLLOW_UP_MARKERS = (
+    "tranh này", "tranh đó", "bức này", "bức đó", "cái này", "cái đó", "số 1", "số 2", "số 3",
+    "thứ nhất", "thứ hai", "thứ ba", "giá bao nhiêu", "treo ở đâu", "của nó", "nó có",
+    "tại sao vậy", "vì sao vậy", "sao lại thế", "như vậy là", "ý bạn là",
+)
+
+SUMMARY_PROMPT = (
+    "Tóm tắt ngắn gọn (tối đa 5 gạch đầu dòng, tiếng Việt) cuộc hội thoại tư vấn tranh phong thủy dưới đây. "
+    "Giữ lại: mệnh/Dụng Thần của khách, các tranh đã được gợi ý, mong muốn và quyết định của khách."
+)
+
+
+def _cosine(a, b) -> float:
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    denom = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / denom) if denom > 0 else 0.0
+
+
+class ChatSession:
+    """
+    Trạng thái của 1 kết nối websocket.
+
+    Prompt có context (hồ sơ, kiến thức, tranh) chỉ được dựng ở lượt đầu hoặc khi cần tìm kiếm lại
+    ("anchor"). Các lượt sau chỉ nối thêm câu hỏi vào sau anchor, nên phần đầu của messages giữ
+    nguyên giữa các lượt và Ollama dùng lại được KV cache của prompt đã prefill.
+    """
+
+    def __init__(self):
+        self.anchor_messages = []   # [system, user(prompt có context)]
+        self.anchor_question = ""   # Câu hỏi gốc của anchor (prompt anchor chứa cả context nên không dùng để tóm tắt)
+        self.turns = []             # Các lượt sau anchor: user/assistant xen kẽ
+        self.summary = ""           # Tóm tắt các lượt cũ đã bị cắt khỏi turns / của các anchor trước
+        # Tóm tắt bằng LLM chạy nền (không chặn lượt chat): summary tạm = bản cắt ngắn,
+        # bản LLM được áp dụng ở lượt sau nếu không có lần gộp nào mới hơn (so theo _summary_generation)
+        self._summary_generation = 0
+        self._summary_job = None    # (generation, summary trước đó, các lượt cần gộp) chờ main chạy nền
+        self._summary_ready = None  # (generation, summary) do tác vụ nền trả về
+        self.products = []
+        self.knowledge = []
+        self.feng_shui_profile = None
+        self.retrieval_vector = None
+        # Lượt đang chờ câu trả lời: ("anchor", trạng thái cũ) | ("follow_up", None) | None
+        self._pending = None
+
+    @property
+    def is_fresh(self) -> bool:
+        return not self.anchor_messages
+
+    def needs_retrieval(self, user_text, query_vector=None, user_image_bytes=None, feng_shui_profile=None) -> bool:
+        """Quyết định có cần tìm kiếm lại (ảnh mới, hồ sơ mới, chủ đề mới) hay dùng lại context cũ."""
+        if self.is_fresh or user_image_bytes:
+            return True
+        if feng_shui_profile != self.feng_shui_profile:
+            return True
+        text = " " + " ".join((user_text or "").lower().split()) + " "
+        if any(f" {marker} " in text for marker in FOLLOW_UP_MARKERS):
+            return False
+        if query_vector is None or self.retrieval_vector is None:
+            return True
+        return _cosine(query_vector, self.retrieval_vector) < settings.SESSION_RETRIEVAL_SIMILARITY
+
+    def start_context(self, user_text, user_image_bytes, products, knowledge, feng_shui_profile, query_vector=None, usage=None, cancel=None):
+        """Dựng anchor mới với kết quả tìm kiếm mới và stream câu trả lời."""
+        self._apply_ready_summary()
+        previous = (self.anchor_messages, self.anchor_question, self.turns, self.summary, self.products, self.knowledge,
+                    self.feng_shui_profile, self.retrieval_vector, self._summary_generation, self._summary_job)
+        # Chủ đề mới: gộp anchor cũ (câu hỏi + trả lời) và các lượt nối tiếp vào summary thay vì bỏ đi
+        if self.anchor_messages:
+            self._fold([{"role": "user", "content": self.anchor_question}] + self.turns)
+
+        question = user_text
+        if self.summary:
+            question = f"(Tóm tắt hội thoại trước: {self.summary})\n{user_text}"
+
+        messages, token_usage = build_messages(
+            question,
+            user_image_bytes,
+            products,
+            knowledge,
+            feng_shui_profile=feng_shui_profile,
+            reserve_tokens=settings.SESSION_HISTORY_TOKENS,
+        )
+        if usage is not None:
+            usage.update(token_usage)
+            token_usage = usage
+        token_usage["session"] = {"retrieval": True, "history_tokens": 0}
+
+        self._pending = ("anchor", previous)
+        self.anchor_messages = messages
+        self.anchor_question = user_text
+        self.turns = []
+        self.products = products
+        self.knowledge = knowledge
+        self.feng_shui_profile = feng_shui_profile
+        self.retrieval_vector = query_vector
+
+        yield from stream_messages(messages, token_usage, priority=PRIORITY_INTERACTIVE, cancel=cancel)
+
+    def follow_up(self, user_text, usage=None, cancel=None):
+        """Lượt nối tiếp: dùng lại anchor + lịch sử, không tìm kiếm lại."""
+        self._apply_ready_summary()
+        self.turns.append({"role": "user", "content": user_text})
+        self._pending = ("follow_up", None)
+        messages = list(self.anchor_messages)
+        if self.summary:
+            messages.append({"role": "system", "content": f"Tóm tắt các lượt trước: {self.summary}"})
+        messages.extend(self.turns)
+
+        token_usage = usage if usage is not None else {}
+        token_usage["session"] = {"retrieval": False, "history_tokens": self.history_tokens()}
+
+        yield from stream_messages(messages, token_usage, priority=PRIORITY_INTERACTIVE, cancel=cancel)
+
+    def discard_turn(self):
+        """
+        Lượt bị hủy giữa chừng (chưa có câu trả lời): bỏ câu hỏi nối tiếp khỏi lịch sử,
+        hoặc khôi phục anchor cũ (kèm summary trước khi gộp) nếu lượt đó đã dựng anchor mới.
+        Không có lượt dở dang thì bỏ qua.
+        """
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return
+        kind, previous = pending
+        if kind == "anchor":
+            (self.anchor_messages, self.anchor_question, self.turns, self.summary, self.products, self.knowledge,
+             self.feng_shui_profile, self.retrieval_vector, self._summary_generation, self._summary_job) = previous
+        elif self.turns and self.turns[-1]["role"] == "user":
+            self.turns.pop()
+
+    def record_answer(self, answer):
+        """
+        Lưu câu trả lời vào lịch sử (nhanh, không gọi LLM); vượt trần token thì cắt các lượt cũ,
+        phần tóm tắt bằng LLM lấy qua take_summary_job() để chạy nền.
+        (Với lượt dựng anchor, câu hỏi đã nằm trong prompt anchor nên chỉ lưu câu trả lời.)
+        """
+        self._pending = None
+        self.turns.append({"role": "assistant", "content": answer})
+        self._compact()
+
+    def take_summary_job(self):
+        """Việc tóm tắt đang chờ (None nếu không có): main chạy run_summary_job() ở tác vụ nền."""
+        job, self._summary_job = self._summary_job, None
+        return job
+
+    def run_summary_job(self, job):
+        """Blocking (threadpool, tác vụ nền): tóm tắt bằng LLM, áp dụng ở lượt sau."""
+        generation, base_summary, evicted = job
+        summary = self._summarize(base_summary, evicted)
+        if summary:
+            self._summary_ready = (generation, summary)
+
+    def _apply_ready_summary(self):
+        ready, self._summary_ready = self._summary_ready, None
+        # Đã có lần gộp mới hơn thì bản này đã cũ (summary tạm của lần mới đã chứa nội dung của nó)
+        if ready and ready[0] == self._summary_generation:
+            self.summary = ready[1]
+
+    def history_tokens(self) -> int:
+        return count_tokens(self.summary) + sum(count_tokens(m["content"]) for m in self.turns)
+
+    def _compact(self):
+        """Rolling summarization: gộp các lượt cũ nhất vào summary cho tới khi dưới trần token."""
+        if self.history_tokens() <= settings.SESSION_HISTORY_TOKENS:
+            return
+
+        evicted = []
+        while len(self.turns) > 2 and self.history_tokens() > settings.SESSION_HISTORY_TOKENS // 2:
+            evicted.append(self.turns.pop(0))
+        if evicted:
+            self._fold(evicted)
+
+    def _fold(self, evicted):
+        """Gộp các lượt vào summary: ngay lập tức bằng bản cắt ngắn, bản LLM đưa vào hàng chờ chạy nền."""
+        evicted = [m for m in evicted if m.get("content")]
+        if not evicted:
+            return
+        base_summary = self.summary
+        self._summary_generation += 1
+        self.summary = truncate_to_tokens(_transcript(base_summary, evicted)[-4000:], settings.SESSION_SUMMARY_TOKENS)
+        self._summary_job = (self._summary_generation, base_summary, evicted)
+
+    def _summarize(self, base_summary, evicted):
+        transcript = _transcript(base_summary, evicted)
+        try:
+            # Tóm tắt là việc nền: ưu tiên thấp, quá tải thì dùng phương án dự phòng
+            with llm_gateway.slot(PRIORITY_BATCH) as admitted:
+                if admitted:
+                    response = ollama.chat(
+                        model=settings.LLM_MODEL_ID,
+                        messages=[
+                            {"role": "system", "content": SUMMARY_PROMPT},
+                            {"role": "user", "content": transcript},
+                        ],
+                        keep_alive=settings.LLM_KEEP_ALIVE,
+                        options={"temperature": 0.2, "num_predict": settings.SESSION_SUMMARY_TOKENS},
+                    )
+                    summary = response.message.content.strip()
+                    if summary:
+                        logger.info(f"🗜️ Đã tóm tắt {len(evicted)} lượt chat cũ")
+                        return summary
+        except Exception as e:
+            logger.warning(f"⚠️ Lỗi tóm tắt hội thoại: {e}")
+        # Quá tải / lỗi: giữ summary tạm (phần cuối transcript trong giới hạn token)
+        return None
+
+
+def _transcript(base_summary, turns) -> str:
+    transcript = "\n".join(
+        f"{'Khách' if m['role'] == 'user' else 'Tư vấn'}: {m['content']}" for m in turns
+    )
+    return f"Tóm tắt trước đó: {base_summary}\n{transcript}" if base_summary else transcript
@@ -0,0 +1,108 @@
+# singleflight.py
+# (Gộp các request giống hệt nhau đang chạy đồng thời: double-click, frontend retry...)
+#
+# Request đầu tiên với 1 fingerprint khởi chạy phép tính (embedding, tìm kiếm, LLM) trong 1 task dùng chung;
+# các request trùng đến sau chỉ chờ kết quả của task đó. Task chỉ bị hủy (trả slot LLM) khi TẤT CẢ
+# client đang chờ đã bỏ đi. Kết quả được giữ thêm 1 khoảng ngắn cho request trùng đến muộn.
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from .logger import get_logger
+from .metrics import SINGLEFLIGHT_TOTAL
+
+logger = get_logger("singleflight")
+
+
+def fingerprint(*parts) -> str:
+    """sha1 của nội dung request (bytes giữ nguyên, phần còn lại serialize JSON có sắp khóa)."""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (bytes, bytearray)):
+            digest.update(hashlib.sha1(part).digest())
+        else:
+            digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class Abandoned(Exception):
+    """Client đã bỏ đi trước khi có kết quả."""
+
+
+class _Flight:
+    def __init__(self, task, cancel):
+        self.task = task
+        self.cancel = cancel            # threading.Event truyền vào phép tính (dừng LLM, trả slot)
+        self.subscribers = 0
+        self.finished_at = None
+
+
+class SingleFlight:
+
+    def __init__(self, name: str, window: float):
+        self.name = name
+        self.window = window            # Giây giữ kết quả sau khi xong
+        self._flights = {}
+
+    def _join(self, key, compute):
+        flight = self._flights.get(key)
+        if flight is not None and flight.finished_at is not None and time.monotonic() - flight.finished_at > self.window:
+            flight = None
+        if flight is not None:
+            role = "late" if flight.task.done() else "follower"
+        else:
+            role = "leader"
+            cancel = threading.Event()
+            flight = _Flight(asyncio.create_task(compute(cancel)), cancel)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finished(key, flight))
+        flight.subscribers += 1
+        SINGLEFLIGHT_TOTAL.labels(endpoint=self.name, role=role).inc()
+        if role != "leader":
+            logger.info(f"🔗 Gộp request trùng vào phép tính đang có ({self.name}, {role})")
+        return flight, role
+
+    def _finished(self, key, flight):
+        flight.finished_at = time.monotonic()
+        failed = flight.task.cancelled() or flight.task.exception() is not None
+        # Lỗi / bị hủy: không giữ lại cho request đến muộn
+        if failed or self.window <= 0:
+            self._evict(key, flight)
+        else:
+            asyncio.get_running_loop().call_later(self.window, self._evict, key, flight)
+
+    def _evict(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _leave(self, flight):
+        flight.subscribers -= 1
+        if flight.subscribers <= 0 and not flight.task.done():
+            # Không còn ai chờ: dừng phép tính dùng chung
+            flight.cancel.set()
+            flight.task.cancel()
+
+    async def do(self, key, compute, abandon: asyncio.Future = None):
+        """
+        Chạy compute(cancel) (coroutine) hoặc chờ phép tính trùng key đang chạy.
+        - abandon: awaitable hoàn tất khi client này bỏ đi -> raise Abandoned (phép tính vẫn chạy cho người khác)
+        Returns: (kết quả, role) với role = "leader" | "follower" | "late"
+        """
+        flight, role = self._join(key, compute)
+        try:
+            if abandon is None:
+                return await asyncio.shield(flight.task), role
+            done, _ = await asyncio.wait({flight.task, abandon}, return_when=asyncio.FIRST_COMPLETED)
+            if flight.task not in done:
+                raise Abandoned()
+            return flight.task.result(), role
+        finally:
+            self._leave(flight)
+
+    def stats(self):
+        return {
+            "in_flight": sum(1 for f in self._flights.values() if not f.task.done()),
+            "cached": sum(1 for f in self._flights.values() if f.task.done()),
+        }
@@ -0,0 +1,315 @@
+# vector_store.py
+# (Tìm kiếm vector qua 1 interface chung: Qdrant server hoặc NumPy memmap chạy ngay trong process)
+#
+# Backend "numpy" phù hợp khi kho nhỏ (vài nghìn vector): tìm chính xác (exact top-k) dưới 1ms,
+# không tốn round-trip mạng. Dữ liệu lấy từ chính các collection Qdrant mà index / ingest đã ghi:
+#   python -m src.vector_store export            # snapshot mọi collection ra VECTOR_STORE_DIR
+# index.py / ingest_*.py tự gọi vector_store.sync(...) sau khi nạp xong.
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy as np
+from qdrant_client.http import models
+from .config import settings
+from .logger import get_logger
+from .qdrant import client
+
+logger = get_logger("vector_store")
+
+
+@dataclass
+class SearchHit:
+    id: str
+    score: float
+    payload: dict
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+class VectorStore(ABC):
+    """Interface chung. filters: {field: value | [values]} (khớp bất kỳ; field dạng list thì khớp phần tử)."""
+
+    def search(self, collection: str, vector, limit: int, filters: dict = None):
+        return self.search_batch(collection, [vector], limit, filters)[0]
+
+    @abstractmethod
+    def search_batch(self, collection: str, vectors, limit: int, filters: dict = None):
+        """List[List[SearchHit]] theo thứ tự vectors."""
+
+    @abstractmethod
+    def read_payloads(self, collection: str, fields=None):
+        """Payload mọi điểm của collection (chỉ giữ các trường fields nếu có)."""
+
+    @abstractmethod
+    def retrieve(self, collection: str, point_id: str):
+        """(vector, payload) của 1 điểm, None nếu không có."""
+
+    def sync(self, collection: str):
+        """Gọi sau khi collection Qdrant thay đổi (index / ingest)."""
+
+
+class QdrantVectorStore(VectorStore):
+
+    def __init__(self, qdrant_client):
+        self.client = qdrant_client
+
+    @staticmethod
+    def _filter(filters):
+        if not filters:
+            return None
+        conditions = []
+        for field, value in filters.items():
+            match = models.MatchAny(any=list(value)) if isinstance(value, (list, tuple, set)) else models.MatchValue(value=value)
+            conditions.append(models.FieldCondition(key=field, match=match))
+        return models.Filter(must=conditions)
+
+    def search(self, collection, vector, limit, filters=None):
+        results = self.client.query_points(
+            collection_name=collection,
+            query=list(vector),
+            query_filter=self._filter(filters),
+            limit=limit,
+        )
+        return [SearchHit(str(p.id), p.score, p.payload) for p in results.points]
+
+    def search_batch(self, collection, vectors, limit, filters=None):
+        query_filter = self._filter(filters)
+        responses = self.client.query_batch_points(
+            collection_name=collection,
+            requests=[models.QueryRequest(query=list(v), filter=query_filter, limit=limit, with_payload=True) for v in vectors],
+        )
+        return [[SearchHit(str(p.id), p.score, p.payload) for p in r.points] for r in responses]
+
+    def read_payloads(self, collection, fields=None):
+        payloads, offset = [], None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=collection, limit=512, offset=offset,
+                with_payload=list(fields) if fields else True, with_vectors=False,
+            )
+            payloads += [p.payload for p in points]
+            if offset is None:
+                break
+        return payloads
+
+    def retrieve(self, collection, point_id):
+        points = self.client.retrieve(collection, ids=[point_id], with_payload=True, with_vectors=True)
+        return (points[0].vector, points[0].payload) if points else None
+
+
+class _LoadedCollection:
+    MAX_MASKS = 64   # Bộ lọc do người dùng gửi lên: giữ LRU nhỏ để bộ nhớ không phình theo số tổ hợp lọc
+
+    def __init__(self, matrix, ids, payloads, mtime):
+        self.matrix = matrix       # memmap (N, dim), đã chuẩn hóa L2
+        self.ids = ids
+        self.payloads = payloads
+        self.mtime = mtime
+        self._masks = OrderedDict()
+        self._masks_lock = threading.Lock()
+
+    def mask(self, filters):
+        """Mask boolean cho bộ lọc payload (LRU theo bộ lọc, collection nhỏ nên quét 1 lần là đủ)."""
+        key = json.dumps(filters, sort_keys=True, ensure_ascii=False, default=list)
+        with self._masks_lock:
+            mask = self._masks.get(key)
+            if mask is not None:
+                self._masks.move_to_end(key)
+                return mask
+        mask = np.array([_matches(p, filters) for p in self.payloads], dtype=bool)
+        with self._masks_lock:
+            self._masks[key] = mask
+            while len(self._masks) > self.MAX_MASKS:
+                self._masks.popitem(last=False)
+        return mask
+
+
+def _matches(payload, filters) -> bool:
+    for field, expected in filters.items():
+        expected = set(expected) if isinstance(expected, (list, tuple, set)) else {expected}
+        value = payload.get(field)
+        values = set(value) if isinstance(value, list) else {value}
+        if not values & expected:
+            return False
+    return True
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Mỗi collection = {dir}/{collection}.{generation}.npy (ma trận float16/float32 đã chuẩn hóa, mở bằng memmap)
+                   + {dir}/{collection}.meta.json (ids, payloads, tên file ma trận + shape).
+    Mỗi lần ghi tạo file ma trận mới rồi mới thay meta -> meta luôn trỏ tới đúng ma trận của nó.
+    Tự nạp lại khi meta thay đổi (sau khi index / ingest chạy sync).
+    """
+
+    KEEP_GENERATIONS = 2   # Giữ thêm 1 bản cũ cho request vừa đọc meta cũ nhưng chưa mở ma trận
+
+    BLOCK_ROWS = 8192   # Nhân theo khối để float16 không phải đổi kiểu cả ma trận 1 lần (float32 dùng thẳng memmap)
+
+    def __init__(self, directory: str, dtype: str = "float32"):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def _meta_path(self, collection):
+        return os.path.join(self.directory, collection + ".meta.json")
+
+    def _matrix_paths(self, collection):
+        """Các file ma trận đã ghi xong của collection, mới nhất trước."""
+        pattern = re.compile(re.escape(collection) + r"\.(\d+)\.npy")
+        generations = [(int(m.group(1)), name) for name in os.listdir(self.directory)
+                       if (m := pattern.fullmatch(name))]
+        return [os.path.join(self.directory, name) for _, name in sorted(generations, reverse=True)]
+
+    def _load(self, collection) -> _LoadedCollection:
+        meta_path = self._meta_path(collection)
+        try:
+            mtime = os.stat(meta_path).st_mtime
+        except OSError:
+            raise FileNotFoundError(f"Chưa có snapshot cho collection '{collection}' trong {self.directory}")
+
+        loaded = self._collections.get(collection)
+        if loaded is not None and loaded.mtime == mtime:
+            return loaded
+        with self._lock:
+            loaded = self._collections.get(collection)
+            if loaded is None or loaded.mtime != mtime:
+                with open(meta_path, encoding="utf-8") as f:
+                    meta = json.load(f)
+                # Snapshot cũ (trước khi có generation) không có "matrix"
+                matrix_path = os.path.join(self.directory, meta.get("matrix", collection + ".npy"))
+                matrix = np.load(matrix_path, mmap_mode="r")
+                if list(matrix.shape) != meta.get("shape", list(matrix.shape)) or \
+                        (matrix.shape[0] and matrix.shape[0] != len(meta["ids"])):
+                    raise ValueError(f"Snapshot {collection} không khớp: ma trận {matrix.shape}, meta {len(meta['ids'])} ids")
+                loaded = _LoadedCollection(matrix, meta["ids"], meta["payloads"], mtime)
+                self._collections[collection] = loaded
+                logger.info(f"📂 Nạp {collection}: {matrix.shape[0]} vectors ({matrix.dtype}, memmap)")
+        return loaded
+
+    def search_batch(self, collection, vectors, limit, filters=None):
+        data = self._load(collection)
+        if data.matrix.shape[0] == 0:
+            return [[] for _ in vectors]
+        queries = _normalize(np.atleast_2d(vectors))
+
+        # Exact dot-product (vector đã chuẩn hóa -> cosine) theo khối hàng
+        scores = np.empty((len(queries), data.matrix.shape[0]), dtype=np.float32)
+        for start in range(0, data.matrix.shape[0], self.BLOCK_ROWS):
+            block = np.asarray(data.matrix[start:start + self.BLOCK_ROWS], dtype=np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+
+        if filters:
+            scores[:, ~data.mask(filters)] = -np.inf
+
+        k = min(limit, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(scores, top):
+            ordered = candidates[np.argsort(-row[candidates])]
+            results.append([
+                SearchHit(data.ids[i], float(row[i]), data.payloads[i])
+                for i in ordered if np.isfinite(row[i])
+            ])
+        return results
+
+    def read_payloads(self, collection, fields=None):
+        payloads = self._load(collection).payloads
+        if not fields:
+            return list(payloads)
+        return [{k: p[k] for k in fields if k in p} for p in payloads]
+
+    def retrieve(self, collection, point_id):
+        data = self._load(collection)
+        try:
+            row = data.ids.index(str(point_id))
+        except ValueError:
+            return None
+        # Vector trong snapshot đã chuẩn hóa L2 (đủ cho cosine)
+        return np.asarray(data.matrix[row], dtype=np.float32), data.payloads[row]
+
+    def write_collection(self, collection, ids, vectors, payloads):
+        """
+        Ghi snapshot: ma trận vào file generation mới (không ghi đè file đang được memmap),
+        meta ghi sau cùng bằng đổi tên nguyên tử -> request đang đọc thấy trọn bản cũ hoặc trọn bản mới.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        meta_path = self._meta_path(collection)
+        matrix = _normalize(vectors).astype(self.dtype) if len(vectors) else np.zeros((0, 0), dtype=self.dtype)
+
+        matrix_name = f"{collection}.{time.time_ns()}.npy"
+        matrix_path = os.path.join(self.directory, matrix_name)
+        np.save(matrix_path + ".tmp.npy", matrix)
+        os.replace(matrix_path + ".tmp.npy", matrix_path)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"matrix": matrix_name, "shape": list(matrix.shape),
+                       "ids": [str(i) for i in ids], "payloads": payloads}, f, ensure_ascii=False)
+        os.replace(meta_path + ".tmp", meta_path)
+        logger.info(f"💾 Snapshot {collection}: {len(ids)} vectors -> {matrix_path}")
+
+        for old in self._matrix_paths(collection)[self.KEEP_GENERATIONS:]:
+            try:
+                os.unlink(old)
+            except OSError:
+                pass
+
+    def sync(self, collection):
+        export_collection(collection, self)
+
+
+def read_collection(collection: str, batch_size: int = 256):
+    """Đọc toàn bộ điểm (kèm vector) của collection Qdrant -> (ids, ma trận float32, payloads)."""
+    ids, vectors, payloads = [], [], []
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection, limit=batch_size, offset=offset, with_payload=True, with_vectors=True,
+        )
+        for point in points:
+            ids.append(point.id)
+            vectors.append(point.vector)
+            payloads.append(point.payload)
+        if offset is None:
+            break
+    return ids, np.asarray(vectors, dtype=np.float32), payloads
+
+
+def export_collection(collection: str, store: NumpyVectorStore):
+    """Ghi collection Qdrant thành snapshot NumPy."""
+    store.write_collection(collection, *read_collection(collection))
+
+
+def make_vector_store() -> VectorStore:
+    if settings.VECTOR_BACKEND == "numpy":
+        return NumpyVectorStore(settings.VECTOR_STORE_DIR, settings.VECTOR_STORE_DTYPE)
+    return QdrantVectorStore(client)
+
+
+vector_store = make_vector_store()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot collection Qdrant ra file NumPy (memmap)")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--collections", default=f"{settings.PAINTINGS_COLLECTION},{settings.DOCS_COLLECTION}")
+    args = parser.parse_args()
+
+    store = vector_store if isinstance(vector_store, NumpyVectorStore) else \
+        NumpyVectorStore(settings.VECTOR_STORE_DIR, settings.VECTOR_STORE_DTYPE)
+    for collection in args.collections.split(","):
+        export_collection(collection.strip(), store)
+
+
+if __name__ == "__main__":
+    main()
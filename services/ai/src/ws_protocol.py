@@ -0,0 +1,250 @@
+# ws_protocol.py
+# (Giao thức websocket cho /ws/chat: v1 giữ nguyên cho client cũ, v2 gom token + ảnh dạng binary)
+#
+# Protocol v1 (/ws/chat):
+#   Client -> { "text": "...", "image": "base64...", "feng_shui_profile": {...} }
+#   Server -> { "type": "products", "data": [...] } rồi từng token dạng text frame
+#
+# Protocol v2 (/ws/chat/v2):
+#   Client -> { "type": "message", "text": "...", "feng_shui_profile": {...}, "image_size": 123456 }
+#             theo sau là các binary frame chứa đúng image_size bytes ảnh (nếu có)
+#   Server -> { "type": "products", "data": [...] }
+#             { "type": "delta", "text": "..." }        (nhiều token gom lại)
+#             { "type": "done", "cached": bool, "usage": {...} }
+#             { "type": "cancelled" }                   (lượt bị thay bởi tin nhắn mới, không có "done")
+#             { "type": "error", "message": "..." }
+import asyncio
+import base64
+import binascii
+import json
+import time
+from fastapi import WebSocket, WebSocketDisconnect
+from .config import settings
+from .logger import get_logger
+
+logger = get_logger("ws_protocol")
+
+
+class ChatEmitterV1:
+    """Gửi kết quả theo định dạng cũ: mỗi token 1 text frame."""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+
+    def reset(self):
+        pass
+
+    async def products(self, data):
+        await self.websocket.send_json({"type": "products", "data": data})
+
+    async def token(self, token: str):
+        await self.websocket.send_text(token)
+
+    async def done(self, usage=None, cached=False):
+        pass
+
+    async def cancelled(self):
+        pass
+
+    async def error(self, message: str):
+        logger.warning(f"⚠️ WS error: {message}")
+
+
+class ChatEmitterV2:
+    """
+    Gom token thành frame theo cửa sổ thời gian / kích thước để giảm số lần gửi (syscall + framing).
+    Token đầu tiên được gửi ngay để giữ time-to-first-token thấp.
+    """
+
+    def __init__(self, websocket: WebSocket, window_ms: int = None, max_chars: int = None):
+        self.websocket = websocket
+        self.window = (window_ms if window_ms is not None else settings.WS_COALESCE_MS) / 1000
+        self.max_chars = max_chars or settings.WS_COALESCE_CHARS
+        self._buffer = []
+        self._buffered_chars = 0
+        self._first_at = None
+        self._sent_first = False
+        self._flusher = None
+        self._lock = asyncio.Lock()
+
+    def reset(self):
+        """Bắt đầu câu trả lời mới: bỏ phần đệm còn sót của lượt bị hủy."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        self._buffer, self._buffered_chars, self._first_at = [], 0, None
+        self._sent_first = False
+
+    async def products(self, data):
+        await self.websocket.send_json({"type": "products", "data": data})
+
+    async def token(self, token: str):
+        if not self._sent_first:
+            self._sent_first = True
+            await self.websocket.send_json({"type": "delta", "text": token})
+            return
+
+        async with self._lock:
+            self._buffer.append(token)
+            self._buffered_chars += len(token)
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+            should_flush = self._buffered_chars >= self.max_chars or time.monotonic() - self._first_at >= self.window
+            if should_flush:
+                await self._flush_locked()
+            elif self._flusher is None:
+                # Đảm bảo phần đệm không bị giữ lâu hơn cửa sổ khi token đến chậm
+                self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.window)
+            async with self._lock:
+                self._flusher = None
+                await self._flush_locked()
+        except asyncio.CancelledError:
+            pass
+
+    async def _flush_locked(self):
+        if not self._buffer:
+            return
+        text = "".join(self._buffer)
+        self._buffer, self._buffered_chars, self._first_at = [], 0, None
+        await self.websocket.send_json({"type": "delta", "text": text})
+
+    async def done(self, usage=None, cached=False):
+        async with self._lock:
+            if self._flusher is not None:
+                self._flusher.cancel()
+                self._flusher = None
+            await self._flush_locked()
+        self._sent_first = False
+        await self.websocket.send_json({"type": "done", "cached": cached, "usage": usage or {}})
+
+    async def cancelled(self):
+        """Kết thúc lượt bị hủy: bỏ phần đệm chưa gửi, báo client stream đã dừng."""
+        self.reset()
+        await self.websocket.send_json({"type": "cancelled"})
+
+    async def error(self, message: str):
+        await self.websocket.send_json({"type": "error", "message": message})
+
+
+async def receive_v1(websocket: WebSocket, inbox: asyncio.Queue):
+    """Đọc tin nhắn JSON (ảnh base64) và đưa vào inbox. Đưa None khi ngắt kết nối."""
+    try:
+        while True:
+            data = await websocket.receive_json()
+
+            image_bytes = None
+            image_b64 = data.get("image")
+            if image_b64:
+                if "," in image_b64: image_b64 = image_b64.split(",")[1]
+                try:
+                    image_bytes = base64.b64decode(image_b64)
+                except (binascii.Error, ValueError):
+                    logger.warning("⚠️ Ảnh base64 không hợp lệ, bỏ qua ảnh")
+                if image_bytes and len(image_bytes) > settings.WS_MAX_IMAGE_BYTES:
+                    logger.warning(f"⚠️ Ảnh quá lớn ({len(image_bytes)} bytes), bỏ qua ảnh")
+                    image_bytes = None
+
+            await inbox.put({
+                "text": data.get("text", ""),
+                "image_bytes": image_bytes,
+                "feng_shui_profile": data.get("feng_shui_profile"),
+            })
+    except WebSocketDisconnect:
+        logger.info("👋 Client Disconnected")
+    except Exception as e:
+        logger.error(f"❌ Error: {e}")
+    finally:
+        await inbox.put(None)
+
+
+def _parse_image_size(value):
+    """image_size trong header: số nguyên >= 0 (thiếu = 0); sai kiểu / âm -> None."""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return None
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return None
+    if size < 0 or (isinstance(value, float) and value != size):
+        return None
+    return size
+
+
+async def receive_v2(websocket: WebSocket, inbox: asyncio.Queue, emitter: ChatEmitterV2):
+    """
+    Đọc header JSON + các binary frame ảnh. Giới hạn kích thước được kiểm tra ngay khi nhận
+    (header khai báo quá lớn hoặc nhận nhiều hơn khai báo -> bỏ ảnh, báo lỗi).
+    """
+    pending = None          # Header đang chờ đủ bytes ảnh
+    buffer = bytearray()
+    discard_remaining = 0   # Số bytes của ảnh bị từ chối còn phải bỏ qua
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                logger.info("👋 Client Disconnected")
+                break
+
+            if message.get("bytes") is not None:
+                chunk = message["bytes"]
+                if discard_remaining > 0:
+                    discard_remaining = max(discard_remaining - len(chunk), 0)
+                    continue
+                if pending is None:
+                    await emitter.error("Binary frame không có header 'message' đi trước")
+                    continue
+
+                buffer.extend(chunk)
+                expected = pending["image_size"]
+                if len(buffer) > expected or len(buffer) > settings.WS_MAX_IMAGE_BYTES:
+                    await emitter.error("Dữ liệu ảnh vượt quá kích thước khai báo")
+                    pending, buffer = None, bytearray()
+                    continue
+                if len(buffer) == expected:
+                    await inbox.put({**pending["message"], "image_bytes": bytes(buffer)})
+                    pending, buffer = None, bytearray()
+                continue
+
+            try:
+                header = json.loads(message.get("text") or "")
+            except json.JSONDecodeError:
+                await emitter.error("Header JSON không hợp lệ")
+                continue
+            if header.get("type") != "message":
+                await emitter.error(f"Loại tin nhắn không hỗ trợ: {header.get('type')}")
+                continue
+
+            parsed = {
+                "text": header.get("text", ""),
+                "image_bytes": None,
+                "feng_shui_profile": header.get("feng_shui_profile"),
+            }
+            if pending is not None:
+                await emitter.error("Ảnh của tin nhắn trước chưa gửi đủ, đã bỏ qua")
+                pending, buffer = None, bytearray()
+            image_size = _parse_image_size(header.get("image_size"))
+            if image_size is None:
+                await emitter.error(f"image_size không hợp lệ: {header.get('image_size')!r}")
+                continue
+
+            if image_size > settings.WS_MAX_IMAGE_BYTES:
+                await emitter.error(f"Ảnh quá lớn (tối đa {settings.WS_MAX_IMAGE_BYTES} bytes)")
+                discard_remaining = image_size
+                await inbox.put(parsed)
+            elif image_size > 0:
+                pending = {"message": parsed, "image_size": image_size}
+            else:
+                await inbox.put(parsed)
+    except WebSocketDisconnect:
+        logger.info("👋 Client Disconnected")
+    except Exception as e:
+        logger.error(f"❌ Error: {e}")
+    finally:
+        await inbox.put(None)